@@ -0,0 +1,39 @@
+import sys
+import time
+import types
+
+# from . import util
+# from .util import *
+
+from util import *
+
+# Micro-benchmarks for hot paths of the bot. They use stand-in objects and do not connect to discord. Run with `python benchmark.py [name]`.
+
+def legacyAccepts(botMention: str, settings: dict[str, Any], message: Any) -> bool:
+    """The routing check of on_message before routes were compiled, for comparison"""
+    if message.channel.id in settings["channellist"]: return settings["channellistiswhitelist"]
+    return message.content.startswith(botMention) or message.content.startswith(settings["commandprefix"])
+
+def routing(n: int=200000) -> dict[str, float]:
+    """Measures messages per second through the reject path of the routing check, for a guild with a 50 channel blacklist"""
+    botID = 123456789012345678
+    settings = {"commandprefix": "//", "channellist": list(range(1000, 1050)), "channellistiswhitelist": False}
+    route = MessageRoute(botID, settings)
+    channel = types.SimpleNamespace(id=5000)
+    messages = [types.SimpleNamespace(channel=channel, content=f"just chatting about message number {i}") for i in range(1000)]
+
+    results = {}
+    start = time.perf_counter()
+    for i in range(n): legacyAccepts(f"<@{botID}>", settings, messages[i % 1000])
+    results["legacy"] = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    accepts = route.accepts
+    for i in range(n): accepts(messages[i % 1000])
+    results["compiled"] = n / (time.perf_counter() - start)
+    return results
+
+benchmarks = {"routing": routing}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks:
+        for k,v in benchmarks[name]().items(): print(f"{name} {k}: {v:,.0f}/s")
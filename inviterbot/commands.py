@@ -1,9 +1,13 @@
 import discord
 import traceback
 import random
-import subprocess
 import os
+import re
+import time
+import asyncio
 
+import executor, ipc
+from runner import PistonError
 from discord.embeds import Embed
 
 # from . import util, static
@@ -12,9 +16,11 @@ from discord.embeds import Embed
 
 from static import *
 from util import *
+from registry import *
 
 class GeneralCommands:
     """A static class that contains all commands normally around server configuration and behaviour. Commands executed here do not necessarily mean that the user has been authenticated, and permissions must be checked during command execution. These commands may or may not have None contexts."""
+    @command(GENERAL)
     async def command_random(event: CommandEvent):
         """Generates a random number. """
         if len(event.parameters) == 0: return "Specify what type of randomness you want"
@@ -27,6 +33,7 @@ class GeneralCommands:
         elif parameters[0].isdecimal(): return f"Here {'are' if a > 1 else 'is'} random number{'s' if a > 1 else ''} between `{0}` and `{int(parameters[0])}`: `{'`, `'.join([str(random.randint(0, int(parameters[0]))) for x in range(a)])}`"
         else: return f"Here {'are' if a > 1 else 'is'} your random number{'s' if a > 1 else ''} between `{0}` and `{int(100)}`: `{'`, `'.join([str(random.randint(0, 100)) for x in range(a)])}`"
         
+    @command(GENERAL)
     async def command_auth(event: CommandEvent):
         if event.parameters == "": 
             if event.context: return f"You are currently sending messages in `{event.bot.resolveGuild(event.context.guildID)}`. To switch servers, specify a server name or server ID."
@@ -60,11 +67,13 @@ class GeneralCommands:
 
 class ServerCommands:
     """A static class that contains all commands normally around server configuration and behaviour. Commands executed here do not necessarily mean that the user has been authenticated, and permissions must be checked during command execution. These commands will always have valid contexts."""
-    def command_settings(event: CommandEvent): pass
+    @command(SERVER)
+    async def command_settings(event: CommandEvent): pass
 
 class PrivilegedCommands:
     """A static class that contains all commands normally around bot management. Commands executed here mean that the user has already been authenticated as a custodian or the bot owner. These commands may or may not have None contexts."""
 
+    @command(PRIVILEGED)
     async def command_custodians(event: CommandEvent):
         """Manages the custodians of the bot. Target users may be given as ids or mentions (discord.User)"""
         ret = EmbedBuilder().setColor(0xd4af37).setHeaderUser(event.bot.user).setTimeNow().setTitle("Custodians")
@@ -112,6 +121,7 @@ class PrivilegedCommands:
                     event.bot.admin.remove(x)
                     success.add(x)
         else: return
+        if success: event.bot.store.put("custodians", list(event.bot.admin))
 
         # Return the result of the command
         if len(success) > 1: desc.append(' '.join([f"<@{x}>" for x in success]) + f" are {'already' if mode else 'no longer'} custodians")
@@ -122,9 +132,37 @@ class PrivilegedCommands:
         ret.setDescription("\n".join(desc))
         return ret.build()
 
+    @command(PRIVILEGED)
+    async def command_stats(event: CommandEvent):
+        """Shows where the bot spends its time"""
+        m = event.bot.metrics
+        lag = m.histogram("loop:lag")
+        uptime = int(time.time() - m.started)
+        ret = EmbedBuilder().setColor(0x3498db).setHeaderUser(event.bot.user).setTimeNow().setTitle("Statistics")
+        ret.setDescription(f"Up for {uptime // 3600}h {uptime // 60 % 60}m. Event loop lag p50 {lag.percentile(50) * 1000:g}ms, p99 {lag.percentile(99) * 1000:g}ms, max {lag.max * 1000:.1f}ms")
+        e = ret.build()
+        e.add_field(name="Slowest events", value=m.summary("event", 5), inline=False)
+        e.add_field(name="Slowest commands", value=m.summary("command", 5), inline=False)
+        if m.detector is not None: e.add_field(name="Blocked the event loop", value=m.detector.summary(5), inline=False)
+        e.add_field(name="REST calls", value="\n".join(f"`{k[5:]}` {v}" for k,v in sorted(m.counters.items()) if k.startswith("rest:")) or "None", inline=False)
+        e.add_field(name="Scheduler", value=event.bot.scheduler.summary(), inline=False)
+        e.add_field(name="Execute", value=event.bot.executor.summary(), inline=False)
+        e.add_field(name="Run", value=event.bot.runner.summary(), inline=False)
+        e.add_field(name="Rich messages", value=event.bot.messageHandler.richMessages.summary(), inline=False)
+        e.add_field(name="Outbound", value=", ".join(f"{k} {v}" for k,v in event.bot.messageHandler.outbound.items()), inline=False)
+        e.add_field(name="Invites", value=event.bot.invites.summary() + "\n" + event.bot.warmup.progress(), inline=False)
+        if isinstance(event.bot, discord.AutoShardedClient):
+            latencies = dict(event.bot.latencies)
+            r = []
+            for id, s in sorted(event.bot.shardStates.items()):
+                guilds = sum(1 for x in event.bot.guilds if x.shard_id == id)
+                r.append(f"`{id}` {'ready' if s.ready else 'not ready'}, {guilds} guilds, {latencies.get(id, float('nan')) * 1000:.0f}ms, {s.eventRate():.1f} events/s, {s.resumes} resumes")
+            e.add_field(name="Shards", value="\n".join(r) or "None ready", inline=False)
+        return e
+
+    @command(PRIVILEGED)
     async def command_execute(event: CommandEvent):
-        """Executes a python command. Useful for changing bot configurations or prototyping code."""
-        ldict = {}
+        """Executes python statements separated by `;`. Useful for changing bot configurations or prototyping code. Statements that do not use the bot run in a worker process with a timeout."""
         gdict = {
             "event": event,
             "bot": event.bot,
@@ -136,45 +174,67 @@ class PrivilegedCommands:
             "context": event.context,
             "discord": discord
         }
-        parameters = event.parameters.split(';')
+        live = set(executor.LIVE_NAMES)
+        parameters = [x.strip() for x in event.parameters.split(';') if x.strip()]
         r = []
         rs = []
-        for command in parameters:
-            ctemp = command.split('=', 1)
+        def render() -> str:
+            x = "```\n" + ',\n'.join(r) + "```"
+            if len(x) > 1900: return "Message too long. Showing types only:\n```\n" + ',\n'.join(rs) + "```"
+            return x
+        start = time.monotonic()
+        for i, command in enumerate(parameters):
             try:
-                if len(ctemp) > 1 and "(" not in ctemp[0]:
-                    exec(f"async def __exec__(): return ({ctemp[1].strip()})", gdict, ldict)
-                    x = await ldict['__exec__']()
-                    gdict[ctemp[0]] = x
-                    r.append(str(x))
-                    rs.append(type(x).__name__)
-                else:
-                    exec(f"async def __exec__(): return ({command})", gdict, ldict)
-                    x = await ldict['__exec__']()
-                    r.append(str(x))
-                    rs.append(type(x).__name__)
+                text, typeName, output = await event.bot.executor.run(event.bot.executor.compile(command), gdict, live)
+                r.append(output + text)
+                rs.append(typeName)
+            except asyncio.TimeoutError:
+                r.append(f"-----\nTimed out after {event.bot.executor.timeout:g}s\n-----")
+                rs.append("timeout")
+            except executor.WorkerError as e:
+                r.append(f"-----\n{e}-----")
+                rs.append("error")
             except Exception as e:
                 r.append(f"-----\n{traceback.format_exc()}-----")
-        r = "```\n" + ',\n'.join(r) + "```"
-        rs = "Message too long. Showing types only:\n```\n" + ',\n'.join(rs) + "```"
-        if len(r) > 1900: return rs
-        return r
+                rs.append("error")
+            # Show the results so far while later statements are still running
+            if i < len(parameters) - 1 and time.monotonic() - start > 1: await event.sendResponse(render() + f"\nRunning statement {i + 2} of {len(parameters)}...", finished=False)
+        return render()
 
+    @command(PRIVILEGED)
     async def command_run(event: CommandEvent):
-        """Executes another command as another user."""
-        eb = EmbedBuilder().setColor(0xffff00).setFooterUser(event.message.author).setTimeNow().setDescription("PDesc").setTitle("PT")
-        return eb.build()
-        # TODO
-        # ce = CommandEvent(event.bot, targetUser, event.message, name, parameters)
-        # eb.setHeaderUser(targetUser)
-        # pass
+        """Runs code on Piston. Usage: `run <language>[@version] [args...]` followed by a code block, and optionally a second code block to use as stdin."""
+        blocks = re.findall(r"```(?:[^\n`]*\n)?(.*?)```", event.parameters, re.DOTALL)
+        head = event.parameters.split("```", 1)[0].split()
+        if not head or not blocks: return "Give a language followed by a code block to run, e.g. `run py` and then the code in a code block."
+        language, _, version = head[0].partition("@")
+        runner = event.bot.runner
+        try: result, cached = await runner.execute(language, [{"content": blocks[0]}], blocks[1] if len(blocks) > 1 else "", head[1:], version or None)
+        except PistonError as e: return f"The code could not be run: {e}"
+        ret = EmbedBuilder().setColor(0x3498db).setFooterUser(event.message.author).setTimeNow().setTitle(f"{result['language']} {result['version']}")
+        desc = []
+        for stage in ("compile", "run"):
+            x = result.get(stage)
+            if x is None or (stage == "compile" and x.get("code") == 0 and not x.get("output")): continue
+            status = f"exit code {x['code']}" if x.get("signal") is None else f"killed by {x['signal']}"
+            output = x.get("output", "")[-900:].replace("```", "`\u200b``") or "No output"
+            desc.append(f"**{stage.capitalize()}** ({status})\n```\n{output}```")
+        ret.setDescription("\n".join(desc) + ("\nThis result was cached." if cached else ""))
+        return ret.build()
 
+    @command(PRIVILEGED)
     async def command_update(event: CommandEvent):
         """Fetches and update for the discord bot."""
-        x = subprocess.run("git pull", capture_output=True, shell=True)
-        if "Already up to date" not in x.stdout.decode("utf-8"): return "Fetched an update. Use `reload {module}` or `restart` to apply the update."
+        process = await asyncio.create_subprocess_exec("git", "pull", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try: stdout, stderr = await asyncio.wait_for(process.communicate(), 120)
+        except asyncio.TimeoutError:
+            process.kill()
+            return "Fetching an update timed out."
+        if process.returncode != 0: return f"Fetching an update failed:\n```{stderr.decode('utf-8', 'replace')[-1800:]}```"
+        if "Already up to date" not in stdout.decode("utf-8"): return "Fetched an update. Use `reload {module}` or `restart` to apply the update."
         return "No update was found."
 
+    @command(PRIVILEGED)
     async def command_reload(event: CommandEvent):
         """Reloads all or parts of the discord bot."""
         t = event.parameters.lower()
@@ -186,49 +246,62 @@ class PrivilegedCommands:
             if x: return f"Successfully reloaded the `{t}` module."
             else: return f"`{t}` is not a valid module to reload."
 
+    @command(PRIVILEGED)
     async def command_restart(event: CommandEvent):
-        """Restarts the bot"""
-        await event.sendResponse("Restarting the bot.")
+        """Restarts the bot. A new process takes over once it is ready, unless `cold` is given, in which case the bot shuts down first."""
+        if event.parameters.strip().lower() != "cold":
+            try: 
+                await event.bot.manager.handoff()
+                return "Starting a new process. It takes over once it is ready."
+            except ipc.RemoteError as e: await event.sendResponse(f"Could not hand off ({e}), restarting the bot.")
+        else: await event.sendResponse("Restarting the bot.")
         event.bot.manager.queueRestart()
         await event.bot.shutdown()
 
+    @command(PRIVILEGED)
     async def command_shutdown(event: CommandEvent):
         """Shuts down the bot"""
         await event.sendResponse("Shutting down the bot.")
         await event.bot.shutdown()
 
+    @command(PRIVILEGED)
     async def command_deployments(event: CommandEvent):
         """Manages the current deployments"""
         parameters = [x.lower() for x in event.parameters.strip().split(" ", 1)]
+        manager = event.bot.manager
         ret = EmbedBuilder().setColor(0x00ff00).setHeaderUser(event.user).setTimeNow().setTitle("Deployments")
-        if len(parameters) == 0: return ret.setColor(0xff0000).setDescription("Use `start`, `restart`, `stop`, or `list` to manage deployments.").build()
+        if not parameters[0]: return ret.setColor(0xff0000).setDescription("Use `start`, `restart`, `stop`, `list`, or `query` to manage deployments.").build()
+        if parameters[0] in ("start", "stop", "restart", "list") and manager is None: return ret.setColor(0xff0000).setDescription("This deployment is not running under a supervisor.").build()
         if parameters[0] == "start" or parameters[0] == "stop" or parameters[0] == "restart":
-            response = None
-            deploymentModule = ""
-            deploymentID = ""
+            action = {"start": "started", "stop": "stopped", "restart": "restarted"}[parameters[0]]
+            if len(parameters) < 2: return ret.setColor(0xff0000).setDescription(f"Specify a deployment {'module' if parameters[0] == 'start' else 'ID'} to {parameters[0]}").build()
             if parameters[0] == "start":
-                if len(parameters) < 2: return ret.setColor(0xff0000).setDescription(f"Specify a deployment module to {parameters[0]}").build()
-                response = await event.bot.manager.sendDeploymentCommand("start",parameters[1]).getResponse()
                 deploymentModule = parameters[1]
-                deploymentID = response.arguments
+                deploymentID = None
             else:
-                if len(parameters) < 2: return ret.setColor(0xff0000).setDescription(f"Specify a deployment ID to {parameters[0]}").build()
-                currentDeployments = eval((await event.bot.manager.sendDeploymentCommand("list","").getResponse()).arguments)
-                if parameters[1] not in currentDeployments: return ret.setDescription(f"`{parameters[1]}` is not a valid deployment ID.").build()
-                response = await event.bot.manager.sendDeploymentCommand(parameters[0], parameters[1]).getResponse()
-                if parameters[0] == "restart": response = await event.bot.manager.sendDeploymentCommand("stop", parameters[1]).getResponse()
-                deploymentModule = currentDeployments[parameters[1]]
+                # The supervisor pushes the state of all deployments, so this needs no request
+                if parameters[1] not in manager.deployments: return ret.setDescription(f"`{parameters[1]}` is not a valid deployment ID.").build()
+                deploymentModule = manager.deployments[parameters[1]]["module"]
                 deploymentID = parameters[1]
-            if response.command == "OK": ret.setDescription(f"Successfully {parameters[0]}ed deployment `{deploymentID}` (`{deploymentModule}`)")
-            else: ret.setColor(0xffff00).setDescription(f"Got `{response.command}` trying to {parameters[0]} deployment `{deploymentID}` (`{deploymentModule}`)")
+            try: 
+                if parameters[0] == "start": deploymentID = await manager.start(deploymentModule)
+                else: await getattr(manager, parameters[0])(deploymentID)
+            except (ipc.RemoteError, ConnectionError) as e: return ret.setColor(0xffff00).setDescription(f"Could not {parameters[0]} deployment `{deploymentID or deploymentModule}`: {e}").build()
+            ret.setDescription(f"Successfully {action} deployment `{deploymentID}` (`{deploymentModule}`)")
         elif parameters[0] == "list":
-            currentDeployments = eval((await event.bot.manager.sendDeploymentCommand("list","").getResponse()).arguments)
             ret.setTitle("Current Deployments")
             desc = ""
-            for deployment in currentDeployments:
-                desc += f"\n - `{deployment}`: `{currentDeployments[deployment]}`"
-            ret.setDescription(desc.lstrip("\n"))
-        elif parameters[0] == "query": ret.setTitle("Detected Deployment Modules").setDescription("\n".join([f" - `{x[2:]}`" for x in [f.path for f in os.scandir(".") if f.is_dir()] if os.path.exists(x+'/deploy.py')]))
-        else: ret.setColor(0xff0000).setDescription("Unknown subcommand. Use `start`, `restart`, `stop`, or `list` to manage deployments.")
+            for k,v in manager.deployments.items():
+                desc += f"\n - `{k}`: `{v['module']}` {v['state']}"
+                if v["pid"] is not None: desc += f", up {int(time.time() - v['startedAt']) // 60}m"
+                if v["latency"] is not None: desc += f", gateway {v['latency'] * 1000:.0f}ms"
+                if v["rtt"] is not None: desc += f", checked in {v['rtt'] * 1000:.1f}ms"
+                if v["restarts"]: desc += f", {v['restarts']} restarts"
+                if k == manager.id: desc += " (this deployment)"
+            ret.setDescription(desc.lstrip("\n") or "None")
+        elif parameters[0] == "query":
+            found = await asyncio.get_event_loop().run_in_executor(None, lambda: [f.name for f in os.scandir(".") if f.is_dir() and os.path.exists(f.path + "/deploy.py")])
+            ret.setTitle("Detected Deployment Modules").setDescription("\n".join(f" - `{x}`" for x in found))
+        else: ret.setColor(0xff0000).setDescription("Unknown subcommand. Use `start`, `restart`, `stop`, `list`, or `query` to manage deployments.")
         return ret.build()
             
\ No newline at end of file
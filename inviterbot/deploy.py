@@ -1,5 +1,5 @@
+import asyncio
 import discord
-import os
 import json
 import importlib
 from typing import Any, Union, List, NoReturn, Optional
@@ -8,15 +8,23 @@ from typing import Any, Union, List, NoReturn, Optional
 # from .static import *
 # from .util import *
 
-import commands, events, messages, static
+import commands, events, executor, handoff, invites, messages, metrics, persistence, registry, runner, scheduler, shards, static, warmup
 from static import *
 from util import *
 
 tokens = {}
+shardCount = None # Number of shards to run ShardedDeployment with. None lets discord recommend it.
+metricsExport = None # Path of a file to periodically write metrics to in the Prometheus text format, if any
+pistonURL = "http://127.0.0.1:2000" # Piston server used by the run command
+pistonConcurrency = 64 # Jobs the run command may have in flight, which should match max_concurrent_jobs of the Piston server
+blockingThreshold = None # Debug mode. Seconds a callback may hold the event loop before it is reported with the command or event that caused it.
 
 owner = ""
-admin = set(loadJSON("custodians.json")) # type: set[str]
-context = {}
+admin = set() # type: set[str] # Filled from the store when a deployment is created
+context = {} # type: dict[int, ServerContext] # Server contexts by guild id
+
+# Events that are handled even when the bot is not serving, as they only track the connection
+PASSIVE_EVENTS = frozenset(("on_socket_response", "on_shard_connect", "on_shard_disconnect", "on_shard_ready", "on_shard_resumed"))
 
 def isBotCustodian(user: Any) -> bool:
     """Returns if the given user is a custodian (admin) of the application"""
@@ -34,11 +42,28 @@ class Deployment(discord.Client):
     isBotOwner = lambda a,b=None: isBotOwner(a) or isBotOwner(b)
     isBotCustodian = lambda a,b=None: isBotCustodian(a) or isBotCustodian(b)
 
-    def __init__(self, manager, token: str):
-        super().__init__(intents=discord.Intents.all())
+    def __init__(self, manager, token: str, **options):
+        super().__init__(intents=discord.Intents.all(), **options)
         self.manager = manager 
         if token in tokens: token = tokens[token]
         self.token = token
+        self.lastPinTimestamps = {} # type: dict[int, Optional[str]]
+        self.guildIndex = NameIndex()
+        self.channelIndex = NameIndex()
+        self.userIndex = NameIndex()
+        self.memberIndexes = {} # type: dict[int, NameIndex]
+        self.metrics = metrics.Metrics(exportPath=metricsExport, blockingThreshold=blockingThreshold)
+        self.prepared = None # type: asyncio.Future
+        self.shardStates = {} # type: dict[int, shards.ShardState]
+        self.guildIDs = set() # type: set[int]
+        self.pendingDMContexts = {} # type: dict[int, list[str]] # Stored DM contexts of guilds whose shard is not ready yet
+        self.pendingContexts = {} # type: dict[int, dict[str, Any]] # Handed off context states of guilds whose shard is not ready yet
+        # A process that takes over from another stays passive until the previous process stops serving, and buffers events until it is prepared
+        self.handoffPath = getattr(manager, "handoffPath", None) # type: Optional[str]
+        self.serving = self.handoffPath is None
+        self.takeover = None # type: asyncio.Future
+        self.store = persistence.Store("state").recover()
+        admin.update(self.store.load("custodians", []))
 
     def deploy(self) -> None:
         """Blocking call that deploys the bot with the given token. Returns after shutdown is called. """
@@ -46,21 +71,93 @@ class Deployment(discord.Client):
 
     async def on_ready(self) -> None:
         """Discord event. Prepares all aspects of the bot after connect and login"""
+        await self.prepare()
+        self.prepareGuilds(self.guilds)
+        self.getShard(0).ready = True
+
+    async def prepare(self) -> bool:
+        """Prepares the parts of the bot that do not depend on specific guilds. Only runs once, and returns whether it ran in this call."""
+        if self.prepared is not None: 
+            await self.prepared
+            return False
+        self.prepared = asyncio.get_event_loop().create_future()
         print(f"Successful login as {self.user}")
+        snapshot = await self.receiveHandoff() if self.handoffPath is not None else None
         if self.manager: self.manager.signalRunning()
         self.prepareCommands()
-        print("Initializing guilds and contexts:")
-        self.guildIDs = set()
-        if "settings" not in os.listdir(): os.mkdir("settings")
-        for x in self.guilds:
-            print(f" - {x.name} ({x.id}) owned by {x.owner_id}")
-            await self.on_guild_join(x)
+        self.dmRoute = MessageRoute(self.user.id)
+        self.store.start()
+        await self.store.migrateLegacy()
+        self.metrics.start()
+        self.indexUsers()
+        # Contexts are created from disk immediately. Invites are fetched in the background, and guilds that receive events first are initialized first.
+        self.warmup = warmup.GuildWarmup(self, self.store.load("invites", {}))
+        self.invites = invites.InviteAttribution(self)
         self.dmContexts = {}
-        for k,v in loadJSON("dmcontexts.json").items():
-            self.setDMContext(k, v)
-
+        self.dmGuildIndex = {} # type: dict[int, set[int]] # Guild id to the ids of users whose DMs are set to it
         self.messageHandler = messages.MessageHandler(self)
-        await self.messageHandler.update()
+        self.scheduler = scheduler.CommandScheduler(self)
+        self.scheduler.start()
+        self.executor = executor.StatementExecutor()
+        self.runner = runner.PistonRunner(pistonURL, pistonConcurrency)
+        if snapshot is not None: self.pendingContexts = {int(k): v for k,v in snapshot.get("contexts", {}).items()}
+        # Guilds that are already connected must be known before DM contexts and pins refer to them
+        self.prepareGuilds(self.guilds)
+        dmContexts = snapshot["dmContexts"] if snapshot is not None and "dmContexts" in snapshot else self.store.load("dmcontexts", {})
+        for k,v in dmContexts.items():
+            if v is None: continue
+            if int(v) in self.guildIDs: self.setDMContext(k, v)
+            else: self.pendingDMContexts.setdefault(int(v), []).append(k)
+        if snapshot is not None and handoff.restoreMessages(self.messageHandler, snapshot): self.messageHandler.ready = True
+        else: await self.messageHandler.update()
+        self.prepared.set_result(True)
+        return True
+
+    async def receiveHandoff(self) -> Optional[dict[str, Any]]:
+        """Takes over from the previous process of this deployment and returns its snapshot, or None if it could not be read. Events are buffered from here until the bot is prepared. Closes the bot if the previous process could not be reached, as it is then still serving."""
+        self.takeover = self.prepared
+        self.serving = True
+        try: snapshot = await handoff.receive(self.handoffPath)
+        except OSError:
+            await self.close()
+            raise
+        except handoff.HandoffError as e:
+            print(f"Starting without a handoff snapshot: {e}")
+            snapshot = None
+        # The previous process wrote everything to the store before handing off
+        self.store = await asyncio.get_event_loop().run_in_executor(None, persistence.Store("state").recover)
+        admin.update(self.store.load("custodians", []))
+        if snapshot is not None: print(f"Took over with a snapshot from {time.time() - snapshot.get('createdAt', time.time()):.2f}s ago")
+        return snapshot
+
+    def prepareGuilds(self, guilds: List[discord.Guild]) -> None:
+        """Creates the contexts of the given guilds and schedules their warm-up. Guilds that were already prepared are skipped."""
+        guilds = [x for x in guilds if x.id not in self.guildIDs]
+        if not guilds: return
+        print("Initializing guilds and contexts:")
+        self.indexGuilds(guilds)
+        for x in guilds:
+            print(f" - {x.name} ({x.id}) owned by {x.owner_id}")
+            self.guildIDs.add(x.id)
+            c = self.warmup.seed(x)
+            # Must happen before the warm-up tasks run, which skip contexts that were warmed by the previous process
+            if x.id in self.pendingContexts: handoff.restoreContext(c, self.pendingContexts.pop(x.id))
+            for k in self.pendingDMContexts.pop(x.id, ()): self.setDMContext(k, x.id)
+        self.warmup.start(guilds)
+
+    def getShard(self, shard: int) -> shards.ShardState:
+        """Returns the state of a shard, creating it if needed"""
+        if shard not in self.shardStates: self.shardStates[shard] = shards.ShardState(shard)
+        return self.shardStates[shard]
+
+    def guildShard(self, guild: Union[discord.Guild, int]) -> int:
+        """Returns the shard of a guild or guild id"""
+        return shards.shardOf(guild if isinstance(guild, int) else guild.id, self.shard_count)
+
+    def isShardReady(self, guild: Optional[discord.Guild]) -> bool:
+        """Returns whether the shard of the guild is ready. Without a guild, returns whether the bot is prepared."""
+        if self.prepared is None or not self.prepared.done(): return False
+        return guild is None or self.getShard(self.guildShard(guild)).ready
 
     def reload(self, module: str, raw: bool=False) -> bool:
         """Reloads and updates a module of the bot. Could be either 'commands', 'events' or 'all'. Returns whether the update was successful. Can be called after bot shutdown."""
@@ -72,46 +169,60 @@ class Deployment(discord.Client):
         elif module.lower() == "messages": 
             x = bool(importlib.reload(messages))
             if x is False: return False
-            a = self.messageHandler.pinsCache
-            b = self.messageHandler.richMessages
+            old = self.messageHandler
             self.messageHandler = messages.MessageHandler(self)
-            self.messageHandler.pinsCache = a
-            self.messageHandler.richMessages = b
+            for x in ("pinsCache", "trackedChannels", "pinTimes", "richMessages"): setattr(self.messageHandler, x, getattr(old, x))
+            self.messageHandler.richMessages.handler = self.messageHandler
             return True
         elif module.lower() == "all":
             importlib.reload(util)
+            importlib.reload(registry)
             self.reload("commands", raw)
             self.reload("events", raw)
             self.reload("messages", raw)
         else: return False
 
     def prepareCommands(self) -> None:
-        """Initializes commands to use in the discord bot. Calling this command again finds new commands that the bot can handle."""
+        """Initializes commands to use in the discord bot. Calling this command again finds new commands that the bot can handle. The previous commands stay in use if the new ones cannot be registered."""
         print("Initializing commands:")
-        self.generalCommandList = set() # type: set[str]
-        self.serverCommandList = set() # type: set[str]
-        self.privilegedCommandList = set() # type: set[str]
-        for x in dir(commands.GeneralCommands):
-            if x.startswith("command_") and len(x) > 8: 
-                self.generalCommandList.add(x)
-                print(" - Found general command: " + x[8:])
-        for x in dir(commands.ServerCommands):
-            if x.startswith("command_") and len(x) > 8: 
-                self.serverCommandList.add(x)
-                print(" - Found server command: " + x[8:])
-        for x in dir(commands.PrivilegedCommands):
-            if x.startswith("command_") and len(x) > 8: 
-                self.privilegedCommandList.add(x)
-                print(" - Found privileged command: " + x[8:])
+        r = registry.CommandRegistry(commands.GeneralCommands, commands.ServerCommands, commands.PrivilegedCommands)
+        for x in r.commands: print(f" - Found {x.scope} command: {x.name}" + (f" ({', '.join(x.aliases)})" if x.aliases else ""))
+        self.commands = r
 
     async def shutdown(self) -> None:
         """Shuts down the bot and writes all necessary objects to disk"""
+        if self.prepared is None: 
+            await self.close()
+            return
+        self.scheduler.stop()
+        self.metrics.stop()
+        self.executor.close()
+        await self.runner.close()
         await self.close()
-        saveJSON(self.dmContexts, "dmcontexts.json")
-        saveJSON(list(admin), "custodians.json")
-        if "settings" not in os.listdir(): os.mkdir("settings")
-        for k,v in context.items(): saveJSON(v.settings, f"settings/{k}.json")
+        await self.persist()
+
+    async def serveHandoff(self, path: str) -> asyncio.AbstractServer:
+        """Waits for a new process of this deployment on a Unix socket, and hands off to it once it connects"""
+        return await handoff.serve(self, path)
+
+    async def stopServing(self) -> None:
+        """Stops handling events and commands, and writes everything to the store, which is closed. Used when handing off to a new process."""
+        self.serving = False
+        self.scheduler.stop()
+        self.metrics.stop()
+        self.executor.close()
+        await self.runner.close()
+        await self.persist()
+
+    async def persist(self) -> None:
+        """Writes all necessary objects to the store and closes it"""
+        # Values that did not change since they were last written are skipped by the store
+        self.saveDMContexts()
+        self.store.put("custodians", list(admin))
+        for v in context.values(): v.saveSettings()
+        self.store.put("invites", self.warmup.save())
         self.messageHandler.save()
+        await asyncio.get_event_loop().run_in_executor(None, self.store.close)
 
     def getContexts(self) -> dict[int, ServerContext]:
         """Returns all server contexts"""
@@ -130,7 +241,7 @@ class Deployment(discord.Client):
     
     def getDMContext(self, user: Any) -> Optional[ServerContext]:
         """Returns a specific server context in a specific user's DM. The given guild may be either Guild, or an id (int or str)."""
-        if isinstance(user, str) or isinstance(user, int): guild = self.get_user(int(str(user)))
+        if isinstance(user, str) or isinstance(user, int): user = self.get_user(int(str(user)))
         if user is None or user.id not in self.dmContexts or self.dmContexts[user.id] is None: return None
         r = self.getContext(self.dmContexts[user.id])
         if not r.isModerator(user): return None
@@ -143,14 +254,68 @@ class Deployment(discord.Client):
         if not isinstance(context, ServerContext): 
             try: context = self.getContext(context)
             except Exception: pass
+        if context is not None and not isinstance(context, ServerContext): return False
         if context is None: 
             if user.id not in self.dmContexts: return False
+            self.unindexDMContext(user.id)
             del self.dmContexts[user.id]
+            self.saveDMContexts()
             return True
         if not context.isModerator(user): return False
+        self.unindexDMContext(user.id)
         self.dmContexts[user.id] = context.guildID
+        self.dmGuildIndex.setdefault(context.guildID, set()).add(user.id)
+        self.saveDMContexts()
         return True
 
+    def saveDMContexts(self) -> None:
+        """Writes the DM contexts to the store, keeping those of guilds whose shard is not ready yet"""
+        r = {str(k): g for g,users in self.pendingDMContexts.items() for k in users}
+        r.update((str(k), v) for k,v in self.dmContexts.items())
+        self.store.put("dmcontexts", r)
+
+    def unindexDMContext(self, userID: int) -> None:
+        """Removes the user from the DM context index of the guild their DMs are set to"""
+        guildID = self.dmContexts.get(userID)
+        if guildID is None or guildID not in self.dmGuildIndex: return
+        self.dmGuildIndex[guildID].discard(userID)
+        if not self.dmGuildIndex[guildID]: del self.dmGuildIndex[guildID]
+
+    def getDMContextUsers(self, guild: Any) -> set[int]:
+        """Returns the ids of the users whose DMs are set to the given guild or guild id"""
+        return self.dmGuildIndex.get(guild.id if isinstance(guild, discord.Guild) else int(str(guild)), set())
+
+    def indexUsers(self) -> None:
+        """Indexes the names of every user that can be seen"""
+        self.userIndex.build([(u.id, (u.name, str(u))) for u in self.users])
+
+    def indexUser(self, user: discord.abc.User) -> None:
+        """Indexes a user by name and by name#discriminator"""
+        self.userIndex.put(user.id, user.name, str(user))
+
+    def indexGuild(self, guild: discord.Guild) -> None:
+        """Indexes the name of the guild and the names of its channels and members"""
+        self.indexGuilds([guild])
+
+    def indexGuilds(self, guilds: List[discord.Guild]) -> None:
+        """Indexes the names of the guilds and of their channels and members, sorting each index once"""
+        self.guildIndex.build([(x.id, (x.name,)) for x in guilds])
+        self.channelIndex.build([(c.id, (c.name,)) for x in guilds for c in x.channels])
+        for x in guilds:
+            if x.id not in self.memberIndexes: self.memberIndexes[x.id] = NameIndex()
+            self.memberIndexes[x.id].build([(m.id, (m.name, str(m), m.nick)) for m in x.members])
+
+    def unindexGuild(self, guild: discord.Guild) -> None:
+        """Removes the guild and its channels from the indexes"""
+        self.guildIndex.remove(guild.id)
+        for c in guild.channels: self.channelIndex.remove(c.id)
+        self.memberIndexes.pop(guild.id, None)
+
+    def indexMember(self, member: discord.Member) -> None:
+        """Indexes a member of a guild by name, name#discriminator and nickname"""
+        if member.guild.id not in self.memberIndexes: self.memberIndexes[member.guild.id] = NameIndex()
+        self.memberIndexes[member.guild.id].put(member.id, member.name, str(member), member.nick)
+
     def resolveGuild(self, guild: Any) -> Optional[discord.Guild]:
         """Returns a guild based on the hint provided by guild. Returns None if it cannot be resolved"""
         if isinstance(guild, discord.Guild): return guild
@@ -168,8 +333,7 @@ class Deployment(discord.Client):
         """Returns a list of guilds based on the hint or name provided by guild. Returns an empty list if it cannot be resolved"""
         x = self.resolveGuild(guild)
         if x is not None: return [x]
-        guild = str(guild).lower()
-        return [g for g in self.guilds if g.name.lower() == guild]
+        return [x for x in (self.get_guild(i) for i in self.guildIndex.get(str(guild))) if x is not None]
 
     def resolveChannel(self, channel: Any) -> Optional[Union[discord.abc.GuildChannel, discord.abc.PrivateChannel]]:
         """Returns a channel based on the hint provided by channel. Returns None if it cannot be resolved"""
@@ -189,8 +353,7 @@ class Deployment(discord.Client):
         """Returns a discord.abc.GuildChannel or discord.abc.PrivateChannel based on the hint or name provided by channel. Returns an empty list if it cannot be resolved"""
         x = self.resolveChannel(channel)
         if x is not None: return [x]
-        channel = str(channel).lower()
-        return [c for g in self.guilds for c in g if c.name.lower() == channel]
+        return [x for x in (self.get_channel(i) for i in self.channelIndex.get(str(channel))) if x is not None]
 
     def resolveUser(self, user: Any) -> Optional[discord.abc.User]:
         """Returns a discord.User based on the hint provided by user. Returns None if it cannot be resolved"""
@@ -206,9 +369,8 @@ class Deployment(discord.Client):
     def resolveUserByName(self, user: Any) -> List[discord.abc.User]:
         """Returns a user based on the hint or name provided by user. Returns an empty list if it cannot be resolved"""
         x = self.resolveUser(user)
-        if x is not None: return x
-        user = str(user).lower()
-        return [u for u in self.get_all_members() if str(u) == user or u.name == user]
+        if x is not None: return [x]
+        return [x for x in (self.get_user(i) for i in self.userIndex.get(str(user))) if x is not None]
 
     def resolveMember(self, user: Any, guild: Any) -> Optional[discord.Member]:
         """Returns a member based on the hint provided by user and guild. Returns None if it cannot be resolved"""
@@ -219,13 +381,15 @@ class Deployment(discord.Client):
 
     async def resolveMemberByName(self, user: Any, guild: Any) -> List[discord.Member]:
         """Returns members based on the hints or names provided by user and guild. Returns an empty list if it cannot be resolved"""
-        guild = self.resolveGuildByName(guild)
+        guild = self.resolveGuild(guild)
+        if guild is None: return []
         x = self.resolveUser(user)
-        user = str(user)
-        if guild is None: return None
-        if x: return guild.get_member(x.id)
-        elif "#" in x: return guild.get_member_named(user)
-        else: return await guild.query_members(query=user)
+        if x is not None: 
+            x = guild.get_member(x.id)
+            return [x] if x is not None else []
+        ids = self.memberIndexes[guild.id].get(str(user)) if guild.id in self.memberIndexes else set()
+        if ids: return [x for x in (guild.get_member(i) for i in ids) if x is not None]
+        return await guild.query_members(query=str(user))
 
     async def resolveMessage(self, message: Any, channel: Any, fetch: bool=False) -> Optional[discord.Message]:
         """Returns a discord.Message based on the id provided by message and the hint provided by channel. Returns None if it cannot be resolved."""
@@ -250,11 +414,13 @@ class Deployment(discord.Client):
         if x is not None: return x
         return None
 
-    async def on_command(self, message: discord.Message) -> None:
-        """Attempt to handle a command from the message."""
+    async def on_command(self, message: discord.Message, context: Optional[ServerContext]=None) -> None:
+        """Attempt to handle a command from the message. The context of the message's guild may be given if it is already known."""
         
-        content = message.content.lstrip(self.user.mention)
-        if message.channel.type != discord.ChannelType.private: content = content.lstrip(self.getContext(message.guild).settings["commandprefix"])
+        if message.channel.type == discord.ChannelType.private: content = self.dmRoute.strip(message.content)
+        else:
+            if context is None: context = self.getContext(message.guild)
+            content = context.getRoute().strip(message.content)
         content = content.strip().split(" ", maxsplit=1)
 
         user = message.author
@@ -263,10 +429,13 @@ class Deployment(discord.Client):
 
         # Attempt to get the specific context, either from the server or a DM
         if message.channel.type == discord.ChannelType.private: currentContext = self.getDMContext(user)
-        else: currentContext = self.getContext(message.guild) 
+        else: currentContext = context
 
-        # Call the command
-        await self.call_command(CommandEvent(self, currentContext, user, message, name, parameters))
+        # Queue the command. Privileged commands skip the rate limits and run before any other queued command. Unknown commands are answered, and rate limited, when they are addressed to the bot.
+        command = self.commands.get(name)
+        privileged = command is not None and command.scope == registry.PRIVILEGED and self.isBotCustodian(user)
+        addressed = message.channel.type == discord.ChannelType.private or context.getRoute().isAddressed(message.content)
+        await self.scheduler.submit(CommandEvent(self, currentContext, user, message, name, parameters), privileged, known=command is not None, addressed=addressed)
         # TODO: if valid command and dm, modlog?
         return
 
@@ -275,82 +444,125 @@ class Deployment(discord.Client):
         if event is None: return
         
         # Helper function, called to run a specific commnad
-        async def call(cls, qualname: str, event: CommandEvent):
-            if triggerTyping: await event.message.channel.trigger_typing()
-            ret = await getattr(cls, qualname)(event)
+        async def call(handler, event: CommandEvent):
+            # Typing is only shown for commands that take longer than the typing delay
+            typing = self.messageHandler.deferTyping(event.message.channel) if triggerTyping else None
+            try: 
+                with self.metrics.track("command:" + command.name): ret = await handler(event)
+            finally: 
+                if typing: typing.cancel()
             if ret is not None: await event.sendResponse(ret, finished=True)
 
-        qualname = "command_" + event.name 
-        # Attempt to run a prvileged command, checking if the user is authorized
-        if self.isBotCustodian(event.message.author) and qualname in self.privilegedCommandList: 
-            await call(commands.PrivilegedCommands, qualname, event)
-            return True
-        # Attempt to run a general command
-        if qualname in self.generalCommandList: 
-            await call(commands.GeneralCommands, qualname, event)
-            return True
+        command = self.commands.get(event.name)
+        isPrivate = event.message.channel.type == discord.ChannelType.private
+        isCustodian = self.isBotCustodian(event.message.author)
+        if command is not None:
+            # Attempt to run a prvileged command, checking if the user is authorized
+            if command.scope == registry.PRIVILEGED and isCustodian:
+                await call(command.handler, event)
+                return True
+            # Attempt to run a general command
+            if command.scope == registry.GENERAL: 
+                await call(command.handler, event)
+                return True
 
         # Running server commands requires context to be set. If it cannot find the context, treat it as an unknown command.
-        if event.context is None and event.message.channel.type == discord.ChannelType.private: 
+        if event.context is None and isPrivate: 
             await event.sendResponse("Unknown command. To send server commands in DMs, use `auth` and specify a server.")
             return False
         elif event.context is None: return False
 
         # Attempt to run a server command
-        if qualname in self.serverCommandList: 
-            await call(commands.ServerCommands, qualname, event)
+        if command is not None and command.scope == registry.SERVER: 
+            await call(command.handler, event)
             return True
 
-        # Unknown command
-        if event.message.channel.type == discord.ChannelType.private: await event.sendResponse("Unknown command. Commands in DMs must not be prefixed.")
+        # Unknown command. Suggest similar commands the user may run, unless the message is chat in a whitelisted channel that was not addressed to the bot.
+        if not isPrivate and not event.context.getRoute().isAddressed(event.message.content): return False
+        suggestions = self.commands.suggest(event.name, lambda x: x.scope != registry.PRIVILEGED or isCustodian)
+        if suggestions: await event.sendResponse(f"Unknown command `{event.name}`. Did you mean {' or '.join(f'`{x}`' for x in suggestions)}?")
+        elif isPrivate: await event.sendResponse("Unknown command. Commands in DMs must not be prefixed.")
         return False
     
+    async def forward(self, name: str, *args) -> Any:
+        """Passes a discord event to events.DiscordEvents, recording how long it took. Events are dropped while the bot is not serving, and held back while it takes over from a previous process."""
+        if name not in PASSIVE_EVENTS:
+            if not self.serving: return
+            if self.takeover is not None and not self.takeover.done(): await asyncio.shield(self.takeover)
+        with self.metrics.track("event:" + name): return await getattr(events.DiscordEvents, name)(self, *args)
+
+    # Pass shard events
+    async def on_shard_connect(self, shard_id): return await self.forward("on_shard_connect", shard_id)
+    async def on_shard_disconnect(self, shard_id): return await self.forward("on_shard_disconnect", shard_id)
+    async def on_shard_ready(self, shard_id): return await self.forward("on_shard_ready", shard_id)
+    async def on_shard_resumed(self, shard_id): return await self.forward("on_shard_resumed", shard_id)
+
     # Pass relevant discord events
-    async def on_typing(self, channel, user, when): return await events.DiscordEvents.on_typing(self, channel, user, when)
-    async def on_message(self, message): return await events.DiscordEvents.on_message(self, message)
-    async def on_message_delete(self, message): return await events.DiscordEvents.on_message_delete(self, message)
-    async def on_bulk_message_delete(self, messages): return await events.DiscordEvents.on_bulk_message_delete(self, messages)
-    async def on_raw_message_delete(self, payload): return await events.DiscordEvents.on_raw_message_delete(self, payload)
-    async def on_raw_bulk_message_delete(self, payload): return await events.DiscordEvents.on_raw_bulk_message_delete(self, payload)
-    async def on_message_edit(self, before, after): return await events.DiscordEvents.on_message_edit(self, before, after)
-    async def on_raw_message_edit(self, payload): return await events.DiscordEvents.on_raw_message_edit(self, payload)
-    async def on_reaction_add(self, reaction, user): return await events.DiscordEvents.on_reaction_add(self, reaction, user)
-    async def on_raw_reaction_add(self, payload): return await events.DiscordEvents.on_raw_reaction_add(self, payload)
-    async def on_reaction_remove(self, reaction, user): return await events.DiscordEvents.on_reaction_remove(self, reaction, user)
-    async def on_raw_reaction_remove(self, payload): return await events.DiscordEvents.on_raw_reaction_remove(self, payload)
-    async def on_reaction_clear(self, message, reactions): return await events.DiscordEvents.on_reaction_clear(self, message, reactions)
-    async def on_raw_reaction_clear(self, payload): return await events.DiscordEvents.on_raw_reaction_clear(self, payload)
-    async def on_reaction_clear_emoji(self, reaction): return await events.DiscordEvents.on_reaction_clear_emoji(self, reaction)
-    async def on_raw_reaction_clear_emoji(self, payload): return await events.DiscordEvents.on_raw_reaction_clear_emoji(self, payload)
-    async def on_private_channel_delete(self, channel): return await events.DiscordEvents.on_private_channel_delete(self, channel)
-    async def on_private_channel_create(self, channel): return await events.DiscordEvents.on_private_channel_create(self, channel)
-    async def on_private_channel_update(self, before, after): return await events.DiscordEvents.on_private_channel_update(self, before, after)
-    async def on_private_channel_pins_update(self, channel, last_pin): return await events.DiscordEvents.on_private_channel_pins_update(self, channel, last_pin)
-    async def on_guild_channel_delete(self, channel): return await events.DiscordEvents.on_guild_channel_delete(self, channel)
-    async def on_guild_channel_create(self, channel): return await events.DiscordEvents.on_guild_channel_create(self, channel)
-    async def on_guild_channel_update(self, before, after): return await events.DiscordEvents.on_guild_channel_update(self, before, after)
-    async def on_guild_channel_pins_update(self, channel, last_pin): return await events.DiscordEvents.on_guild_channel_pins_update(self, channel, last_pin)
-    async def on_guild_integrations_update(self, guild): return await events.DiscordEvents.on_guild_integrations_update(self, guild)
-    async def on_webhooks_update(self, channel): return await events.DiscordEvents.on_webhooks_update(self, channel)
-    async def on_member_join(self, member): return await events.DiscordEvents.on_member_join(self, member)
-    async def on_member_remove(self, member): return await events.DiscordEvents.on_member_remove(self, member)
-    async def on_member_update(self, before, after): return await events.DiscordEvents.on_member_update(self, before, after)
-    async def on_user_update(self, before, after): return await events.DiscordEvents.on_user_update(self, before, after)
-    async def on_guild_join(self, guild): return await events.DiscordEvents.on_guild_join(self, guild)
-    async def on_guild_remove(self, guild): return await events.DiscordEvents.on_guild_remove(self, guild)
-    async def on_guild_update(self, before, after): return await events.DiscordEvents.on_guild_update(self, before, after)
-    async def on_guild_role_create(self, role): return await events.DiscordEvents.on_guild_role_create(self, role)
-    async def on_guild_role_delete(self, role): return await events.DiscordEvents.on_guild_role_delete(self, role)
-    async def on_guild_role_update(self, before, after): return await events.DiscordEvents.on_guild_role_update(self, before, after)
-    async def on_guild_emojis_update(self, guild, before, after): return await events.DiscordEvents.on_guild_emojis_update(self, guild, before, after)
-    async def on_guild_available(self, guild): return await events.DiscordEvents.on_guild_available(self, guild)
-    async def on_guild_unavailable(self, guild): return await events.DiscordEvents.on_guild_unavailable(self, guild)
-    async def on_voice_state_update(self, member, before, after): return await events.DiscordEvents.on_voice_state_update(self, member, before, after)
-    async def on_member_ban(self, guild, user): return await events.DiscordEvents.on_member_ban(self, guild, user)
-    async def on_member_unban(self, guild, user): return await events.DiscordEvents.on_member_unban(self, guild, user)
-    async def on_invite_create(self, invite): return await events.DiscordEvents.on_invite_create(self, invite)
-    async def on_invite_delete(self, invite): return await events.DiscordEvents.on_invite_delete(self, invite)
+    async def on_socket_response(self, msg): return await self.forward("on_socket_response", msg)
+    async def on_typing(self, channel, user, when): return await self.forward("on_typing", channel, user, when)
+    async def on_message(self, message): return await self.forward("on_message", message)
+    async def on_message_delete(self, message): return await self.forward("on_message_delete", message)
+    async def on_bulk_message_delete(self, messages): return await self.forward("on_bulk_message_delete", messages)
+    async def on_raw_message_delete(self, payload): return await self.forward("on_raw_message_delete", payload)
+    async def on_raw_bulk_message_delete(self, payload): return await self.forward("on_raw_bulk_message_delete", payload)
+    async def on_message_edit(self, before, after): return await self.forward("on_message_edit", before, after)
+    async def on_raw_message_edit(self, payload): return await self.forward("on_raw_message_edit", payload)
+    async def on_reaction_add(self, reaction, user): return await self.forward("on_reaction_add", reaction, user)
+    async def on_raw_reaction_add(self, payload): return await self.forward("on_raw_reaction_add", payload)
+    async def on_reaction_remove(self, reaction, user): return await self.forward("on_reaction_remove", reaction, user)
+    async def on_raw_reaction_remove(self, payload): return await self.forward("on_raw_reaction_remove", payload)
+    async def on_reaction_clear(self, message, reactions): return await self.forward("on_reaction_clear", message, reactions)
+    async def on_raw_reaction_clear(self, payload): return await self.forward("on_raw_reaction_clear", payload)
+    async def on_reaction_clear_emoji(self, reaction): return await self.forward("on_reaction_clear_emoji", reaction)
+    async def on_raw_reaction_clear_emoji(self, payload): return await self.forward("on_raw_reaction_clear_emoji", payload)
+    async def on_private_channel_delete(self, channel): return await self.forward("on_private_channel_delete", channel)
+    async def on_private_channel_create(self, channel): return await self.forward("on_private_channel_create", channel)
+    async def on_private_channel_update(self, before, after): return await self.forward("on_private_channel_update", before, after)
+    async def on_private_channel_pins_update(self, channel, last_pin): return await self.forward("on_private_channel_pins_update", channel, last_pin)
+    async def on_guild_channel_delete(self, channel): return await self.forward("on_guild_channel_delete", channel)
+    async def on_guild_channel_create(self, channel): return await self.forward("on_guild_channel_create", channel)
+    async def on_guild_channel_update(self, before, after): return await self.forward("on_guild_channel_update", before, after)
+    async def on_guild_channel_pins_update(self, channel, last_pin): return await self.forward("on_guild_channel_pins_update", channel, last_pin)
+    async def on_guild_integrations_update(self, guild): return await self.forward("on_guild_integrations_update", guild)
+    async def on_webhooks_update(self, channel): return await self.forward("on_webhooks_update", channel)
+    async def on_member_join(self, member): return await self.forward("on_member_join", member)
+    async def on_member_remove(self, member): return await self.forward("on_member_remove", member)
+    async def on_member_update(self, before, after): return await self.forward("on_member_update", before, after)
+    async def on_user_update(self, before, after): return await self.forward("on_user_update", before, after)
+    async def on_guild_join(self, guild): return await self.forward("on_guild_join", guild)
+    async def on_guild_remove(self, guild): return await self.forward("on_guild_remove", guild)
+    async def on_guild_update(self, before, after): return await self.forward("on_guild_update", before, after)
+    async def on_guild_role_create(self, role): return await self.forward("on_guild_role_create", role)
+    async def on_guild_role_delete(self, role): return await self.forward("on_guild_role_delete", role)
+    async def on_guild_role_update(self, before, after): return await self.forward("on_guild_role_update", before, after)
+    async def on_guild_emojis_update(self, guild, before, after): return await self.forward("on_guild_emojis_update", guild, before, after)
+    async def on_guild_available(self, guild): return await self.forward("on_guild_available", guild)
+    async def on_guild_unavailable(self, guild): return await self.forward("on_guild_unavailable", guild)
+    async def on_voice_state_update(self, member, before, after): return await self.forward("on_voice_state_update", member, before, after)
+    async def on_member_ban(self, guild, user): return await self.forward("on_member_ban", guild, user)
+    async def on_member_unban(self, guild, user): return await self.forward("on_member_unban", guild, user)
+    async def on_invite_create(self, invite): return await self.forward("on_invite_create", invite)
+    async def on_invite_delete(self, invite): return await self.forward("on_invite_delete", invite)
+
+class ShardedDeployment(Deployment, discord.AutoShardedClient):
+    """A deployment that runs several gateway shards. Each shard's guilds serve commands as soon as that shard is ready, and per-shard event counts and latencies are tracked."""
+    def __init__(self, manager, token: str):
+        super().__init__(manager, token, shard_count=shardCount)
+
+    async def on_ready(self) -> None:
+        """Discord event. Dispatched once every shard is ready, which each shard already handled"""
+        await self.prepare()
+        self.prepareGuilds(self.guilds)
+
+    async def forward(self, name: str, *args) -> Any:
+        """Passes a discord event to events.DiscordEvents, counting it towards the shard of the guild it belongs to"""
+        for x in args:
+            guild = x if isinstance(x, discord.Guild) else getattr(x, "guild", None)
+            if isinstance(guild, discord.Guild):
+                self.getShard(self.guildShard(guild)).recordEvent()
+                break
+        return await super().forward(name, *args)
 
 if __name__ == "__main__":
-    bot = Deployment(None, "token")
+    bot = (ShardedDeployment if shardCount else Deployment)(None, "token")
     bot.deploy()
\ No newline at end of file
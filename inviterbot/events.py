@@ -1,4 +1,6 @@
+import asyncio
 import discord
+import time
 
 # from . import util, static
 # from .util import *
@@ -12,89 +14,149 @@ class DiscordEvents:
 
     # The following events are not passed on to this class, and instead should be handled by the bot class
     async def on_connect(bot): pass
-    async def on_shard_connect(bot, shard_id): pass
     async def on_disconnect(bot): pass
-    async def on_shard_disconnect(bot, shard_id): pass
     async def on_ready(bot): pass
-    async def on_shard_ready(bot, shard_id): pass
     async def on_resumed(bot): pass
-    async def on_shard_resumed(bot, shard_id): pass
     async def on_error(bot, event, *args, **kwargs): pass    
 
     # Events that are passed to this class
+    async def on_shard_connect(bot, shard_id: int):
+        """Discord event. Records that a shard connected to the gateway"""
+        bot.getShard(shard_id).connects += 1
+
+    async def on_shard_disconnect(bot, shard_id: int):
+        """Discord event. Stops serving the guilds of the shard until it is ready or resumed again"""
+        bot.getShard(shard_id).ready = False
+
+    async def on_shard_ready(bot, shard_id: int):
+        """Discord event. Prepares the bot if this is the first shard, then the guilds of the shard, which start serving commands without waiting for the other shards"""
+        first = await bot.prepare()
+        guilds = [x for x in bot.guilds if x.shard_id == shard_id]
+        fresh = {x.id for x in guilds if x.id not in bot.guildIDs}
+        bot.prepareGuilds(guilds)
+        # The first shard synced pins while preparing. Later shards only sync the channels of their new guilds.
+        if not first and fresh: asyncio.ensure_future(bot.messageHandler.syncPins(fresh))
+        s = bot.getShard(shard_id)
+        s.ready = True
+        s.readyAt = time.time()
+        print(f"Shard {shard_id} is ready with {len(guilds)} guild(s)")
+
+    async def on_shard_resumed(bot, shard_id: int):
+        """Discord event. Resumes serving the guilds of the shard"""
+        s = bot.getShard(shard_id)
+        s.resumes += 1
+        s.ready = True
+
+    async def on_socket_response(bot, msg: dict):
+        """Discord event. Records the last pin timestamp of channels from raw gateway payloads, which the library does not keep on channel objects"""
+        t = msg.get("t")
+        if t == "GUILD_CREATE": 
+            for c in msg["d"].get("channels", []): bot.lastPinTimestamps[int(c["id"])] = c.get("last_pin_timestamp")
+        elif t == "READY": 
+            for c in msg["d"].get("private_channels", []): bot.lastPinTimestamps[int(c["id"])] = c.get("last_pin_timestamp")
+        elif t == "CHANNEL_CREATE" or t == "CHANNEL_UPDATE": bot.lastPinTimestamps[int(msg["d"]["id"])] = msg["d"].get("last_pin_timestamp")
+        elif t == "CHANNEL_PINS_UPDATE": bot.lastPinTimestamps[int(msg["d"]["channel_id"])] = msg["d"].get("last_pin_timestamp")
+
     async def on_message(bot, message: discord.Message):
         """Discord event. Checks if the given message is a valid command to respond to."""
 
+        # Messages of shards that are still starting up are ignored
+        if not bot.isShardReady(message.guild): return
+
         # First, notify the message handler of the message
         await bot.messageHandler.onMessage(message)
 
-        handleCommand = False
         if message.author == bot.user or message.type != discord.MessageType.default:
             return
 
-        # If the message was sent through a DM, always attempt to handle the command
-        if message.channel.type == discord.ChannelType.private: 
-            handleCommand = True
-
-        # Check the server context rules to see if the bot should handle the command
-        if handleCommand is False and message.channel.id in bot.getContext(message.guild).settings['channellist']: handleCommand = bot.getContext(message.guild).settings['channellistiswhitelist']
-        elif handleCommand is False and (message.content.startswith(bot.user.mention) or message.content.startswith(bot.getContext(message.guild).settings['commandprefix'])): handleCommand = True
+        # If the message was sent through a DM, always attempt to handle the command. Otherwise, check the server context rules.
+        context = None
+        if message.channel.type != discord.ChannelType.private: 
+            context = bot.getContext(message.guild)
+            if not context.getRoute().accepts(message): return
 
-        # If applicable, send the command to the command handler
-        if not handleCommand: return
-        await bot.on_command(message)
+        # Send the command to the command handler
+        await bot.on_command(message, context)
 
     async def on_guild_join(bot, guild: discord.Guild):
         """Discord event. Creates a context for the given guild"""
         bot.guildIDs.add(guild.id)
-        await bot.getContext(guild).update(guild)
+        bot.indexGuild(guild)
+        await bot.warmup.ensure(guild)
 
     async def on_guild_leave(bot, guild: discord.Guild): 
         """Discord event. Removes the guild from the list to handle from and removes any contexts that exists in DM."""
         bot.guildIDs.discard(guild.id)
-        for k,v in bot.getDMContexts:
-            if v.guildID == guild.id:
-                bot.resolveChannel(k).send(f"I have left the server `{guild.name}`. You are no longer able to send server commands there.")
-                bot.setDMContext(k, None)
+        bot.unindexGuild(guild)
+        users = list(bot.getDMContextUsers(guild))
+        for k in users: bot.setDMContext(k, None)
+        await asyncio.gather(*[DiscordEvents.notifyUser(bot, k, f"I have left the server `{guild.name}`. You are no longer able to send server commands there.") for k in users], return_exceptions=True)
+
+    async def on_guild_remove(bot, guild: discord.Guild): await DiscordEvents.on_guild_leave(bot, guild)
 
     async def on_invite_create(bot, invite: discord.Invite):
         """Discord event. Used to track who invited whom"""
-        bot.getContext(invite.guild).inviteCache[invite.code] = 0
+        bot.getContext(invite.guild).cacheInvite(invite)
 
     async def on_invite_delete(bot, invite: discord.Invite):
-        """Discord event. Used to track who invited whom"""
-        del bot.getContext(invite.guild).inviteCache[invite.code]
+        """Discord event. Used to track who invited whom. The invite stays cached until the next fetch, since it may have been deleted by reaching its maximum uses."""
+        pass
 
     async def on_member_join(bot, member: discord.Member):
         """Discord event. Uses cached invites to check who the user was invited by"""
+        bot.indexMember(member)
+        bot.indexUser(member)
+        await bot.warmup.ensure(member.guild)
         channel = bot.getContext(member.guild.id).settings["invitedlog"]
-        newinvites = await member.guild.invites()
-        for x in newinvites: 
-            if x.uses > bot.getContext(member.guild).inviteCache[x.code]:
-                usedinvite = x
-                bot.getContext(member.guild).inviteCache[x.code] = x.uses
+        invite = await bot.invites.attribute(member)
         if channel is None: return
-        await member.guild.get_channel(channel).send(f"Welcome {member.mention}, invited using <{usedinvite.url}> by {usedinvite.inviter.mention}")
+        await bot.messageHandler.sendMessage(f"Welcome {member.mention}, invited using {invite.describe()}", member.guild.get_channel(channel))
 
     async def on_member_update(bot, before: discord.Member, after: discord.Member): 
-        if after.id in bot.dmContexts:
-            if bot.getDMContext(after) is None:
-                bot.resolveChannel(after).send(f"You no longer have permission to send server commands to `{after.guild.name}`")
-                bot.setDMContext(after, None)
-
-    async def on_guild_role_update(bot, before: discord.Guild, after: discord.Guild): 
-        for x in after.members:
-            await DiscordEvents.on_member_update(bot, x, x)
+        if before.nick != after.nick: bot.indexMember(after)
+        if after.id in bot.getDMContextUsers(after.guild) and await DiscordEvents.recheckDMContext(bot, after): 
+            await DiscordEvents.notifyUser(bot, after.id, f"You no longer have permission to send server commands to `{after.guild.name}`")
+
+    async def on_guild_role_update(bot, before: discord.Role, after: discord.Role): 
+        """Discord event. Rechecks the users whose DMs are set to the guild, if the permissions that make a moderator changed"""
+        if not moderatorPermissionsChanged(before.permissions, after.permissions): return
+        revoked = [m for m in (after.guild.get_member(x) for x in list(bot.getDMContextUsers(after.guild))) if m is not None and await DiscordEvents.recheckDMContext(bot, m)]
+        await asyncio.gather(*[DiscordEvents.notifyUser(bot, m.id, f"You no longer have permission to send server commands to `{after.guild.name}`") for m in revoked], return_exceptions=True)
+
+    async def recheckDMContext(bot, member: discord.Member) -> bool:
+        """Removes the DM context of the member if they are no longer a moderator of its guild. Returns whether it was removed."""
+        if bot.getDMContext(member) is not None: return False
+        bot.setDMContext(member, None)
+        return True
+
+    async def notifyUser(bot, userID: int, text: str):
+        """Sends a message to a user's DMs, opening them if needed"""
+        user = bot.resolveUser(userID)
+        if user is None: return
+        await bot.messageHandler.sendMessage(text, user.dm_channel or await user.create_dm())
+
+    # Events that only keep the name indexes current
+    async def on_guild_channel_create(bot, channel: discord.abc.GuildChannel): bot.channelIndex.put(channel.id, channel.name)
+    async def on_guild_channel_delete(bot, channel: discord.abc.GuildChannel): bot.channelIndex.remove(channel.id)
+    async def on_guild_channel_update(bot, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel): bot.channelIndex.put(after.id, after.name)
+    async def on_guild_update(bot, before: discord.Guild, after: discord.Guild): bot.guildIndex.put(after.id, after.name)
+    async def on_member_remove(bot, member: discord.Member): 
+        if member.guild.id in bot.memberIndexes: bot.memberIndexes[member.guild.id].remove(member.id)
+    async def on_user_update(bot, before: discord.User, after: discord.User): 
+        bot.indexUser(after)
+        for g in after.mutual_guilds: 
+            m = g.get_member(after.id)
+            if m is not None: bot.indexMember(m)
 
     # Events that only notify the message handler
-    async def on_raw_message_delete(bot, payload: discord.RawMessageDeleteEvent): bot.messageHandler.onMessageDelete(payload)
-    async def on_raw_bulk_message_delete(bot, payload: discord.RawBulkMessageDeleteEvent): bot.messageHandler.onMessageDelete(payload)
-    async def on_raw_reaction_add(bot, payload: discord.RawReactionActionEvent): bot.messageHandler.onReactionActionEvent(payload)
-    async def on_raw_reaction_remove(bot, payload: discord.RawReactionActionEvent): bot.messageHandler.onReactionActionEvent(payload)
-    async def on_raw_reaction_clear(bot, payload: discord.RawReactionClearEvent): bot.messageHandler.onReactionClearEmojiEvent(payload)
-    async def on_raw_reaction_clear_emoji(bot, payload: discord.RawReactionClearEmojiEvent): bot.messageHandler.onReactionClearEvent(payload)
-    async def on_private_channel_pins_update(bot, channel: discord.abc.PrivateChannel, last_pin: Optional[datetime.datetime]): await bot.messageHandler.onPinsUpdate(channel)
-    async def on_guild_channel_pins_update(bot, channel: discord.abc.GuildChannel, last_pin: Optional[datetime.datetime]): await bot.messageHandler.onPinsUpdate(channel)
+    async def on_raw_message_delete(bot, payload: discord.RawMessageDeleteEvent): await bot.messageHandler.onMessageDelete(payload)
+    async def on_raw_bulk_message_delete(bot, payload: discord.RawBulkMessageDeleteEvent): await bot.messageHandler.onMessageDelete(payload)
+    async def on_raw_reaction_add(bot, payload: discord.RawReactionActionEvent): await bot.messageHandler.onReactionActionEvent(payload)
+    async def on_raw_reaction_remove(bot, payload: discord.RawReactionActionEvent): await bot.messageHandler.onReactionActionEvent(payload)
+    async def on_raw_reaction_clear(bot, payload: discord.RawReactionClearEvent): await bot.messageHandler.onReactionClearEmojiEvent(payload)
+    async def on_raw_reaction_clear_emoji(bot, payload: discord.RawReactionClearEmojiEvent): await bot.messageHandler.onReactionClearEvent(payload)
+    async def on_private_channel_pins_update(bot, channel: discord.abc.PrivateChannel, last_pin: Optional[datetime.datetime]): await bot.messageHandler.onPinsUpdate(channel, last_pin)
+    async def on_guild_channel_pins_update(bot, channel: discord.abc.GuildChannel, last_pin: Optional[datetime.datetime]): await bot.messageHandler.onPinsUpdate(channel, last_pin)
 
     # Events that are generally passed to this class but are not implemented
     async def on_typing(bot, channel, user, when): pass
@@ -109,14 +171,8 @@ class DiscordEvents:
     async def on_private_channel_delete(bot, channel): pass
     async def on_private_channel_create(bot, channel): pass
     async def on_private_channel_update(bot, before, after): pass
-    async def on_guild_channel_delete(bot, channel): pass
-    async def on_guild_channel_create(bot, channel): pass
-    async def on_guild_channel_update(bot, before, after): pass
     async def on_guild_integrations_update(bot, guild): pass
     async def on_webhooks_update(bot, channel): pass
-    async def on_member_remove(bot, member): pass
-    async def on_user_update(bot, before, after): pass
-    async def on_guild_update(bot, before, after): pass
     async def on_guild_role_create(bot, role): pass
     async def on_guild_role_delete(bot, role): pass
     async def on_guild_emojis_update(bot, guild, before, after): pass
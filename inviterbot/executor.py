@@ -0,0 +1,191 @@
+import ast
+import asyncio
+import collections
+import contextlib
+import functools
+import importlib
+import inspect
+import io
+import pickle
+import struct
+import sys
+import traceback
+import types
+
+from typing import Any, Iterable, Optional
+
+# Names of the execute command that refer to live bot objects. Statements that use them, or names assigned from them, run on the event loop.
+LIVE_NAMES = frozenset(("event", "bot", "me", "user", "message", "channel", "guild", "context", "discord"))
+
+# Frames between the executor and its workers are a length followed by a pickle
+FRAME = struct.Struct("!I")
+
+class Statement:
+    """A compiled statement of the execute command. Expressions and assignments to a single name have a value, anything else is executed for its side effects."""
+    __slots__ = ("source", "body", "target", "expression", "imports", "code", "names", "awaits")
+
+    def __init__(self, source: str):
+        """Parses and compiles the statement. Raises SyntaxError if it is invalid."""
+        self.source = source
+        tree = ast.parse(source, mode="exec")
+        node = tree.body[0] if len(tree.body) == 1 else None
+        self.body = source
+        self.target = None # type: Optional[str]
+        self.expression = isinstance(node, ast.Expr)
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            self.expression = True
+            self.target = node.targets[0].id
+            self.body = ast.get_source_segment(source, node.value)
+        # Imports are cheap and bind modules, which cannot be sent back from a worker
+        self.imports = any(isinstance(x, (ast.Import, ast.ImportFrom)) for x in tree.body)
+        self.code = compile(self.body, "<execute>", "eval" if self.expression else "exec", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+        self.names = frozenset(globalNames(self.code))
+        self.awaits = bool(self.code.co_flags & inspect.CO_COROUTINE)
+
+def globalNames(code: types.CodeType) -> Iterable[str]:
+    """Yields every name a code object and the functions and comprehensions inside it may look up"""
+    yield from code.co_names
+    for x in code.co_consts:
+        if isinstance(x, types.CodeType): yield from globalNames(x)
+
+class WorkerError(Exception):
+    """Raised when a statement failed in a worker. The message is the formatted traceback."""
+
+class Worker:
+    """A subprocess that runs statements. It is killed when a statement runs too long."""
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    async def call(self, request: bytes) -> tuple:
+        self.process.stdin.write(FRAME.pack(len(request)) + request)
+        await self.process.stdin.drain()
+        length, = FRAME.unpack(await self.process.stdout.readexactly(FRAME.size))
+        return pickle.loads(await self.process.stdout.readexactly(length))
+
+    def kill(self) -> None:
+        if self.process.returncode is None: self.process.kill()
+
+class StatementExecutor:
+    """Runs the statements of the execute command. Statements that need live bot objects or await run on the event loop. Everything else runs in a pool of worker processes with a wall-clock timeout, so CPU-bound statements cannot stall the gateway, and a worker that times out or is cancelled is killed. Statements are compiled once per source text."""
+    def __init__(self, workers: int=2, timeout: float=10.0, cacheSize: int=256):
+        self.timeout = timeout
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict() # type: collections.OrderedDict[str, Statement]
+        self.slots = asyncio.Semaphore(workers)
+        self.idle = [] # type: list[Worker]
+        self.stats = {"loop": 0, "worker": 0, "timeouts": 0, "cached": 0, "compiled": 0}
+
+    def compile(self, source: str) -> Statement:
+        """Returns the compiled statement of the source text, compiling it if it is not cached. Raises SyntaxError if it is invalid."""
+        s = self.cache.get(source)
+        if s is not None:
+            self.cache.move_to_end(source)
+            self.stats["cached"] += 1
+            return s
+        s = self.cache[source] = Statement(source)
+        self.stats["compiled"] += 1
+        if len(self.cache) > self.cacheSize: self.cache.popitem(last=False)
+        return s
+
+    def request(self, statement: Statement, namespace: dict[str, Any], live: set[str]) -> Optional[bytes]:
+        """Returns the request that runs the statement in a worker, or None if it must run on the event loop"""
+        if statement.awaits or statement.imports or statement.names & live: return None
+        values, modules = {}, {}
+        for k in statement.names:
+            if k not in namespace or k.startswith("__"): continue
+            # Modules are imported again by the worker
+            if isinstance(namespace[k], types.ModuleType): modules[k] = namespace[k].__name__
+            else: values[k] = namespace[k]
+        try: return pickle.dumps((statement.body, statement.expression, statement.target, values, modules))
+        except Exception: return None
+
+    async def run(self, statement: Statement, namespace: dict[str, Any], live: set[str]) -> tuple[str, str, str]:
+        """Runs a statement in the namespace and returns the text of its value, the name of its type and anything it printed. Statements run in a worker get copies of the names they use, which replace the originals afterwards so changes made in place are kept. Names assigned on the event loop are added to live, as they may refer to live objects. Raises WorkerError if the statement failed in a worker, and asyncio.TimeoutError if it took too long."""
+        request = self.request(statement, namespace, live)
+        if request is None:
+            self.stats["loop"] += 1
+            before = dict(namespace)
+            output = io.StringIO()
+            # Redirecting stdout would also capture what other tasks print while the statement awaits, so the statement gets its own print unless it defined one
+            injected = "print" not in namespace
+            if injected: namespace["print"] = functools.partial(print, file=output)
+            try:
+                result = eval(statement.code, namespace)
+                if inspect.isawaitable(result): result = await asyncio.wait_for(result, self.timeout)
+            finally:
+                if injected and isinstance(namespace.get("print"), functools.partial): del namespace["print"]
+            if statement.target is not None: namespace[statement.target] = result
+            # Modules are not live, as workers import them again
+            live.update(k for k,v in namespace.items() if before.get(k, live) is not v and not isinstance(v, types.ModuleType) and not k.startswith("__"))
+            return str(result), type(result).__name__, output.getvalue()
+        self.stats["worker"] += 1
+        status, values, text, typeName, output = await self.call(request)
+        if status == "error": raise WorkerError(text)
+        for k,v in values.items():
+            # Instances of classes defined by a statement only exist in the worker
+            try: namespace[k] = pickle.loads(v)
+            except Exception: namespace.pop(k, None)
+        return text, typeName, output
+
+    async def call(self, request: bytes) -> tuple:
+        await self.slots.acquire()
+        worker = None
+        healthy = False
+        try:
+            worker = self.idle.pop() if self.idle else await self.spawn()
+            result = await asyncio.wait_for(worker.call(request), self.timeout)
+            healthy = True
+            return result
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        finally:
+            if healthy: self.idle.append(worker)
+            elif worker is not None: worker.kill()
+            self.slots.release()
+
+    async def spawn(self) -> Worker:
+        process = await asyncio.create_subprocess_exec(sys.executable, __file__, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        return Worker(process)
+
+    def close(self) -> None:
+        """Kills the idle workers. Workers that are running a statement are killed when it finishes."""
+        for x in self.idle: x.kill()
+        self.idle = []
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the executor"""
+        s = self.stats
+        return f"{s['loop']} on the loop, {s['worker']} in workers ({s['timeouts']} timed out), {s['compiled']} compiled, {s['cached']} cached"
+
+def serve() -> None:
+    """Body of a worker process. Reads statements from stdin and writes the results to stdout until stdin closes."""
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    cache = collections.OrderedDict() # type: collections.OrderedDict[tuple[str, bool], types.CodeType]
+    while True:
+        header = stdin.read(FRAME.size)
+        if len(header) < FRAME.size: return
+        body, expression, target, namespace, modules = pickle.loads(stdin.read(FRAME.unpack(header)[0]))
+        output = io.StringIO()
+        try:
+            code = cache.get((body, expression))
+            if code is None:
+                code = cache[(body, expression)] = compile(body, "<execute>", "eval" if expression else "exec")
+                if len(cache) > 256: cache.popitem(last=False)
+            for k,v in modules.items(): namespace[k] = importlib.import_module(v)
+            with contextlib.redirect_stdout(output): result = eval(code, namespace)
+            if target is not None: namespace[target] = result
+            # Names the statement bound or was sent are sent back if they can be pickled, as the statement may have changed them in place
+            values = {}
+            for k,v in namespace.items():
+                if k.startswith("__") or isinstance(v, types.ModuleType): continue
+                try: values[k] = pickle.dumps(v)
+                except Exception: pass
+            response = ("ok", values, str(result), type(result).__name__, output.getvalue())
+        except BaseException:
+            response = ("error", {}, traceback.format_exc(), None, output.getvalue())
+        data = pickle.dumps(response)
+        stdout.write(FRAME.pack(len(data)) + data)
+        stdout.flush()
+
+if __name__ == "__main__": serve()
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import struct
+import time
+import traceback
+import zlib
+
+import discord
+
+from typing import Any
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+import messages
+from static import *
+from util import *
+
+# A snapshot is sent as a header followed by zlib compressed JSON. The version in the header is the version of the snapshot layout.
+MAGIC = b"IVHS"
+HEADER = struct.Struct("!4sHQ") # Magic, version, length of the payload
+VERSION = 1
+
+# Functions that upgrade a snapshot of the given version to the next version, so a new process can reuse the snapshot of an older one.
+# Readers ignore sections they do not know and treat missing sections as absent, so only changes to existing sections need a migration. Version 1 is the first layout, so there are none yet.
+MIGRATIONS = {} # type: dict[int, Any]
+
+class HandoffError(Exception):
+    """Raised when a snapshot could not be received or read after the previous process stopped serving"""
+
+def capture(bot) -> dict[str, Any]:
+    """Returns the state of the bot that is expensive to rebuild after a restart. Must be called from the event loop."""
+    contexts = {}
+    for k,v in bot.getContexts().items():
+        contexts[str(k)] = {
+            "inviteCache": dict(v.inviteCache),
+            "inviteInfo": {code: list(x) for code,x in v.inviteInfo.items()},
+            "unclaimedInvites": [list(x) for x in v.unclaimedInvites],
+            "warmed": v.warmed,
+        }
+    h = bot.messageHandler
+    richMessages = []
+    for id, m in h.richMessages.items():
+        # Messages without an event handler have no behaviour to restore
+        if m.eventHandler is None: continue
+        x = {"id": id, "eventHandler": m.eventHandler, "channel": m.channel, "data": m.data, "expires": m.expires}
+        if not isinstance(m, messages.RichMessageSkeleton) or m.loaded:
+            x["content"] = m.content
+            x["embed"] = m.embed.to_dict() if m.embed is not None else None
+        richMessages.append(x)
+    return {
+        "createdAt": time.time(),
+        "contexts": contexts,
+        "dmContexts": {str(k): v for k,v in bot.dmContexts.items()},
+        "pins": {str(k): v.tolist() for k,v in h.pinsCache.items()},
+        "trackedChannels": list(h.trackedChannels),
+        "pinTimes": {str(k): v.isoformat() if v is not None else None for k,v in h.pinTimes.items()},
+        "richMessages": richMessages,
+    }
+
+def encode(snapshot: dict[str, Any]) -> bytes:
+    payload = zlib.compress(json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+    return HEADER.pack(MAGIC, VERSION, len(payload)) + payload
+
+def decode(version: int, payload: bytes) -> dict[str, Any]:
+    """Returns the snapshot in the payload, upgraded to the current version. Raises HandoffError if it is newer than this code understands."""
+    if version > VERSION: raise HandoffError(f"Snapshot version {version} is newer than the supported version {VERSION}")
+    snapshot = json.loads(zlib.decompress(payload).decode("utf-8"))
+    while version < VERSION:
+        snapshot = MIGRATIONS[version](snapshot)
+        version += 1
+    return snapshot
+
+def restoreContext(c: ServerContext, state: dict[str, Any]) -> None:
+    """Restores the invite state of a context from a snapshot. Warmed contexts are not fetched again."""
+    c.inviteCache.clear()
+    c.inviteCache.update(state.get("inviteCache", {}))
+    c.inviteInfo = {k: tuple(v) for k,v in state.get("inviteInfo", {}).items()}
+    c.unclaimedInvites = [tuple(x) for x in state.get("unclaimedInvites", [])]
+    c.warmed = state.get("warmed", False)
+    c.seeded = True
+
+def restoreMessages(h, snapshot: dict[str, Any]) -> bool:
+    """Restores the pins and rich messages of a message handler from a snapshot. Returns whether the pins were restored, in which case they need no sync."""
+    for x in snapshot.get("richMessages", []):
+        m = messages.RichMessageSkeleton(h, x["id"], x["eventHandler"], x["channel"], x["data"], x.get("expires"))
+        if "content" in x:
+            m.content = x["content"]
+            m.embed = discord.Embed.from_dict(x["embed"]) if x["embed"] is not None else None
+        h.richMessages[m.id] = m
+    h.richMessages.spillStored()
+    if "pins" not in snapshot: return False
+    h.trackedChannels.update(snapshot.get("trackedChannels", []))
+    for k,v in snapshot["pins"].items(): h.setPins(int(k), v)
+    for k,v in snapshot.get("pinTimes", {}).items(): h.pinTimes[int(k)] = datetime.datetime.fromisoformat(v) if v is not None else None
+    return True
+
+async def serve(bot, path: str) -> asyncio.AbstractServer:
+    """Waits for the successor of the bot on a Unix socket. When it connects, the bot stops serving and writes its state to the store, sends the snapshot, and closes once the successor acknowledged it."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        server.close()
+        try:
+            await bot.stopServing()
+            start = time.perf_counter()
+            data = await asyncio.get_event_loop().run_in_executor(None, encode, capture(bot))
+            writer.write(data)
+            await writer.drain()
+            await asyncio.wait_for(reader.readexactly(1), 60)
+            print(f"Handed off {len(data) // 1024}KiB of state in {time.perf_counter() - start:.2f}s")
+        except Exception: traceback.print_exc()
+        finally:
+            writer.close()
+            if os.path.exists(path): os.remove(path)
+            await bot.close()
+    if os.path.exists(path): os.remove(path)
+    server = await asyncio.start_unix_server(handle, path=path)
+    return server
+
+async def receive(path: str, timeout: float=60.0) -> dict[str, Any]:
+    """Connects to the previous process and returns its snapshot. Raises OSError if the previous process could not be reached, in which case it is still serving, and HandoffError if the snapshot could not be read after it stopped."""
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        try:
+            magic, version, length = HEADER.unpack(await asyncio.wait_for(reader.readexactly(HEADER.size), timeout))
+            if magic != MAGIC: raise HandoffError("The previous process did not send a snapshot")
+            payload = await asyncio.wait_for(reader.readexactly(length), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e: raise HandoffError(f"The snapshot was not received: {type(e).__name__} {e}")
+        try: snapshot = await asyncio.get_event_loop().run_in_executor(None, decode, version, payload)
+        except HandoffError: raise
+        except Exception as e: raise HandoffError(f"The snapshot could not be read: {type(e).__name__} {e}")
+        writer.write(b"\x01")
+        await writer.drain()
+        return snapshot
+    finally: writer.close()
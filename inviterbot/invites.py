@@ -0,0 +1,95 @@
+import asyncio
+import time
+import discord
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+from static import *
+from util import *
+
+class Attribution:
+    """Data class for the invite a member most likely joined with"""
+    def __init__(self, code: Optional[str], inviter: Optional[int]=None, vanity: bool=False):
+        self.code = code
+        self.inviter = inviter
+        self.vanity = vanity
+
+    def describe(self) -> str:
+        """Returns a human readable description of the invite"""
+        if self.vanity: return "the server's vanity URL"
+        if self.code is None: return "an unknown invite"
+        return f"<https://discord.gg/{self.code}>" + (f" by <@{self.inviter}>" if self.inviter else "")
+
+class InviteAttribution:
+    """Attributes member joins to invites. Joins in the same guild that arrive within a short window share a single invite fetch, and the use deltas are handed out to the waiting members in join order."""
+    def __init__(self, bot, window: float=1.5, unclaimedTTL: float=30.0):
+        """Creates the engine. Invite uses that no member claimed are kept for unclaimedTTL seconds for joins whose events arrive late."""
+        self.bot = bot
+        self.window = window
+        self.unclaimedTTL = unclaimedTTL
+        self.pending = {} # type: dict[int, list[tuple[discord.Member, asyncio.Future]]]
+        self.metrics = {"joins": 0, "fetches": 0, "coalesced": 0, "attributed": 0, "vanity": 0, "unknown": 0}
+
+    def isPending(self, guildID: int) -> bool:
+        """Returns whether joins of the guild are waiting for an invite fetch"""
+        return guildID in self.pending
+
+    async def attribute(self, member: discord.Member) -> Attribution:
+        """Returns the invite the member most likely joined with. Waits for the current batch of joins in the member's guild."""
+        self.metrics["joins"] += 1
+        future = asyncio.get_event_loop().create_future()
+        guildID = member.guild.id
+        if guildID in self.pending:
+            self.metrics["coalesced"] += 1
+            self.pending[guildID].append((member, future))
+        else:
+            self.pending[guildID] = [(member, future)]
+            asyncio.ensure_future(self.flush(member.guild))
+        return await future
+
+    async def flush(self, guild: discord.Guild) -> None:
+        """Waits for the coalescing window to pass, then fetches the invites once and resolves every pending join of the guild"""
+        await asyncio.sleep(self.window)
+        c = self.bot.getContext(guild)
+        async with c.inviteLock:
+            # Joins arriving from here on go into the next batch
+            batch = self.pending.pop(guild.id, [])
+            try:
+                self.metrics["fetches"] += 1
+                self.bot.metrics.count("rest:member_join.invites")
+                invites = await guild.invites()
+            except Exception as e:
+                for _,f in batch:
+                    if not f.done(): f.set_exception(e)
+                return
+            # Uses left over from earlier batches may belong to members of this batch whose events arrived late. They come after the uses of this fetch and expire, so a lost or duplicated join does not shift every later attribution.
+            now = time.time()
+            leftover = [x for x in c.unclaimedInvites if x[3] > now]
+            c.unclaimedInvites = []
+            deltas = [(code, count, inviter, now + self.unclaimedTTL) for code, count, inviter in c.applyInvites(invites, max(0, len(batch) - sum(x[1] for x in leftover)))]
+            deltas += leftover
+
+        batch.sort(key=lambda x: (x[0].joined_at or datetime.datetime.min, x[0].id))
+        for member,future in batch:
+            if deltas:
+                code, count, inviter, deadline = deltas[0]
+                if count > 1: deltas[0] = (code, count - 1, inviter, deadline)
+                else: deltas.pop(0)
+                self.metrics["attributed"] += 1
+                result = Attribution(code, inviter)
+            elif "VANITY_URL" in guild.features:
+                self.metrics["vanity"] += 1
+                result = Attribution(None, vanity=True)
+            else:
+                self.metrics["unknown"] += 1
+                result = Attribution(None)
+            if not future.done(): future.set_result(result)
+        # Uses without a member yet are joins whose events have not arrived
+        c.unclaimedInvites = deltas
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the metrics"""
+        m = self.metrics
+        return f"{m['joins']} joins, {m['fetches']} invite fetches ({m['coalesced']} saved), {m['attributed']} attributed, {m['vanity']} vanity, {m['unknown']} unknown"
@@ -0,0 +1,110 @@
+import asyncio
+import itertools
+import json
+import struct
+import traceback
+
+from typing import Any, Awaitable, Callable, Optional
+
+# A frame is a fixed header, the operation name and a JSON body. The length in the header covers everything after the header.
+HEADER = struct.Struct("!IIBH") # Length, request id, kind, length of the operation name
+MAX_FRAME = 16 * 1024 * 1024
+
+# Kinds of frames. Responses and errors carry the id of the request they answer. Notifications expect no answer.
+REQUEST = 0
+RESPONSE = 1
+ERROR = 2
+NOTIFY = 3
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed frame"""
+
+class RemoteError(Exception):
+    """Raised when the peer could not handle a request. The message is the error the peer reported."""
+
+def encodeFrame(kind: int, id: int, op: str, body: Any=None) -> bytes:
+    """Returns the bytes of a single frame"""
+    o = op.encode("utf-8")
+    b = json.dumps(body, separators=(",", ":")).encode("utf-8")
+    if len(o) + len(b) > MAX_FRAME: raise ProtocolError(f"Frame of {len(o) + len(b)} bytes is too large")
+    return HEADER.pack(len(o) + len(b), id, kind, len(o)) + o + b
+
+async def readFrame(reader: asyncio.StreamReader) -> tuple[int, int, str, Any]:
+    """Reads a single frame and returns its kind, request id, operation and body. Raises asyncio.IncompleteReadError at the end of the stream."""
+    length, id, kind, opLength = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME or opLength > length or kind > NOTIFY: raise ProtocolError(f"Malformed frame header ({length}, {id}, {kind}, {opLength})")
+    data = await reader.readexactly(length)
+    try: return kind, id, data[:opLength].decode("utf-8"), json.loads(data[opLength:])
+    except ValueError as e: raise ProtocolError(f"Malformed frame body: {e}")
+
+class Connection:
+    """One end of a supervisor connection. Requests are pipelined: each carries an id, any number may be in flight, and responses are matched to their request by id in whatever order they arrive. Incoming requests run concurrently on the handler registered for their operation, which receives the body and returns the response body."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handlers: Optional[dict[str, Callable[[Any], Awaitable[Any]]]]=None, onClose: Optional[Callable[[], Any]]=None):
+        self.reader = reader
+        self.writer = writer
+        self.handlers = handlers if handlers is not None else {}
+        self.onClose = onClose
+        self.ids = itertools.count(1)
+        self.pending = {} # type: dict[int, asyncio.Future]
+        self.closed = False
+        self.task = None # type: asyncio.Task
+
+    def start(self) -> "Connection":
+        """Starts reading frames. Must be called from the event loop."""
+        self.task = asyncio.ensure_future(self.readLoop())
+        return self
+
+    async def request(self, op: str, body: Any=None, timeout: Optional[float]=None) -> Any:
+        """Sends a request and returns the body of its response. Raises RemoteError if the peer failed to handle it, ConnectionError if the connection closes first, and asyncio.TimeoutError after the timeout."""
+        if self.closed: raise ConnectionError("The connection is closed")
+        id = next(self.ids) & 0xffffffff
+        future = asyncio.get_event_loop().create_future()
+        self.pending[id] = future
+        try:
+            self.writer.write(encodeFrame(REQUEST, id, op, body))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally: self.pending.pop(id, None)
+
+    def notify(self, op: str, body: Any=None) -> None:
+        """Sends a notification, which the peer does not answer. Does nothing if the connection is closed."""
+        if not self.closed: self.writer.write(encodeFrame(NOTIFY, 0, op, body))
+
+    async def readLoop(self) -> None:
+        try:
+            while True:
+                kind, id, op, body = await readFrame(self.reader)
+                if kind == REQUEST or kind == NOTIFY:
+                    asyncio.ensure_future(self.handle(kind, id, op, body))
+                    continue
+                future = self.pending.pop(id, None)
+                # Responses to requests that timed out are dropped
+                if future is None or future.done(): continue
+                if kind == RESPONSE: future.set_result(body)
+                else: future.set_exception(RemoteError(body))
+        except (asyncio.IncompleteReadError, ConnectionError): pass
+        except ProtocolError: traceback.print_exc()
+        finally: 
+            self.task = None
+            self.close()
+
+    async def handle(self, kind: int, id: int, op: str, body: Any) -> None:
+        try:
+            handler = self.handlers.get(op)
+            if handler is None: raise KeyError(f"Unknown operation {op}")
+            result = await handler(body)
+            if kind == REQUEST and not self.closed: self.writer.write(encodeFrame(RESPONSE, id, op, result))
+        except Exception as e:
+            if kind == REQUEST and not self.closed: self.writer.write(encodeFrame(ERROR, id, op, f"{type(e).__name__}: {e}"))
+            else: traceback.print_exc()
+
+    def close(self) -> None:
+        """Closes the connection. Requests that are in flight raise ConnectionError."""
+        if self.closed: return
+        self.closed = True
+        self.writer.close()
+        for x in self.pending.values():
+            if not x.done(): x.set_exception(ConnectionError("The connection closed"))
+        self.pending.clear()
+        if self.task is not None: self.task.cancel()
+        if self.onClose is not None: self.onClose()
@@ -1,5 +1,11 @@
+import array
 import asyncio
-from typing import Union
+import bisect
+import collections
+import contextlib
+import heapq
+import time
+from typing import Iterable, Union
 import discord
 from discord.enums import MessageType
 
@@ -11,23 +17,206 @@ from static import *
 from util import *
 
 class RichMessageSkeleton(RichMessage):
-    """Class that represents a rich message after a bot restart. It preserves the data and static event handler attributes, and fetches the content at startup."""
-    def __init__(self, content: str, embed: discord.Embed, eventHandler: str, channel: int, data: dict[Any, Any]):
+    """Class that represents a rich message after a bot restart. It preserves the data and static event handler attributes, and only fetches the content and embed when it is first sent, edited or notified of an event."""
+    def __init__(self, handler: "MessageHandler", id: int, eventHandler: str, channel: int, data: dict[Any, Any], expires: Optional[float]=None):
         super().__init__()
-        self.content = content
-        self.embed = embed
+        self.handler = handler
+        self.id = id
         self.eventHandler = eventHandler
         self.channel = channel
         self.data = data
+        self.expires = expires
+        self.loaded = False
+        self.loading = None # type: asyncio.Task
+
+    # Setting the content or embed directly replaces whatever would have been fetched
+    @property
+    def content(self) -> str: return self.__dict__.get("_content")
+    @content.setter
+    def content(self, content: str) -> None: 
+        self.__dict__["_content"] = content
+        self.loaded = True
+    @property
+    def embed(self) -> discord.Embed: return self.__dict__.get("_embed")
+    @embed.setter
+    def embed(self, embed: discord.Embed) -> None: 
+        self.__dict__["_embed"] = embed
+        self.loaded = True
+
+    async def load(self) -> Optional[discord.Message]:
+        """Fetches the content and embed of the message if they are not loaded yet. Concurrent calls share a single fetch. Returns the fetched message, or None if it was already loaded or could not be resolved."""
+        if self.loaded: return None
+        if self.loading is None: self.loading = asyncio.ensure_future(self._load())
+        try: return await asyncio.shield(self.loading)
+        finally:
+            # Allow a later retry if the fetch failed
+            if self.loading.done() and not self.loaded: self.loading = None
+
+    async def _load(self) -> Optional[discord.Message]:
+        self.handler.bot.metrics.count("rest:messages.fetch")
+        m = await self.handler.bot.resolveMessage(self.id, self.channel, fetch=True)
+        if m is None: 
+            print(f"Could not resolve rich message {self.id} in channel {self.channel}")
+            return None
+        self.channel = m.channel.id
+        self.__dict__["_content"] = m.content
+        self.__dict__["_embed"] = m.embeds[0] if m.embeds else None
+        self.loaded = True
+        return m
+
+class RichMessageRegistry:
+    """Holds the rich messages of a MessageHandler, bounded by an entry and an estimated memory cap. The least recently used messages are evicted first, and messages expire after their TTL. Evicted messages with an event handler are spilled to the store, which only keeps them on disk, and are reloaded as RichMessageSkeleton when an event refers to them."""
+    def __init__(self, handler: "MessageHandler", maxEntries: int=5000, maxBytes: int=8 * 1024 * 1024, ttl: Optional[float]=None, handlerTTLs: Optional[dict[str, float]]=None):
+        """Creates a registry. ttl is the default lifetime in seconds of messages, and handlerTTLs overrides it by event handler. A TTL set on a message overrides both."""
+        self.handler = handler
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.handlerTTLs = handlerTTLs or {} # type: dict[str, float]
+        self.entries = collections.OrderedDict() # type: collections.OrderedDict[int, RichMessage]
+        self.sizes = {} # type: dict[int, int]
+        self.expiries = [] # type: list[tuple[float, int]]
+        self.bytes = 0
+        self.stats = {"evicted": 0, "spilled": 0, "expired": 0, "reloaded": 0, "savedBytes": 0}
+
+    def estimate(self, message: RichMessage) -> int:
+        """Returns a rough estimate of the memory a message uses"""
+        n = 256 + len(message.content or "") + len(repr(message.data))
+        if message.embed is not None: n += len(repr(message.embed.to_dict()))
+        return n
+
+    def get(self, id: int, default: Any=None) -> Optional[RichMessage]:
+        """Returns the message with the given id, reloading it from the store if it was evicted. Messages that are only kept on disk are not read, so default is returned for them; use fetch to reload those."""
+        m = self.entries.get(id)
+        if m is not None:
+            if m.expires is not None and m.expires <= time.time():
+                self.expire(id)
+                return default
+            self.entries.move_to_end(id)
+            return m
+        return self.restore(id, self.handler.bot.store.data.get(f"messages/{id}"), default)
+
+    async def fetch(self, id: int, default: Any=None) -> Optional[RichMessage]:
+        """Returns the message with the given id like get, but also reads a message that is only kept on disk without blocking the event loop"""
+        if id in self.entries: return self.get(id, default)
+        y = await self.handler.bot.store.fetch(f"messages/{id}")
+        if id in self.entries: return self.get(id, default)
+        return self.restore(id, y, default)
+
+    def restore(self, id: int, y: Optional[dict[str, Any]], default: Any) -> Optional[RichMessage]:
+        """Puts the stored message back into memory"""
+        if y is None: return default
+        m = RichMessageSkeleton(self.handler, id, **y)
+        if m.expires is not None and m.expires <= time.time():
+            self.handler.persist(id, None)
+            return default
+        self.stats["reloaded"] += 1
+        self[id] = m
+        return m
+
+    def __contains__(self, id: int) -> bool: return id in self.entries or self.handler.bot.store.contains(f"messages/{id}")
+    def __getitem__(self, id: int) -> RichMessage:
+        m = self.get(id)
+        if m is None: raise KeyError(id)
+        return m
+
+    def __setitem__(self, id: int, message: RichMessage) -> None:
+        if id in self.entries: self.bytes -= self.sizes.pop(id)
+        self.entries[id] = message
+        self.entries.move_to_end(id)
+        self.sizes[id] = self.estimate(message)
+        self.bytes += self.sizes[id]
+        if message.expires is None:
+            ttl = message.ttl if message.ttl is not None else self.handlerTTLs.get(message.eventHandler, self.ttl)
+            if ttl is not None: message.expires = time.time() + ttl
+        if message.expires is not None: heapq.heappush(self.expiries, (message.expires, id))
+        self.sweep()
+
+    def __delitem__(self, id: int) -> None:
+        del self.entries[id]
+        self.bytes -= self.sizes.pop(id)
+
+    def items(self) -> List[tuple[int, RichMessage]]:
+        """Returns the messages that are in memory"""
+        return list(self.entries.items())
+
+    def expire(self, id: int) -> None:
+        """Removes an expired message from memory and from the store"""
+        del self[id]
+        self.handler.persist(id, None)
+        self.stats["expired"] += 1
+
+    def sweep(self) -> None:
+        """Expires messages whose TTL passed, then evicts the least recently used messages until the registry is within its caps"""
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            deadline, id = heapq.heappop(self.expiries)
+            m = self.entries.get(id)
+            if m is not None and m.expires == deadline: self.expire(id)
+        while self.entries and (len(self.entries) > self.maxEntries or self.bytes > self.maxBytes):
+            id, m = next(iter(self.entries.items()))
+            self.stats["savedBytes"] += self.sizes[id]
+            del self[id]
+            self.stats["evicted"] += 1
+            # Messages with an event handler are kept on disk and reloaded on demand. Others have no behaviour and are dropped.
+            if m.eventHandler is not None: 
+                self.handler.persist(id, m)
+                self.handler.bot.store.evict(f"messages/{id}")
+                self.stats["spilled"] += 1
+
+    def spillStored(self) -> None:
+        """Evicts the stored messages that are not in memory from the store, so they are only kept on disk"""
+        store = self.handler.bot.store
+        for k in store.keys("messages/"):
+            if int(k[len("messages/"):]) not in self.entries: store.evict(k)
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the registry"""
+        s = self.stats
+        store = self.handler.bot.store
+        return f"{len(self.entries)}/{self.maxEntries} messages, ~{self.bytes // 1024}/{self.maxBytes // 1024}KiB in memory, {s['evicted']} evicted ({s['spilled']} spilled, ~{s['savedBytes'] // 1024}KiB freed), {s['expired']} expired, {s['reloaded']} reloaded\n{len(store.cold)} stored values only on disk, {store.stats['coldReads']} read back"
+
+class DeferredTyping:
+    """Triggers typing in a channel only if it was not cancelled within a delay"""
+    def __init__(self, handler: "MessageHandler", channel: discord.abc.Messageable, delay: float):
+        self.handler = handler
+        self.channel = channel
+        self.task = None # type: asyncio.Task
+        self.timer = asyncio.get_event_loop().call_later(delay, self.trigger)
+
+    def trigger(self) -> None:
+        self.handler.outbound["typingSent"] += 1
+        self.task = asyncio.ensure_future(self.channel.trigger_typing())
+
+    def cancel(self) -> None:
+        """Cancels the typing if it was not triggered yet"""
+        if self.task is None: 
+            self.timer.cancel()
+            self.handler.outbound["typingAvoided"] += 1
 
 class MessageHandler:
     """Handles the input and output of messages related to the discord bot"""
-    def __init__(self, bot): 
+    def __init__(self, bot, pinConcurrency: int=8): 
         self.ready = False
         self.bot = bot
         self.botID = bot.user.id # type: int
-        self.pinsCache = {} # type: dict[int, set[int]]
-        self.richMessages = {} # type: dict[int, RichMessage]
+        self.pinsCache = {} # type: dict[int, array.array] # Sorted ids of the pinned messages of each tracked channel
+        self.trackedChannels = set() # type: set[int] # Channels that contain rich messages. Pins are only tracked there.
+        self.pinTimes = {} # type: dict[int, Optional[datetime.datetime]] # Last pin timestamp of each tracked channel, as naive UTC
+        self.richMessages = RichMessageRegistry(self)
+        self.pinConcurrency = pinConcurrency
+        self.pinGate = RateLimitGate()
+
+        # Outbound pipeline. Sends and edits in a channel are paced to discord's limit of 5 per 5 seconds, edits of the same message are coalesced, and edits to the state that was last sent are skipped.
+        self.typingDelay = 0.5
+        self.channelRate = (1.0, 5.0)
+        self.channelBuckets = {} # type: dict[int, TokenBucket]
+        self.channelLocks = {} # type: dict[int, asyncio.Lock]
+        self.pendingEdits = {} # type: dict[int, tuple[Union[str, discord.Embed, RichMessage], discord.Message]]
+        self.editTasks = {} # type: dict[int, asyncio.Task]
+        self.sentStates = collections.OrderedDict() # type: collections.OrderedDict[int, tuple]
+        self.pinStats = {"inferred": 0, "fetched": 0}
+        self.outbound = {"sent": 0, "edited": 0, "coalesced": 0, "unchanged": 0, "paced": 0, "typingSent": 0, "typingAvoided": 0}
 
     async def sendMessage(self, message: Union[str, discord.Embed, RichMessage], channel: Union[discord.abc.PrivateChannel, discord.TextChannel, str, int]) -> discord.Message:
         """Sends the given message to the channel provided. If the channel is not a discord channel object, it will attempt to resolve it from the cache. The message can be a string, Embed, or RichMessage object, the last one being registered for event handling."""
@@ -35,107 +224,242 @@ class MessageHandler:
         if channel is None: raise ValueError("Channel cannot be none")
         channel = self.bot.resolveChannel(channel)
         if channel is None: raise ValueError("Could not resolve channel when sending message")
-        if isinstance(message, str): return await channel.send(content=message)
-        elif isinstance(message, discord.Embed): return await channel.send(embed=message)
-        elif isinstance(message, RichMessage):
-            m = await channel.send(**(message.getMessage()))
+        if isinstance(message, RichMessageSkeleton): await message.load()
+        content, embed = self.unpack(message)
+        async with self.pace(channel.id):
+            m = await channel.send(content=content, embed=embed)
+        self.outbound["sent"] += 1
+        self.bot.metrics.count("rest:messages.send")
+        self.remember(m.id, content, embed)
+        if isinstance(message, RichMessage):
             message.channel = channel.id
             self.richMessages[m.id] = message
-            return m
-        else: raise ValueError(f"Unknown message type {message}") 
+            self.persist(m.id, message)
+        return m
 
     async def edit(self, message: Union[str, discord.Embed, RichMessage], messageObject: discord.Message) -> discord.Message:
-        """Edits the message object with the given message, which can be either a str, Embed, or RichMesage. """
+        """Edits the message object with the given message, which can be either a str, Embed, or RichMesage. The edit is skipped if the message already shows the same content and embed."""
         if messageObject is None: raise ValueError("MessageObject cannot be None")
 
-        if isinstance(message, str): await messageObject.edit(content=message, embed=None)
-        elif isinstance(message, discord.Embed): await messageObject.edit(content=None, embed=message)
-        elif isinstance(message, RichMessage):
-            await messageObject.edit(**(message.getMessage()))
+        # A restored message that was never loaded would otherwise be edited to an empty message
+        if isinstance(message, RichMessageSkeleton): await message.load()
+        content, embed = self.unpack(message)
+        if self.sentStates.get(messageObject.id) == self.state(content, embed): self.outbound["unchanged"] += 1
+        else:
+            async with self.pace(messageObject.channel.id):
+                await messageObject.edit(content=content, embed=embed)
+            self.outbound["edited"] += 1
+            self.bot.metrics.count("rest:messages.edit")
+            self.remember(messageObject.id, content, embed)
+
+        if isinstance(message, RichMessage):
             message.channel = messageObject.channel.id
             self.richMessages[messageObject.id] = message
-        else: raise ValueError(f"Unknown message type {message}") 
-    
-        if (not isinstance(message, RichMessage)) and messageObject.id in self.richMessages: del self.richMessages[messageObject.id]
+            self.persist(messageObject.id, message)
+        elif self.isRich(messageObject.id): 
+            if messageObject.id in self.richMessages.entries: del self.richMessages[messageObject.id]
+            self.persist(messageObject.id, None)
 
         return messageObject
 
+    def queueEdit(self, message: Union[str, discord.Embed, RichMessage], messageObject: discord.Message) -> asyncio.Task:
+        """Queues an edit of the message object. If an edit of the same message is already waiting, it is replaced so only the latest state is sent. Returns a task that finishes once no edit of the message is waiting."""
+        if messageObject is None: raise ValueError("MessageObject cannot be None")
+        id = messageObject.id
+        if id in self.pendingEdits: self.outbound["coalesced"] += 1
+        self.pendingEdits[id] = (message, messageObject)
+        if id not in self.editTasks: self.editTasks[id] = asyncio.ensure_future(self.drainEdits(id))
+        return self.editTasks[id]
+
+    async def drainEdits(self, id: int) -> None:
+        try:
+            while id in self.pendingEdits:
+                message, messageObject = self.pendingEdits.pop(id)
+                await self.edit(message, messageObject)
+        finally: self.editTasks.pop(id, None)
+
+    def deferTyping(self, channel: discord.abc.Messageable) -> DeferredTyping:
+        """Triggers typing in the channel unless the returned object is cancelled before the typing delay passes"""
+        return DeferredTyping(self, channel, self.typingDelay)
+
+    def unpack(self, message: Union[str, discord.Embed, RichMessage]) -> tuple[Optional[str], Optional[discord.Embed]]:
+        """Returns the content and embed of a message"""
+        if isinstance(message, str): return message, None
+        elif isinstance(message, discord.Embed): return None, message
+        elif isinstance(message, RichMessage): return message.getContent(), message.getEmbed()
+        else: raise ValueError(f"Unknown message type {message}") 
+
+    def state(self, content: Optional[str], embed: Optional[discord.Embed]) -> tuple:
+        return (content, repr(sorted(embed.to_dict().items())) if embed is not None else None)
+
+    def remember(self, id: int, content: Optional[str], embed: Optional[discord.Embed]) -> None:
+        """Records what a message shows, keeping only the most recent messages"""
+        self.sentStates[id] = self.state(content, embed)
+        self.sentStates.move_to_end(id)
+        while len(self.sentStates) > 1000: self.sentStates.popitem(last=False)
+
+    @contextlib.asynccontextmanager
+    async def pace(self, channelID: int):
+        """Waits until a request may be sent in the channel without being rate limited. Requests in a channel are sent in order."""
+        if channelID not in self.channelLocks:
+            if len(self.channelLocks) >= 1000:
+                for k in [k for k,v in self.channelLocks.items() if not v.locked() and self.channelBuckets[k].full()]: 
+                    del self.channelLocks[k]
+                    del self.channelBuckets[k]
+            self.channelLocks[channelID] = asyncio.Lock()
+            self.channelBuckets[channelID] = TokenBucket(*self.channelRate)
+        async with self.channelLocks[channelID]:
+            bucket = self.channelBuckets[channelID]
+            if not bucket.take():
+                self.outbound["paced"] += 1
+                await asyncio.sleep(bucket.delay())
+                bucket.take()
+            yield
+
     async def update(self) -> None:
         """Update the message object with pins from all channels that can be seen and reconstructs the message cache from messages.json"""
-        for c in self.bot.get_all_channels(): 
-            if not isinstance(c, discord.TextChannel): continue
-            y = await c.pins()
-            if len(y) > 0: self.pinsCache[c.id] = set([x.id for x in y])
-        for c in self.bot.private_channels: 
-            y = await c.pins()
-            if len(y) > 0: self.pinsCache[c.id] = set([x.id for x in y])
-
-        a = loadJSON("messages.json")
-        for x,y in a.items():
-            m = await self.bot.resolveMessage(x, y["channel"], fetch=True)
-            if m is None: 
-                print(f'couldnt resolve {m}')
-                continue
-            y["content"] = m.content
-            y["embed"] = m.embeds[0] if m.embeds else None
-            y["channel"] = m.channel.id
-            self.richMessages[int(str(x))] = RichMessageSkeleton(**y)
-        
+        # Migrate messages.json to one key per message. The legacy key is kept empty so the file is not read again.
+        legacy = self.bot.store.load("messages", {})
+        if legacy:
+            for x,y in legacy.items(): self.bot.store.put(f"messages/{x}", y)
+            self.bot.store.put("messages", {})
+
+        for k,v in self.bot.store.items("messages/"): 
+            if v.get("channel") is not None: self.trackedChannels.add(v["channel"])
+        await self.syncPins()
+
+        # Rich messages are not restored here. The registry reloads them from the store when an event refers to them, so they only need to be on disk.
+        self.richMessages.spillStored()
+
         self.ready = True
 
-    async def onPinsUpdate(self, channel: Union[discord.abc.GuildChannel, discord.abc.PrivateChannel]) -> None: 
-        """To be called when a channel updates its pins. Notifies any RichMessage objects if it was unpinned"""
-        p = set([x.id for x in await channel.pins()])
+    def setPins(self, channelID: int, ids: Iterable[int]) -> None:
+        """Replaces the cached pins of a channel"""
+        self.pinsCache[channelID] = array.array("q", sorted(ids))
 
-        if channel.id not in self.pinsCache: 
-            self.pinsCache[channel.id] = p
+    def addPin(self, channelID: int, id: int) -> None:
+        p = self.pinsCache.setdefault(channelID, array.array("q"))
+        i = bisect.bisect_left(p, id)
+        if i == len(p) or p[i] != id: p.insert(i, id)
+
+    def isPinned(self, channelID: int, id: int) -> bool:
+        p = self.pinsCache.get(channelID)
+        if p is None: return False
+        i = bisect.bisect_left(p, id)
+        return i < len(p) and p[i] == id
+
+    def isRich(self, id: int) -> bool:
+        """Returns whether the id belongs to a rich message, without reloading it from the store"""
+        return id in self.richMessages
+
+    async def syncPins(self, guilds: Optional[set[int]]=None) -> None:
+        """Fills the pins cache for every channel that contains rich messages, or only for the channels of the given guild ids. Channels whose last pin timestamp matches the one in the store reuse the saved pins, channels that were never pinned are skipped, and the rest are fetched by a pool of workers."""
+        snapshot = self.bot.store.load("pins", {})
+        timestamps = self.bot.lastPinTimestamps
+        stale = []
+        for id in self.trackedChannels:
+            c = self.bot.get_channel(id)
+            # Channels of shards that are not connected yet are synced when their shard is ready
+            if c is None: continue
+            if guilds is not None and getattr(getattr(c, "guild", None), "id", None) not in guilds: continue
+            if c.id in timestamps:
+                self.pinTimes[c.id] = parseTime(timestamps[c.id])
+                if timestamps[c.id] is None: continue
+                x = snapshot.get(str(c.id))
+                if x is not None and x["lastPin"] == timestamps[c.id]:
+                    if x["pins"]: self.setPins(c.id, x["pins"])
+                    continue
+            stale.append(c)
+        print(f"Fetching pins for {len(stale)} channel(s), {len(self.pinsCache)} cached in total")
+
+        channels = iter(stale)
+        async def worker():
+            for c in channels:
+                self.bot.metrics.count("rest:messages.pins")
+                try: y = await self.pinGate.call(c.pins)
+                except discord.HTTPException as e: 
+                    if e.status != 403: print(f"Could not fetch pins for channel {c.id}: {e}")
+                    continue
+                if len(y) > 0: self.setPins(c.id, [x.id for x in y])
+                else: self.pinsCache.pop(c.id, None)
+        await asyncio.gather(*[worker() for _ in range(min(self.pinConcurrency, len(stale)))])
+
+    async def onPinsUpdate(self, channel: Union[discord.abc.GuildChannel, discord.abc.PrivateChannel], lastPin: Optional[datetime.datetime]=None) -> None: 
+        """To be called when a channel updates its pins. Notifies any RichMessage objects if it was unpinned. Pins are applied from their system message, so the pins are only fetched when a rich message may have been unpinned."""
+        if channel.id not in self.trackedChannels: return
+        lastPin = parseTime(lastPin)
+        previous = self.pinTimes.get(channel.id)
+        self.pinTimes[channel.id] = lastPin
+
+        # A newer last pin means a message was pinned, which onMessage applies from the pins_add message
+        if lastPin is not None and previous is not None and lastPin > previous: 
+            self.pinStats["inferred"] += 1
+            return
+        # Otherwise a message was unpinned. Which one only matters if a rich message is pinned here.
+        q = self.pinsCache.get(channel.id, ())
+        if not any(self.isRich(x) for x in q): 
+            self.pinStats["inferred"] += 1
             return
-        q = self.pinsCache[channel.id]
 
-        for x in q.difference(p):
-            if x in self.richMessages:
-                if x in q: self.richMessages[x].onEvent(MessageUnpinEvent(), None)
-        self.pinsCache[channel.id] = p
+        self.pinStats["fetched"] += 1
+        self.bot.metrics.count("rest:messages.pins")
+        p = set([x.id for x in await channel.pins()])
+        for x in q:
+            if x not in p: await self.dispatch(x, MessageUnpinEvent(), None)
+        self.setPins(channel.id, p)
 
     async def onMessage(self, message: discord.Message) -> None: 
         """To be called when a message is sent. Notifies any RichMessage objects if replies occured or if it was pined."""
         if message.reference is None: return
-        if message.reference.message_id not in self.richMessages: return
-        if message.type == discord.MessageType.pins_add: 
-            self.richMessages[message.reference.message_id].onEvent(MessagePinEvent(), message)
-            if message.channel.id not in self.pinsCache: 
-                self.pinsCache[message.channel.id] = set()
-            self.pinsCache[message.channel.id].add(message.reference.message_id)
-        else: self.richMessages[message.reference.message_id].onEvent(MessageReplyEvent(), message)
-
-    def onMessageDelete(self, payload: Union[discord.RawMessageDeleteEvent, discord.RawBulkMessageDeleteEvent]) -> None: 
+        if message.type == discord.MessageType.pins_add and message.channel.id in self.trackedChannels: 
+            self.addPin(message.channel.id, message.reference.message_id)
+        if message.type == discord.MessageType.pins_add: await self.dispatch(message.reference.message_id, MessagePinEvent(), message)
+        else: await self.dispatch(message.reference.message_id, MessageReplyEvent(), message)
+
+    async def dispatch(self, id: int, event: Any, message: Optional[discord.Message]) -> None:
+        """Notifies the rich message with the given id of an event, if there is one. A message restored after a restart is loaded first, so its event handler sees its content and embed."""
+        m = await self.richMessages.fetch(id)
+        if m is None: return
+        # A deleted message cannot be fetched anymore
+        if isinstance(m, RichMessageSkeleton) and not isinstance(event, (discord.RawMessageDeleteEvent, discord.RawBulkMessageDeleteEvent)): await m.load()
+        m.onEvent(event, message)
+
+    async def onMessageDelete(self, payload: Union[discord.RawMessageDeleteEvent, discord.RawBulkMessageDeleteEvent]) -> None: 
         """To be called when a message is deleted. Notifies any RichMessage objects if it was deleted."""
         l = []
         if isinstance(payload, discord.RawMessageDeleteEvent): l.append(payload.message_id)
         elif isinstance(payload, discord.RawBulkMessageDeleteEvent): l.extend(payload.message_ids)
-        for x in l: 
-            if x in self.richMessages: self.richMessages[x].onEvent(payload, None)
+        for x in l: await self.dispatch(x, payload, None)
 
-    def onReactionActionEvent(self, payload: discord.RawReactionActionEvent) -> None: 
+    async def onReactionActionEvent(self, payload: discord.RawReactionActionEvent) -> None: 
         """To be called when reactions occur. Notifies any RichMessage objects if it was the target."""
-        if payload.message_id in self.richMessages: self.richMessages[payload.message_id].onEvent(payload, None)
+        await self.dispatch(payload.message_id, payload, None)
 
-    def onReactionClearEmojiEvent(self, payload: discord.RawReactionClearEmojiEvent) -> None: 
+    async def onReactionClearEmojiEvent(self, payload: discord.RawReactionClearEmojiEvent) -> None: 
         """To be called when a reaction emoji was cleared. Notifies any RichMessage objects if it was the target."""
-        if payload.message_id in self.richMessages: self.richMessages[payload.message_id].onEvent(payload, None)
+        await self.dispatch(payload.message_id, payload, None)
 
-    def onReactionClearEvent(self, payload: discord.RawReactionClearEvent) -> None: 
+    async def onReactionClearEvent(self, payload: discord.RawReactionClearEvent) -> None: 
         """To be called when reactions were cleared. Notifies any RichMessage objects if it was the target."""
-        if payload.message_id in self.richMessages: self.richMessages[payload.message_id].onEvent(payload, None)
+        await self.dispatch(payload.message_id, payload, None)
+
+    def persist(self, id: int, message: Optional[RichMessage]) -> None:
+        """Stores the rich message with the given id so it can be reconstructed after a restart. Messages without an event handler, or None, are removed from the store."""
+        if message is None or message.eventHandler is None: 
+            self.bot.store.delete(f"messages/{id}")
+            return
+        a = {}
+        a["eventHandler"] = message.eventHandler
+        a["channel"] = message.channel
+        a["data"] = message.data
+        if message.channel is not None: self.trackedChannels.add(message.channel)
+        if message.expires is not None: a["expires"] = message.expires
+        self.bot.store.put(f"messages/{id}", a)
 
     def save(self) -> None: 
-        """Saves the messages to messages.json so it can be reconstructed from the file"""
-        d = {}
-        for k,v in self.richMessages.items():
-            if v.eventHandler == None: continue
-            a = {}
-            a["eventHandler"] = v.eventHandler
-            a["channel"] = v.channel
-            a["data"] = v.data
-            d[k] = a
-        saveJSON(d, "messages.json")
+        """Stores every rich message and the pins cache so they can be reconstructed. Unchanged messages are not written again."""
+        for k,v in self.richMessages.items(): self.persist(k, v)
+
+        # Only channels with a known last pin timestamp can be revalidated on the next startup
+        timestamps = self.bot.lastPinTimestamps
+        self.bot.store.put("pins", {str(k): {"lastPin": timestamps[k], "pins": v.tolist()} for k,v in self.pinsCache.items() if timestamps.get(k) is not None})
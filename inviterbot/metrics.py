@@ -0,0 +1,218 @@
+import asyncio
+import bisect
+import collections
+import contextvars
+import gc
+import os
+import sys
+import threading
+import time
+import traceback
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+from static import *
+from util import *
+
+# Upper bounds of histogram buckets in seconds, from 50us to 30s. Observations above the last bound fall into an overflow bucket.
+BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """A latency histogram with fixed buckets. Recording is a bisect and an increment, and memory does not grow with the number of samples."""
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """Returns the upper bound of the bucket that contains the p-th percentile (0 to 100), or the maximum for the overflow bucket"""
+        if self.count == 0: return 0.0
+        target = self.count * p / 100
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= target: return BOUNDS[i] if i < len(BOUNDS) else self.max
+        return self.max
+
+    def mean(self) -> float: return self.total / self.count if self.count else 0.0
+
+# The command or event the current task is handling, which the BlockingDetector attributes stalls to
+currentActivity = contextvars.ContextVar("activity", default=None) # type: contextvars.ContextVar[Optional[str]]
+
+class Timer:
+    """Context manager that records the time spent inside it to a histogram"""
+    __slots__ = ("histogram", "start")
+    def __init__(self, histogram: Histogram): self.histogram = histogram
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args): self.histogram.record(time.perf_counter() - self.start)
+
+class Activity(Timer):
+    """Timer that also marks the command or event the current task is handling while inside it"""
+    __slots__ = ("name", "token")
+    def __init__(self, histogram: Histogram, name: str):
+        super().__init__(histogram)
+        self.name = name
+    def __enter__(self):
+        self.token = currentActivity.set(self.name)
+        return super().__enter__()
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        currentActivity.reset(self.token)
+
+class BlockingDetector:
+    """Debug mode that reports callbacks holding the event loop longer than a threshold. A watchdog thread notices when the loop stops ticking and samples the stack of the loop thread. The cause is the currentActivity of the task holding the loop, which Metrics.track sets to the command or event being handled."""
+    def __init__(self, metrics: "Metrics", threshold: float=0.1, keep: int=20):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.reports = collections.deque(maxlen=keep) # type: collections.deque[tuple[float, str, float, str]] # Recent stalls as (time, activity, seconds, stack)
+        self.pending = collections.deque() # type: collections.deque[tuple[str, float, str]] # Stalls the watchdog found, recorded by the loop
+        self.lastTick = time.perf_counter()
+        self.loopThread = None # type: int
+        self.loop = None # type: asyncio.AbstractEventLoop
+        self.stopped = threading.Event()
+
+    async def tick(self) -> None:
+        """Marks the loop as alive and records the stalls found by the watchdog. Must run on the event loop."""
+        self.loopThread = threading.get_ident()
+        self.loop = asyncio.get_event_loop()
+        threading.Thread(target=self.watch, name="blocking-detector", daemon=True).start()
+        try:
+            while True:
+                self.lastTick = time.perf_counter()
+                while self.pending:
+                    activity, seconds, stack = self.pending.popleft()
+                    self.metrics.histogram("blocked:" + activity).record(seconds)
+                    self.reports.append((time.time(), activity, seconds, stack))
+                    print(f"Event loop was blocked for {seconds * 1000:.0f}ms by {activity}:\n{stack}")
+                await asyncio.sleep(self.interval)
+        finally: self.stopped.set()
+
+    def watch(self) -> None:
+        """Body of the watchdog thread"""
+        stall = None # type: tuple[float, str, str]
+        while not self.stopped.wait(self.interval):
+            last = self.lastTick
+            late = time.perf_counter() - last - self.interval
+            if stall is not None and stall[0] != last:
+                # The loop ticked again, so the stall is over
+                self.pending.append((stall[1], last - stall[0] - self.interval, stall[2]))
+                stall = None
+            if stall is None and late > self.threshold:
+                frame = sys._current_frames().get(self.loopThread)
+                if frame is not None: stall = (last, self.activity(), "".join(traceback.format_stack(frame, limit=6)))
+
+    def activity(self) -> str:
+        """Returns the currentActivity of the task that is holding the loop. Called from the watchdog thread."""
+        task = asyncio.current_task(self.loop)
+        if task is None: return "unknown"
+        if hasattr(task, "get_context"): context = task.get_context()
+        else:
+            # Task.get_context was added in Python 3.12. Before that the context of a C task is only reachable through the gc, where it is the first referent.
+            context = next((x for x in gc.get_referents(task) if isinstance(x, contextvars.Context)), None)
+        return (context.get(currentActivity) if context is not None else None) or "unknown"
+
+    def summary(self, limit: int=5) -> str:
+        """Returns the most recent stalls"""
+        return "\n".join(f"`{a}` {s * 1000:.0f}ms {time.time() - t:.0f}s ago" for t, a, s, _ in list(self.reports)[-limit:]) or "None recorded"
+
+class Metrics:
+    """Collects latency histograms and counters of the bot, samples the event loop lag, and optionally exports everything in the Prometheus text format"""
+    def __init__(self, lagInterval: float=0.5, exportPath: Optional[str]=None, exportInterval: float=15.0, blockingThreshold: Optional[float]=None):
+        """Creates the metrics. A blocking threshold in seconds enables the BlockingDetector."""
+        self.detector = BlockingDetector(self, blockingThreshold) if blockingThreshold else None
+        self.histograms = {} # type: dict[str, Histogram]
+        self.counters = {} # type: dict[str, int]
+        self.lagInterval = lagInterval
+        self.exportPath = exportPath
+        self.exportInterval = exportInterval
+        self.tasks = [] # type: list[asyncio.Task]
+        self.started = time.time()
+
+    def histogram(self, name: str) -> Histogram:
+        """Returns the histogram with the given name, creating it if needed. Names are of the form kind:label, such as event:on_message."""
+        h = self.histograms.get(name)
+        if h is None: h = self.histograms[name] = Histogram()
+        return h
+
+    def time(self, name: str) -> Timer:
+        """Returns a context manager that records its duration to the named histogram"""
+        return Timer(self.histogram(name))
+
+    def track(self, name: str) -> Activity:
+        """Returns a context manager that records its duration to the named histogram and attributes stalls inside it to the name"""
+        return Activity(self.histogram(name), name)
+
+    def count(self, name: str, n: int=1) -> None:
+        """Increments the named counter"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start(self) -> None:
+        """Starts the lag sampler and the exporter. Must be called from the event loop."""
+        if self.tasks: return
+        self.tasks.append(asyncio.ensure_future(self.sampleLag()))
+        if self.detector is not None: self.tasks.append(asyncio.ensure_future(self.detector.tick()))
+        if self.exportPath: self.tasks.append(asyncio.ensure_future(self.exportPeriodically()))
+
+    def stop(self) -> None:
+        for x in self.tasks: x.cancel()
+        self.tasks = []
+
+    async def sampleLag(self) -> None:
+        """Measures how late the event loop wakes up from a sleep, which is the time callbacks held the loop"""
+        h = self.histogram("loop:lag")
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lagInterval)
+            h.record(max(0.0, time.perf_counter() - start - self.lagInterval))
+
+    async def exportPeriodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.exportInterval)
+            try:
+                text = self.prometheus()
+                await asyncio.get_event_loop().run_in_executor(None, self.writeExport, text)
+            except Exception: traceback.print_exc()
+
+    def writeExport(self, text: str) -> None:
+        """Atomically replaces the export file, so scrapers never read a partial file"""
+        tmp = self.exportPath + ".tmp"
+        with open(tmp, "w") as f: f.write(text)
+        os.replace(tmp, self.exportPath)
+
+    def prometheus(self) -> str:
+        """Returns every histogram and counter in the Prometheus text exposition format"""
+        lines = ["# TYPE inviterbot_latency_seconds histogram"]
+        for name, h in sorted(self.histograms.items()):
+            kind, _, label = name.partition(":")
+            labels = f'kind="{kind}",name="{label}"'
+            n = 0
+            for bound, c in zip(BOUNDS, h.counts):
+                n += c
+                lines.append(f'inviterbot_latency_seconds_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'inviterbot_latency_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f'inviterbot_latency_seconds_sum{{{labels}}} {h.total}')
+            lines.append(f'inviterbot_latency_seconds_count{{{labels}}} {h.count}')
+        lines.append("# TYPE inviterbot_total counter")
+        for name, v in sorted(self.counters.items()): lines.append(f'inviterbot_total{{name="{name}"}} {v}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, kind: str, limit: int=10) -> str:
+        """Returns one line per histogram of the given kind, slowest p99 first"""
+        r = []
+        for name, h in sorted(((k,v) for k,v in self.histograms.items() if k.startswith(kind + ":")), key=lambda x: -x[1].percentile(99))[:limit]:
+            r.append(f"`{name[len(kind) + 1:]}` {h.count}x p50 {h.percentile(50) * 1000:g}ms p99 {h.percentile(99) * 1000:g}ms max {h.max * 1000:.1f}ms")
+        return "\n".join(r) or "None recorded"
@@ -0,0 +1,318 @@
+import asyncio
+import os
+import json
+import pickle
+import queue
+import struct
+import threading
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+from static import *
+from util import *
+
+class JSONSerializer:
+    """Encodes values as compact JSON. Keys of dictionaries become strings."""
+    name = "json"
+    def dumps(self, value: Any) -> bytes: return json.dumps(value, separators=(",", ":")).encode("utf-8")
+    def loads(self, data: bytes) -> Any: return json.loads(data.decode("utf-8"))
+
+class PickleSerializer:
+    """Encodes values with pickle. Faster than JSON for large state and keeps the types of dictionary keys."""
+    name = "pickle"
+    def dumps(self, value: Any) -> bytes: return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    def loads(self, data: bytes) -> Any: return pickle.loads(data)
+
+class Store:
+    """A key-value store with write-behind persistence. Changed values are encoded on the event loop and appended to a journal by a background thread. The journal is compacted into a snapshot periodically and on close, and both are replayed on recovery. Values can be evicted from memory, after which they are read from disk when accessed."""
+
+    # Records are a key and a value, each prefixed by its length. A value length of DELETED removes the key.
+    header = struct.Struct(">I")
+    DELETED = 0xFFFFFFFF
+
+    def __init__(self, directory: str, serializer: Any=None, flushInterval: float=1.0, compactEvery: int=1000):
+        """Creates a store in the given data directory. The serializer must provide dumps(value) -> bytes and loads(bytes) -> value"""
+        self.directory = dataPath(directory)
+        self.serializer = serializer or JSONSerializer()
+        self.flushInterval = flushInterval
+        self.compactEvery = compactEvery
+        self.data = {} # type: dict[str, Any]
+        self.dirty = set() # type: set[str]
+        self.encoded = {} # type: dict[str, bytes] # The last encoding written of each key, used to skip unchanged values
+        self.journalLength = 0
+        self.queue = queue.Queue() # type: queue.Queue
+        self.thread = None # type: threading.Thread
+        self.task = None # type: asyncio.Task
+        self.stats = {"puts": 0, "skipped": 0, "written": 0, "compactions": 0, "evicted": 0, "coldReads": 0}
+        self.legacy = set() # type: set[str] # Keys that have a legacy {key}.json file and were never stored, found by recover
+
+        # Eviction. A value is only evicted once the version of it that is in memory is on disk.
+        self.cold = set() # type: set[str] # Keys whose value is only on disk
+        self.evicting = set() # type: set[str] # Keys to evict once their value is written
+        self.versions = {} # type: dict[str, int] # Version of the last encoding of each key, if it changed since recover
+        self.locations = {} # type: dict[str, tuple[str, int, int, int]] # File, offset, length and version of the last written value of each key
+        self.sequence = 0
+        self.lock = threading.Lock() # Guards locations, and encoded and cold together, between the event loop and the writer thread
+
+    def snapshotPath(self) -> str: return os.path.join(self.directory, f"snapshot.{self.serializer.name}")
+    def journalPath(self) -> str: return os.path.join(self.directory, f"journal.{self.serializer.name}")
+
+    def recover(self) -> "Store":
+        """Loads the snapshot and replays the journal. A partially written record at the end of the journal, left by a crash, is discarded."""
+        os.makedirs(self.directory, exist_ok=True)
+        for path in (self.snapshotPath(), self.journalPath()):
+            if not os.path.isfile(path): continue
+            with open(path, "rb") as f: raw = f.read()
+            n = 0
+            for key, value, offset in self.readRecords(raw):
+                n += 1
+                if value is None:
+                    self.encoded.pop(key, None)
+                    self.data.pop(key, None)
+                    self.locations.pop(key, None)
+                else:
+                    self.encoded[key] = value
+                    self.data[key] = self.serializer.loads(value)
+                    self.locations[key] = (path, offset, len(value), 0)
+            if path == self.journalPath(): self.journalLength = n
+        self.scanLegacy()
+        return self
+
+    def scanLegacy(self) -> None:
+        """Finds the legacy JSON files of keys that were never stored, so looking up a missing key does not touch the disk"""
+        root = dataPath("")
+        self.legacy.clear()
+        for directory, subdirectories, files in os.walk(root):
+            if os.path.abspath(directory) == os.path.abspath(self.directory):
+                subdirectories.clear()
+                continue
+            for f in files:
+                if not f.endswith(".json"): continue
+                key = os.path.relpath(os.path.join(directory, f[:-5]), root).replace(os.sep, "/")
+                if key not in self.data: self.legacy.add(key)
+
+    async def migrateLegacy(self) -> None:
+        """Reads every legacy JSON file found by recover into the store without blocking the event loop"""
+        loop = asyncio.get_event_loop()
+        for key in list(self.legacy):
+            value = await loop.run_in_executor(None, loadJSON, key + ".json")
+            if key in self.legacy and key not in self.data: self.put(key, value)
+            self.legacy.discard(key)
+
+    def readRecords(self, raw: bytes):
+        """Yields (key, encoded value or None when deleted, offset of the value) from raw record data until the data ends or is truncated"""
+        i = 0
+        size = self.header.size
+        while i + size <= len(raw):
+            (k,) = self.header.unpack_from(raw, i)
+            if i + size + k + size > len(raw): return
+            key = raw[i + size:i + size + k].decode("utf-8")
+            i += size + k
+            (v,) = self.header.unpack_from(raw, i)
+            i += size
+            if v == self.DELETED:
+                yield key, None, i
+                continue
+            if i + v > len(raw): return
+            yield key, raw[i:i + v], i
+            i += v
+
+    def writeRecord(self, f, key: str, value: Optional[bytes]) -> int:
+        """Writes a record and returns the offset of its value in the file"""
+        k = key.encode("utf-8")
+        f.write(self.header.pack(len(k)) + k)
+        if value is None: 
+            f.write(self.header.pack(self.DELETED))
+            return -1
+        f.write(self.header.pack(len(value)))
+        offset = f.tell()
+        f.write(value)
+        return offset
+
+    def start(self) -> None:
+        """Starts the writer thread and the periodic flush. Must be called from the event loop."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writer, name="store-writer", daemon=True)
+            self.thread.start()
+        if self.task is None: self.task = asyncio.ensure_future(self.flushPeriodically())
+
+    def get(self, key: str, default: Any=None) -> Any:
+        """Returns the value of the key, or default if it does not exist. Evicted values are read from disk, and stay evicted."""
+        if key in self.data: return self.data[key]
+        if key in self.cold: return self.readCold(key)
+        return default
+
+    def contains(self, key: str) -> bool:
+        """Returns whether the key exists, without reading an evicted value"""
+        return key in self.data or key in self.cold
+
+    async def fetch(self, key: str, default: Any=None) -> Any:
+        """Returns the value of the key like get, but reads evicted values in the default executor"""
+        if key not in self.cold or key in self.data: return self.get(key, default)
+        try: value = await asyncio.get_event_loop().run_in_executor(None, self.readCold, key)
+        except KeyError: value = default
+        # The key may have been put or deleted while it was read
+        if key in self.data: return self.data[key]
+        return value if key in self.cold else default
+
+    def readCold(self, key: str) -> Any:
+        with self.lock:
+            path, offset, length, _ = self.locations[key]
+            with open(path, "rb") as f:
+                f.seek(offset)
+                value = f.read(length)
+        self.stats["coldReads"] += 1
+        return self.serializer.loads(value)
+
+    def load(self, key: str, default: Any=None) -> Any:
+        """Returns the value of the key. Keys that were never stored are migrated from the legacy {key}.json file if it exists, otherwise default is returned."""
+        if self.contains(key): return self.get(key)
+        if key in self.legacy:
+            # Only reached for files migrateLegacy has not read yet
+            self.legacy.discard(key)
+            self.put(key, loadJSON(key + ".json"))
+            return self.data[key]
+        return default
+
+    def keys(self, prefix: str) -> List[str]:
+        """Returns all keys that start with prefix, including evicted ones"""
+        return [k for k in self.data if k.startswith(prefix)] + [k for k in self.cold if k.startswith(prefix) and k not in self.data]
+
+    def items(self, prefix: str) -> List[tuple[str, Any]]:
+        """Returns all (key, value) pairs whose key starts with prefix. Evicted values are read from disk."""
+        return [(k, self.get(k)) for k in self.keys(prefix)]
+
+    def put(self, key: str, value: Any) -> None:
+        """Marks the key as changed. The value is encoded at the next flush, so objects that are mutated in place only need to be put again. Cancels a pending eviction."""
+        self.data[key] = value
+        self.dirty.add(key)
+        self.legacy.discard(key)
+        self.evicting.discard(key)
+        self.stats["puts"] += 1
+
+    def delete(self, key: str) -> None:
+        """Removes the key"""
+        self.legacy.discard(key)
+        self.evicting.discard(key)
+        if key not in self.data and key not in self.encoded and key not in self.cold: return
+        self.data.pop(key, None)
+        with self.lock: self.cold.discard(key)
+        self.dirty.add(key)
+
+    def evict(self, key: str) -> None:
+        """Drops the value of the key from memory once it is written to disk. Accessing it afterwards reads it from disk, until it is put again."""
+        if key in self.data: self.evicting.add(key)
+
+    def flush(self) -> None:
+        """Encodes every changed value and hands the ones that differ from what was last written to the writer thread. Then evicts the values that were written since they were marked for eviction."""
+        if self.dirty:
+            changes = []
+            for key in self.dirty:
+                value = self.serializer.dumps(self.data[key]) if key in self.data else None
+                if value is not None and self.encoded.get(key) == value:
+                    self.stats["skipped"] += 1
+                    continue
+                changes.append((key, value))
+            self.dirty.clear()
+            batch = []
+            with self.lock:
+                for key, value in changes:
+                    self.sequence += 1
+                    if value is None: 
+                        self.encoded.pop(key, None)
+                        self.versions.pop(key, None)
+                    else: 
+                        self.encoded[key] = value
+                        self.versions[key] = self.sequence
+                    self.cold.discard(key)
+                    batch.append((key, value, self.sequence))
+            if batch: self.queue.put(batch)
+
+        for key in list(self.evicting):
+            with self.lock:
+                location = self.locations.get(key)
+                if location is None or location[3] != self.versions.get(key, 0) or key not in self.encoded: continue
+                del self.encoded[key]
+                self.cold.add(key)
+            self.evicting.discard(key)
+            del self.data[key]
+            self.stats["evicted"] += 1
+
+    async def flushPeriodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            try: self.flush()
+            except Exception: traceback.print_exc()
+
+    def writer(self) -> None:
+        """Body of the writer thread. Appends batches to the journal and compacts it once it grows too long."""
+        while True:
+            batch = self.queue.get()
+            if batch is None: return
+            try:
+                self.append(batch)
+                if self.journalLength >= self.compactEvery: self.compact()
+            except Exception: traceback.print_exc()
+
+    def append(self, batch: List[tuple[str, Optional[bytes], int]]) -> None:
+        """Appends a batch of (key, encoded value or None, version) to the journal and records where the values were written"""
+        path = self.journalPath()
+        written = []
+        with open(path, "ab") as f:
+            for key, value, version in batch: written.append((key, self.writeRecord(f, key, value), value, version))
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            for key, offset, value, version in written:
+                if value is None: self.locations.pop(key, None)
+                else: self.locations[key] = (path, offset, len(value), version)
+        self.journalLength += len(batch)
+        self.stats["written"] += len(batch)
+
+    def compact(self) -> None:
+        """Atomically writes every current value to the snapshot and empties the journal. Evicted values are copied from where they were last written. Only called from the writer thread or after it stopped."""
+        with self.lock:
+            encoded = dict(self.encoded)
+            versions = dict(self.versions)
+            cold = {k: self.locations[k] for k in self.cold}
+        path = self.snapshotPath()
+        tmp = path + ".tmp"
+        locations = {}
+        files = {}
+        try:
+            with open(tmp, "wb") as f:
+                for key, value in encoded.items(): locations[key] = (path, self.writeRecord(f, key, value), len(value), versions.get(key, 0))
+                for key, (source, offset, length, version) in cold.items():
+                    if source not in files: files[source] = open(source, "rb")
+                    files[source].seek(offset)
+                    locations[key] = (path, self.writeRecord(f, key, files[source].read(length)), length, version)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            for x in files.values(): x.close()
+        with self.lock:
+            os.replace(tmp, path)
+            open(self.journalPath(), "wb").close()
+            self.locations = locations
+        self.journalLength = 0
+        self.stats["compactions"] += 1
+
+    def close(self) -> None:
+        """Flushes all changes, stops the writer thread and compacts the journal. Blocks until everything is on disk."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        else:
+            # Nothing was started, so write the pending batches here
+            while not self.queue.empty():
+                batch = self.queue.get()
+                if batch is None: continue
+                self.append(batch)
+        self.compact()
@@ -0,0 +1,71 @@
+from typing import Any, Callable, List, Optional
+
+# Scopes of commands. General commands may run anywhere, server commands require a context, and privileged commands require a custodian.
+GENERAL = "general"
+SERVER = "server"
+PRIVILEGED = "privileged"
+
+class CommandInfo:
+    """Data class that describes a registered command"""
+    def __init__(self, handler: Callable, name: str, scope: str, aliases: List[str], description: Optional[str], metadata: dict[str, Any]):
+        self.handler = handler
+        self.name = name
+        self.scope = scope
+        self.aliases = aliases
+        self.description = description
+        self.metadata = metadata
+
+def command(scope: str, *, name: Optional[str]=None, aliases: List[str]=(), **metadata) -> Callable:
+    """Decorator that marks a function as a command in the given scope. The name defaults to the function name without the command_ prefix. Extra keyword arguments are kept as metadata."""
+    if scope not in (GENERAL, SERVER, PRIVILEGED): raise ValueError(f"Unknown command scope {scope}")
+    def decorator(function: Callable) -> Callable:
+        n = function.__name__
+        if n.startswith("command_"): n = n[len("command_"):]
+        function.commandInfo = CommandInfo(function, (name or n).lower(), scope, [x.lower() for x in aliases], function.__doc__, metadata)
+        return function
+    return decorator
+
+class CommandRegistry:
+    """An immutable table of commands. Invoked names and aliases map directly to their command, and a prefix trie over the names suggests commands for unknown names. Build a new registry to pick up changes."""
+    def __init__(self, *classes: type):
+        """Collects the decorated commands of the given classes. Raises ValueError if two commands share a name or alias, in which case nothing is replaced."""
+        self.commands = [] # type: list[CommandInfo]
+        self.dispatch = {} # type: dict[str, CommandInfo]
+        self.trie = {} # type: dict[str, Any]
+        for cls in classes:
+            for x in vars(cls).values():
+                info = getattr(x, "commandInfo", None)
+                if info is None: continue
+                self.commands.append(info)
+                for n in [info.name] + info.aliases:
+                    if n in self.dispatch: raise ValueError(f"Command name {n} is used by both {self.dispatch[n].handler.__qualname__} and {info.handler.__qualname__}")
+                    self.dispatch[n] = info
+                    self.insert(n)
+
+    def insert(self, name: str) -> None:
+        node = self.trie
+        for c in name: node = node.setdefault(c, {})
+        node[""] = name
+
+    def get(self, name: str) -> Optional[CommandInfo]:
+        """Returns the command with the given name or alias, or None"""
+        return self.dispatch.get(name)
+
+    def suggest(self, name: str, allowed: Callable[[CommandInfo], bool]=lambda x: True, limit: int=3) -> List[str]:
+        """Returns up to limit command names that share the longest prefix with name, if that prefix is at least half of the name or two characters long"""
+        node = self.trie
+        depth = 0
+        for c in name:
+            if c not in node: break
+            node = node[c]
+            depth += 1
+        if depth == 0 or (depth < 2 and depth * 2 < len(name)): return []
+        found = []
+        stack = [node]
+        while stack and len(found) < limit:
+            n = stack.pop()
+            for k in sorted(n, reverse=True):
+                if k == "":
+                    if allowed(self.dispatch[n[k]]): found.append(n[k])
+                else: stack.append(n[k])
+        return sorted(set(self.dispatch[x].name for x in found))[:limit]
@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import hashlib
+import json
+import time
+
+import aiohttp
+
+from typing import Any, Optional
+
+class PistonError(Exception):
+    """Raised when Piston rejects a request or cannot be reached. The message is the reason Piston gave, if any."""
+
+class PistonRunner:
+    """Runs code on a Piston server. Requests share one pooled session and are limited to the server's max_concurrent_jobs. The runtimes are cached for a while so aliases resolve locally, identical requests that are in flight share one job, and finished results are cached by a hash of the request."""
+    def __init__(self, url: str="http://127.0.0.1:2000", concurrency: int=64, runtimesTTL: float=300.0, cacheSize: int=256, timeout: float=30.0):
+        self.url = url.rstrip("/") + "/api/v2/"
+        self.concurrency = concurrency
+        self.runtimesTTL = runtimesTTL
+        self.cacheSize = cacheSize
+        self.timeout = timeout
+        self.session = None # type: aiohttp.ClientSession
+        self.slots = asyncio.Semaphore(concurrency)
+        self.runtimes = [] # type: list[dict[str, Any]]
+        self.runtimesAt = None # type: float
+        self.runtimesFetch = None # type: asyncio.Future
+        self.aliases = {} # type: dict[str, tuple[str, str]] # Language names and aliases to the language and its latest version
+        self.cache = collections.OrderedDict() # type: collections.OrderedDict[str, dict[str, Any]]
+        self.inflight = {} # type: dict[str, asyncio.Future]
+        self.stats = {"jobs": 0, "cached": 0, "coalesced": 0, "errors": 0, "runtimes": 0}
+
+    def getSession(self) -> aiohttp.ClientSession:
+        """Returns the shared session, creating it on first use. Must be called from the event loop."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def request(self, method: str, path: str, body: Any=None) -> Any:
+        """Sends a request to the API and returns the JSON response. Raises PistonError if it fails."""
+        try:
+            async with self.getSession().request(method, self.url + path, json=body) as r:
+                data = await r.json(content_type=None)
+                if r.status >= 400: raise PistonError(data.get("message", f"HTTP {r.status}") if isinstance(data, dict) else f"HTTP {r.status}")
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e: raise PistonError(f"Piston could not be reached: {type(e).__name__} {e}")
+
+    async def getRuntimes(self) -> list[dict[str, Any]]:
+        """Returns the installed runtimes, fetching them if the cached list expired. Concurrent callers share one fetch."""
+        if self.runtimesAt is not None and time.monotonic() - self.runtimesAt < self.runtimesTTL: return self.runtimes
+        if self.runtimesFetch is None:
+            self.runtimesFetch = asyncio.ensure_future(self.fetchRuntimes())
+            self.runtimesFetch.add_done_callback(lambda f: setattr(self, "runtimesFetch", None))
+        return await asyncio.shield(self.runtimesFetch)
+
+    async def fetchRuntimes(self) -> list[dict[str, Any]]:
+        runtimes = await self.request("GET", "runtimes")
+        self.stats["runtimes"] += 1
+        aliases = {}
+        for x in sorted(runtimes, key=lambda x: versionKey(x["version"])):
+            # Later versions replace earlier ones
+            for name in [x["language"], *x.get("aliases", [])]: aliases[name.lower()] = (x["language"], x["version"])
+        self.runtimes, self.aliases, self.runtimesAt = runtimes, aliases, time.monotonic()
+        return runtimes
+
+    async def resolve(self, language: str, version: Optional[str]=None) -> tuple[str, str]:
+        """Returns the language and version a language name or alias refers to. Without a version, the latest installed one is used. Raises PistonError if the language is not installed."""
+        await self.getRuntimes()
+        x = self.aliases.get(language.lower())
+        if x is None: raise PistonError(f"{language} is not an installed language")
+        return x[0], version or x[1]
+
+    async def execute(self, language: str, files: list[dict[str, str]], stdin: str="", args: Optional[list[str]]=None, version: Optional[str]=None) -> tuple[dict[str, Any], bool]:
+        """Runs the files and returns the result of the job, and whether it came from the cache. Raises PistonError if Piston rejected the job."""
+        language, version = await self.resolve(language, version)
+        body = {"language": language, "version": version, "files": files, "stdin": stdin, "args": args or []}
+        key = hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+            self.stats["cached"] += 1
+            return result, True
+        future = self.inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future), False
+        future = self.inflight[key] = asyncio.ensure_future(self.run(key, body))
+        future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        return await asyncio.shield(future), False
+
+    async def run(self, key: str, body: dict[str, Any]) -> dict[str, Any]:
+        async with self.slots:
+            self.stats["jobs"] += 1
+            try: result = await self.request("POST", "execute", body)
+            except PistonError:
+                self.stats["errors"] += 1
+                raise
+        self.cache[key] = result
+        if len(self.cache) > self.cacheSize: self.cache.popitem(last=False)
+        return result
+
+    async def close(self) -> None:
+        """Closes the session. It is created again if the runner is used afterwards."""
+        if self.session is not None: await self.session.close()
+        self.session = None
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the runner"""
+        s = self.stats
+        return f"{s['jobs']} jobs ({s['errors']} failed), {s['cached']} cached, {s['coalesced']} coalesced, {len(self.runtimes)} runtimes"
+
+def versionKey(version: str) -> tuple:
+    """Returns a key that sorts version strings numerically"""
+    return tuple(int(x) if x.isdigit() else 0 for x in version.split("."))
@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import time
+import traceback
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+from static import *
+from util import *
+
+class LaneMetrics:
+    """Counters of a single scheduler lane"""
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.shed = 0
+        self.limited = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+class CommandScheduler:
+    """Runs commands on a fixed number of workers. Commands wait in bounded lanes, and the privileged lane is always served first. Users and guilds are rate limited with token buckets, except in the privileged lane."""
+    PRIVILEGED = "privileged"
+    NORMAL = "normal"
+
+    def __init__(self, bot, concurrency: int=4, queueSize: int=64, userRate: float=0.5, userBurst: float=5, guildRate: float=5, guildBurst: float=20):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queueSize = queueSize
+        self.userRate, self.userBurst = userRate, userBurst
+        self.guildRate, self.guildBurst = guildRate, guildBurst
+        self.lanes = {self.PRIVILEGED: collections.deque(), self.NORMAL: collections.deque()} # type: dict[str, collections.deque]
+        self.metrics = {self.PRIVILEGED: LaneMetrics(), self.NORMAL: LaneMetrics()}
+        self.userBuckets = {} # type: dict[int, TokenBucket]
+        self.guildBuckets = {} # type: dict[int, TokenBucket]
+        self.pending = asyncio.Semaphore(0)
+        self.running = 0
+        self.workers = [] # type: list[asyncio.Task]
+
+    def start(self) -> None:
+        """Starts the workers. Must be called from the event loop."""
+        while len(self.workers) < self.concurrency: self.workers.append(asyncio.ensure_future(self.worker()))
+
+    def stop(self) -> None:
+        """Stops the workers. Queued commands are dropped. A command that stops the scheduler from a worker, such as shutdown, runs to completion."""
+        for x in self.workers: 
+            if x is not asyncio.current_task(): x.cancel()
+        self.workers = []
+
+    def bucket(self, buckets: dict[int, TokenBucket], id: int, rate: float, burst: float) -> TokenBucket:
+        if id not in buckets:
+            # Forget idle buckets so the tables do not grow with every user ever seen
+            if len(buckets) >= 10000:
+                for k in [k for k,v in buckets.items() if v.full()]: del buckets[k]
+            buckets[id] = TokenBucket(rate, burst)
+        return buckets[id]
+
+    async def submit(self, event: CommandEvent, privileged: bool, known: bool=True, addressed: bool=True) -> bool:
+        """Queues a command event. Returns whether it was accepted. Rejected commands that are known get a single busy or rate limit response. Unknown commands that were not addressed to the bot are chat in whitelisted channels, which is not answered, so they are dropped without using up a queue slot or the budget of users and guilds. Unknown commands that were addressed are answered, so they are rate limited like known ones."""
+        if not known and not addressed: return False
+        lane = self.PRIVILEGED if privileged else self.NORMAL
+        m = self.metrics[lane]
+        m.submitted += 1
+        if not privileged:
+            user = self.bucket(self.userBuckets, event.user.id, self.userRate, self.userBurst)
+            guild = self.bucket(self.guildBuckets, event.message.guild.id, self.guildRate, self.guildBurst) if event.message.guild is not None else None
+            # Both buckets are checked before taking from either, so a command the guild rejects does not use up the user's budget
+            limited = user if not user.available() else guild if guild is not None and not guild.available() else None
+            if limited is None:
+                user.take()
+                if guild is not None: guild.take()
+            else:
+                m.limited += 1
+                if not limited.warned:
+                    limited.warned = True
+                    await event.sendResponse("You are sending commands too quickly. Try again in a few seconds." if limited is user else "This server is sending commands too quickly. Try again in a few seconds.")
+                return False
+        q = self.lanes[lane]
+        if privileged and self.running >= self.concurrency:
+            # Every worker is busy, so privileged commands run beside them rather than waiting
+            asyncio.ensure_future(self.run(lane, time.monotonic(), event))
+            return True
+        if len(q) >= self.queueSize:
+            m.shed += 1
+            if known: await event.sendResponse("The bot is busy right now. Try again in a moment.")
+            return False
+        q.append((time.monotonic(), event))
+        m.maxDepth = max(m.maxDepth, len(q))
+        self.pending.release()
+        return True
+
+    async def worker(self) -> None:
+        while True:
+            await self.pending.acquire()
+            lane = self.PRIVILEGED if self.lanes[self.PRIVILEGED] else self.NORMAL
+            queued, event = self.lanes[lane].popleft()
+            await self.run(lane, queued, event)
+
+    async def run(self, lane: str, queued: float, event: CommandEvent) -> None:
+        m = self.metrics[lane]
+        m.started += 1
+        wait = time.monotonic() - queued
+        m.totalWait += wait
+        m.maxWait = max(m.maxWait, wait)
+        self.running += 1
+        try: await self.bot.call_command(event)
+        except asyncio.CancelledError: raise
+        except Exception: traceback.print_exc()
+        finally:
+            self.running -= 1
+            m.completed += 1
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the lanes"""
+        r = [f"{self.running}/{self.concurrency} workers busy"]
+        for name, m in self.metrics.items():
+            avg = m.totalWait / m.started * 1000 if m.started else 0
+            r.append(f"{name}: {len(self.lanes[name])} queued (max {m.maxDepth}), {m.submitted} submitted, {m.completed} done, {m.shed} shed, {m.limited} rate limited, wait avg {avg:.1f}ms max {m.maxWait * 1000:.1f}ms")
+        return "\n".join(r)
@@ -0,0 +1,37 @@
+import collections
+import time
+
+from typing import Optional
+
+def shardOf(guildID: int, shardCount: Optional[int]) -> int:
+    """Returns the shard that receives the events of a guild, using discord's sharding formula"""
+    return (guildID >> 22) % shardCount if shardCount else 0
+
+class ShardState:
+    """Data class for the readiness and activity of a single shard"""
+    window = 60 # Seconds the event rate is averaged over
+
+    def __init__(self, id: int):
+        self.id = id
+        self.ready = False
+        self.readyAt = None # type: float
+        self.connects = 0
+        self.resumes = 0
+        self.events = 0
+        self.recent = collections.deque() # type: collections.deque[list[int]] # [second, events] of each second in the window that had events
+        self.created = time.monotonic()
+
+    def recordEvent(self) -> None:
+        """Counts an event received by the shard"""
+        self.events += 1
+        second = int(time.monotonic())
+        if self.recent and self.recent[-1][0] == second: self.recent[-1][1] += 1
+        else: self.recent.append([second, 1])
+        while self.recent[0][0] <= second - self.window: self.recent.popleft()
+
+    def eventRate(self) -> float:
+        """Returns the number of events per second over the last window"""
+        now = time.monotonic()
+        events = sum(n for second, n in self.recent if second > now - self.window)
+        span = min(self.window, now - self.created)
+        return events / span if span > 0 else 0.0
@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import signal
+import sys
+import time
+import traceback
+
+from typing import Any, Optional
+
+import ipc
+
+# States of a deployment as seen by the supervisor
+STARTING = "starting"
+RUNNING = "running"
+STOPPING = "stopping"
+STOPPED = "stopped"
+FAILED = "failed"
+
+class ManagedDeployment:
+    """Data class for the supervisor's state of a single deployment process"""
+    def __init__(self, id: str, module: str, token: str):
+        self.id = id
+        self.module = module
+        self.token = token
+        self.state = STOPPED
+        self.process = None # type: asyncio.subprocess.Process
+        self.connection = None # type: ipc.Connection
+        self.waiter = None # type: asyncio.Task
+        self.startedAt = None # type: float
+        self.restarts = 0
+        self.crashes = 0 # Consecutive crashes, which back off the next start
+        self.failedChecks = 0
+        self.rtt = None # type: Optional[float] # Round trip of the last health check in seconds
+        self.health = {} # type: dict[str, Any] # Last health report of the deployment
+        self.restartQueued = False
+        self.successor = None # type: asyncio.subprocess.Process # Process that is taking over through a handoff
+        self.successorConnection = None # type: ipc.Connection
+
+    def describe(self) -> dict[str, Any]:
+        """Returns the state of the deployment as sent to every deployment"""
+        return {
+            "module": self.module,
+            "state": self.state,
+            "pid": self.process.pid if self.process is not None and self.process.returncode is None else None,
+            "startedAt": self.startedAt,
+            "restarts": self.restarts,
+            "rtt": self.rtt,
+            "latency": self.health.get("latency"),
+            "lag": self.health.get("lag"),
+            "guilds": self.health.get("guilds"),
+            "handoff": self.successor is not None,
+        }
+
+class Supervisor:
+    """Runs deployments as child processes and talks to them over a Unix socket with the ipc protocol. Deployments are checked periodically and restarted when they stop answering or crash, and every deployment is sent the state of all deployments whenever it changes."""
+    def __init__(self, socketPath: str="supervisor.sock", healthInterval: float=15.0, healthTimeout: float=5.0, maxFailedChecks: int=3, startupTimeout: float=180.0, stopTimeout: float=30.0):
+        self.socketPath = os.path.abspath(socketPath)
+        self.healthInterval = healthInterval
+        self.healthTimeout = healthTimeout
+        self.maxFailedChecks = maxFailedChecks
+        self.startupTimeout = startupTimeout
+        self.stopTimeout = stopTimeout
+        self.deployments = {} # type: dict[str, ManagedDeployment]
+        self.ids = itertools.count(1)
+        self.server = None # type: asyncio.AbstractServer
+        self.closing = False
+
+    async def serve(self, initial: list[tuple[str, str]]) -> None:
+        """Starts the given (module, token) deployments and supervises them until SIGINT or SIGTERM, then stops every deployment"""
+        if os.path.exists(self.socketPath): os.remove(self.socketPath)
+        self.server = await asyncio.start_unix_server(self.accept, path=self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        stop = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for s in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(s, stop.set)
+        for module, token in initial: await self.start(module, token)
+        checker = asyncio.ensure_future(self.checkPeriodically())
+        await stop.wait()
+        print("Stopping all deployments")
+        self.closing = True
+        checker.cancel()
+        await asyncio.gather(*[self.stop(x) for x in list(self.deployments)], return_exceptions=True)
+        self.server.close()
+        os.remove(self.socketPath)
+
+    def describe(self) -> dict[str, dict[str, Any]]:
+        """Returns the state of every deployment by id"""
+        return {k: v.describe() for k,v in self.deployments.items()}
+
+    def broadcast(self) -> None:
+        """Sends the state of every deployment to every connected deployment, so they can list deployments without asking"""
+        state = self.describe()
+        for x in self.deployments.values():
+            if x.connection is not None: x.connection.notify("deployments", state)
+
+    async def start(self, module: str, token: str="token") -> str:
+        """Starts a new deployment of a module and returns its id. The module is a directory containing deploy.py."""
+        if not os.path.isfile(os.path.join(module, "deploy.py")): raise ValueError(f"{module} is not a deployment module")
+        d = ManagedDeployment(str(next(self.ids)), module, token)
+        self.deployments[d.id] = d
+        await self.spawn(d)
+        return d.id
+
+    async def stop(self, id: str) -> None:
+        """Stops a deployment. It is asked to shut down first, and killed if it does not exit in time."""
+        d = self.get(id)
+        d.restartQueued = False
+        if d.successor is not None and d.successor.returncode is None: d.successor.kill()
+        if d.process is None or d.process.returncode is not None:
+            d.state = STOPPED
+            self.broadcast()
+            return
+        d.state = STOPPING
+        self.broadcast()
+        await self.terminate(d)
+
+    async def restart(self, id: str) -> None:
+        """Stops a deployment and starts it again in a new process"""
+        d = self.get(id)
+        if d.process is None or d.process.returncode is not None:
+            # Stopped and crashed deployments are started right away
+            d.restarts += 1
+            return await self.spawn(d)
+        d.restartQueued = True
+        await self.terminate(d)
+
+    async def handoff(self, id: str) -> None:
+        """Starts a successor process that takes over from a running deployment once it is ready. The deployment keeps serving until then. Returns once the successor was started."""
+        d = self.get(id)
+        if d.state != RUNNING or d.connection is None: raise RuntimeError(f"Deployment {id} is not running")
+        if d.successor is not None: raise RuntimeError(f"Deployment {id} is already handing off")
+        path = os.path.join(os.path.dirname(self.socketPath), f"handoff-{d.id}.sock")
+        await d.connection.request("prepareHandoff", {"path": path}, timeout=self.healthTimeout)
+        # If the deployment exits without being replaced, it is started again without a snapshot
+        d.restartQueued = True
+        d.successor = await self.createProcess(d, path)
+        print(f"Handing off deployment {d.id} to process {d.successor.pid}")
+        asyncio.ensure_future(self.waitSuccessor(d, d.successor))
+        self.broadcast()
+
+    def promote(self, d: ManagedDeployment) -> None:
+        """Makes the successor of a deployment its process once the successor is running"""
+        old = d.process
+        d.process, d.connection = d.successor, d.successorConnection
+        d.successor = d.successorConnection = None
+        d.restartQueued = False
+        d.state = RUNNING
+        d.startedAt = time.time()
+        d.restarts += 1
+        d.failedChecks = 0
+        d.health = {}
+        d.waiter = asyncio.ensure_future(self.wait(d))
+        asyncio.ensure_future(self.retire(old))
+        print(f"Deployment {d.id} was handed off to process {d.process.pid}")
+        self.broadcast()
+
+    async def retire(self, process: asyncio.subprocess.Process) -> None:
+        """Waits for a process that handed off to exit, and kills it if it does not"""
+        try: await asyncio.wait_for(process.wait(), self.stopTimeout)
+        except asyncio.TimeoutError: 
+            process.kill()
+            await process.wait()
+
+    async def waitSuccessor(self, d: ManagedDeployment, process: asyncio.subprocess.Process) -> None:
+        """Cancels a handoff if the successor exits or does not start in time. The deployment resumes serving unless it already stopped for the successor, in which case it is started again."""
+        try: code = await asyncio.wait_for(process.wait(), self.startupTimeout)
+        except asyncio.TimeoutError:
+            if d.successor is not process: return
+            print(f"Successor of deployment {d.id} did not start in {self.startupTimeout:g}s")
+            process.kill()
+            code = await process.wait()
+        if d.successor is not process: return
+        print(f"Handoff of deployment {d.id} failed, its successor exited with code {code}")
+        if d.successorConnection is not None: d.successorConnection.close()
+        d.successor = d.successorConnection = None
+        if d.process.returncode is not None:
+            # The deployment already exited for the successor, and its waiter left the decision to this one
+            if not self.closing and d.restartQueued:
+                d.restartQueued = False
+                d.restarts += 1
+                await self.spawn(d)
+            return
+        if d.connection is not None:
+            try: 
+                if (await d.connection.request("cancelHandoff", timeout=self.healthTimeout))["resumed"]: d.restartQueued = False
+            except Exception: traceback.print_exc()
+        self.broadcast()
+
+    def get(self, id: str) -> ManagedDeployment:
+        if id not in self.deployments: raise KeyError(f"{id} is not a deployment")
+        return self.deployments[id]
+
+    async def createProcess(self, d: ManagedDeployment, handoffPath: Optional[str]=None) -> asyncio.subprocess.Process:
+        # The token is passed in the environment so it does not show up in the process list
+        env = dict(os.environ, DEPLOYMENT_TOKEN=d.token)
+        if handoffPath is not None: env["DEPLOYMENT_HANDOFF"] = handoffPath
+        return await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "child", d.module, d.id, self.socketPath, env=env)
+
+    async def spawn(self, d: ManagedDeployment) -> None:
+        d.state = STARTING
+        d.startedAt = time.time()
+        d.failedChecks = 0
+        d.health = {}
+        d.rtt = None
+        d.process = await self.createProcess(d)
+        print(f"Started deployment {d.id} ({d.module}) as process {d.process.pid}")
+        d.waiter = asyncio.ensure_future(self.wait(d))
+        self.broadcast()
+
+    async def terminate(self, d: ManagedDeployment) -> None:
+        if d.process is None or d.process.returncode is not None: return
+        if d.connection is not None:
+            try: await d.connection.request("shutdown", timeout=self.healthTimeout)
+            except Exception: pass
+        try: await asyncio.wait_for(d.process.wait(), self.stopTimeout)
+        except asyncio.TimeoutError:
+            print(f"Deployment {d.id} did not shut down in time, killing it")
+            d.process.kill()
+            await d.process.wait()
+
+    async def wait(self, d: ManagedDeployment) -> None:
+        """Waits for the process of a deployment to exit and decides whether to start it again"""
+        process = d.process
+        code = await process.wait()
+        # A process that handed off was replaced by its successor, which has its own waiter
+        if d.process is not process: return
+        if d.connection is not None: d.connection.close()
+        d.connection = None
+        # The process stopped for a successor that has not reported running yet. Either promote makes the successor the process, or waitSuccessor starts the deployment again if the successor fails.
+        if d.successor is not None: return
+        if self.closing or d.state == STOPPING: d.state = STOPPED
+        elif d.restartQueued:
+            d.restartQueued = False
+            d.restarts += 1
+            d.crashes = 0
+            await self.spawn(d)
+            return
+        elif code == 0: d.state = STOPPED
+        else:
+            d.crashes += 1
+            d.state = FAILED
+            delay = min(60, 2 ** d.crashes)
+            print(f"Deployment {d.id} exited with code {code}, starting it again in {delay}s")
+            self.broadcast()
+            await asyncio.sleep(delay)
+            if d.state != FAILED or self.closing or d.process is not process: return
+            d.restarts += 1
+            await self.spawn(d)
+            return
+        print(f"Deployment {d.id} stopped with code {code}")
+        self.broadcast()
+
+    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Accepts a connection from a deployment, which must introduce itself before anything else"""
+        c = ipc.Connection(reader, writer)
+        async def hello(body: dict[str, Any]) -> dict[str, dict[str, Any]]:
+            d = self.get(str(body["id"]))
+            if d.successor is not None and d.successor.pid == body["pid"]: 
+                d.successorConnection = c
+                c.handlers = self.handlers(d, d.successor)
+                return self.describe()
+            if d.process is None or d.process.pid != body["pid"]: raise PermissionError("The process does not belong to the deployment")
+            if d.connection is not None: d.connection.close()
+            d.connection = c
+            c.handlers = self.handlers(d, d.process)
+            return self.describe()
+        c.handlers["hello"] = hello
+        c.start()
+
+    def handlers(self, d: ManagedDeployment, process: asyncio.subprocess.Process) -> dict[str, Any]:
+        """Returns the operations a connected deployment process may request"""
+        async def running(body):
+            if process is d.successor: return self.promote(d)
+            d.state = RUNNING
+            d.crashes = 0
+            print(f"Deployment {d.id} is running")
+            self.broadcast()
+        async def queueRestart(body): d.restartQueued = True
+        async def start(body): return await self.start(body["module"], body.get("token", "token"))
+        async def stop(body): await self.stop(body["id"])
+        async def restart(body): await self.restart(body["id"])
+        async def handoff(body): await self.handoff(body["id"])
+        async def describe(body): return self.describe()
+        return {"running": running, "queueRestart": queueRestart, "start": start, "stop": stop, "restart": restart, "handoff": handoff, "list": describe}
+
+    async def checkPeriodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.healthInterval)
+            try:
+                await asyncio.gather(*[self.check(x) for x in list(self.deployments.values()) if x.state in (STARTING, RUNNING)])
+                self.broadcast()
+            except Exception: traceback.print_exc()
+
+    async def check(self, d: ManagedDeployment) -> None:
+        """Checks that a deployment answers on its event loop. Deployments that miss several checks in a row, or take too long to start, are restarted."""
+        if d.state == STARTING and time.time() - d.startedAt > self.startupTimeout:
+            print(f"Deployment {d.id} did not start in {self.startupTimeout:g}s, restarting it")
+            return await self.restart(d.id)
+        if d.connection is None: return
+        start = time.perf_counter()
+        try:
+            d.health = await d.connection.request("health", timeout=self.healthTimeout) or {}
+            d.rtt = time.perf_counter() - start
+            d.failedChecks = 0
+        except Exception as e:
+            d.failedChecks += 1
+            print(f"Health check {d.failedChecks}/{self.maxFailedChecks} of deployment {d.id} failed: {type(e).__name__} {e}")
+            if d.failedChecks >= self.maxFailedChecks:
+                print(f"Deployment {d.id} is not responding, restarting it")
+                await self.restart(d.id)
+
+class SupervisorClient:
+    """The manager of a deployment that runs under a supervisor. The state of all deployments is pushed by the supervisor, so listing them needs no request."""
+    def __init__(self, socketPath: str, id: str, handoffPath: Optional[str]=None):
+        self.socketPath = socketPath
+        self.id = id
+        self.handoffPath = handoffPath # Socket of the process this one takes over from, if any
+        self.handoffServer = None # type: asyncio.AbstractServer
+        self.bot = None
+        self.connection = None # type: ipc.Connection
+        self.deployments = {} # type: dict[str, dict[str, Any]]
+
+    async def connect(self) -> None:
+        """Connects to the supervisor and introduces the deployment"""
+        reader, writer = await asyncio.open_unix_connection(self.socketPath)
+        handlers = {"health": self.health, "shutdown": self.shutdown, "deployments": self.updateDeployments, "prepareHandoff": self.prepareHandoff, "cancelHandoff": self.cancelHandoff}
+        self.connection = ipc.Connection(reader, writer, handlers, self.disconnected).start()
+        self.deployments = await self.connection.request("hello", {"id": self.id, "pid": os.getpid()})
+
+    def disconnected(self) -> None:
+        # Without a supervisor nothing would restart or stop the deployment, so it shuts down with it
+        if self.bot is None or self.bot.is_closed(): return
+        print("Lost the connection to the supervisor, shutting down")
+        asyncio.ensure_future(self.bot.shutdown())
+
+    async def health(self, body: Any) -> dict[str, Any]:
+        if self.bot is None: return {"ready": False}
+        latency = self.bot.latency
+        return {
+            "ready": self.bot.isShardReady(None),
+            "latency": latency if math.isfinite(latency) else None,
+            "lag": self.bot.metrics.histogram("loop:lag").percentile(99),
+            "guilds": len(self.bot.guilds),
+        }
+
+    async def shutdown(self, body: Any) -> None:
+        if self.bot is not None: asyncio.ensure_future(self.bot.shutdown())
+
+    async def updateDeployments(self, body: dict[str, dict[str, Any]]) -> None: self.deployments = body
+
+    async def prepareHandoff(self, body: dict[str, Any]) -> None:
+        self.handoffServer = await self.bot.serveHandoff(body["path"])
+
+    async def cancelHandoff(self, body: Any) -> dict[str, bool]:
+        """Stops waiting for a successor. Returns whether the deployment is still serving, which it is unless the successor connected."""
+        if self.handoffServer is not None: self.handoffServer.close()
+        self.handoffServer = None
+        if not self.bot.serving: asyncio.ensure_future(self.bot.close())
+        return {"resumed": self.bot.serving}
+
+    def signalRunning(self) -> None:
+        """Tells the supervisor that the deployment finished logging in"""
+        self.connection.notify("running")
+
+    def queueRestart(self) -> None:
+        """Makes the supervisor start the deployment again once it exits"""
+        self.connection.notify("queueRestart")
+
+    def queueFullUpdate(self) -> None:
+        """Does nothing, as every restart starts a new process that loads all modules from disk"""
+
+    def reload(self, bot, module: str) -> bool:
+        """Reloads a module of the deployment in place"""
+        return bool(bot.reload(module))
+
+    async def start(self, module: str) -> str:
+        """Starts a new deployment of a module and returns its id. Raises ipc.RemoteError if it could not be started."""
+        return await self.connection.request("start", {"module": module})
+
+    async def stop(self, id: str) -> None:
+        """Stops a deployment. Raises ipc.RemoteError if it does not exist."""
+        await self.connection.request("stop", {"id": id})
+
+    async def restart(self, id: str) -> None:
+        """Restarts a deployment. Raises ipc.RemoteError if it does not exist."""
+        await self.connection.request("restart", {"id": id})
+
+    async def handoff(self) -> None:
+        """Starts a new process of this deployment, which takes over once it is ready. Raises ipc.RemoteError if a handoff is not possible."""
+        await self.connection.request("handoff", {"id": self.id})
+
+def runChild(module: str, id: str, socketPath: str) -> None:
+    """Runs a deployment under the supervisor. The deployment module is imported from its directory."""
+    sys.path.insert(0, os.path.abspath(module))
+    import deploy
+    client = SupervisorClient(socketPath, id, os.environ.get("DEPLOYMENT_HANDOFF"))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(client.connect())
+    cls = deploy.ShardedDeployment if getattr(deploy, "shardCount", None) else deploy.Deployment
+    client.bot = cls(client, os.environ.get("DEPLOYMENT_TOKEN", "token"))
+    client.bot.deploy()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs bot deployments as supervised child processes")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    run = sub.add_parser("run", help="Runs the supervisor")
+    run.add_argument("deployments", nargs="*", help="Deployments to start, as module or module:token")
+    run.add_argument("--socket", default="supervisor.sock", help="Path of the Unix socket deployments connect to")
+    run.add_argument("--health-interval", type=float, default=15.0, help="Seconds between health checks")
+    child = sub.add_parser("child", help="Runs a single deployment. Started by the supervisor.")
+    child.add_argument("module")
+    child.add_argument("id")
+    child.add_argument("socket")
+    args = parser.parse_args()
+    if args.mode == "child": runChild(args.module, args.id, args.socket)
+    else:
+        initial = [tuple(x.split(":", 1)) if ":" in x else (x, "token") for x in args.deployments]
+        asyncio.get_event_loop().run_until_complete(Supervisor(args.socket, healthInterval=args.health_interval).serve(initial))
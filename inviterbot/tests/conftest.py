@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# The bot imports its modules by name from its own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Runs every test in an empty directory, as the bot keeps its data relative to the working directory"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,113 @@
+import asyncio
+import builtins
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+
+import pytest
+
+import commands, messages, metrics, persistence, static, util
+
+# Calls that block the thread they are made on
+BLOCKING = [(builtins, "open"), (io, "open"), (os, "listdir"), (os, "scandir"), (os, "stat"), (os, "mkdir"), (os, "makedirs"), (os, "remove"), (subprocess, "run"), (subprocess, "call"), (subprocess, "check_output"), (time, "sleep")]
+
+@pytest.fixture
+def guard(monkeypatch):
+    """Returns a function that makes the blocking calls raise when they are made on a thread that runs an event loop. Executor threads are unaffected."""
+    def wrap(name, f):
+        def guarded(*args, **kwargs):
+            # Opening a file descriptor, such as a pipe, does not touch the disk
+            if args and isinstance(args[0], int): return f(*args, **kwargs)
+            try: asyncio.get_running_loop()
+            except RuntimeError: return f(*args, **kwargs)
+            raise AssertionError(f"{name} was called on the event loop")
+        return guarded
+    def enable():
+        for module, name in BLOCKING: monkeypatch.setattr(module, name, wrap(name, getattr(module, name)))
+    return enable
+
+class Events:
+    """Event handlers of rich messages that record their events"""
+    received = []
+    @staticmethod
+    def record(message, event, reply): Events.received.append((message.id, message.content, event))
+
+def makeBot(store):
+    async def resolveMessage(id, channel, fetch=False): return types.SimpleNamespace(id=id, channel=types.SimpleNamespace(id=channel), content=f"message {id}", embeds=[])
+    return types.SimpleNamespace(store=store, user=types.SimpleNamespace(id=1), metrics=metrics.Metrics(), lastPinTimestamps={}, get_channel=lambda c: None, resolveMessage=resolveMessage)
+
+def test_update_command(guard, monkeypatch):
+    run = asyncio.create_subprocess_exec
+    async def gitPull(*args, **kwargs): return await run(sys.executable, "-c", "print('Already up to date.')", **kwargs)
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", gitPull)
+    guard()
+    assert asyncio.run(commands.PrivilegedCommands.command_update(None)) == "No update was found."
+
+def test_store_lookups(guard):
+    os.makedirs(util.dataPath("settings"))
+    with open(util.dataPath("settings/5.json"), "w") as f: json.dump({"prefix": "?"}, f)
+    store = persistence.Store("state", flushInterval=0.01).recover()
+    guard()
+    async def main():
+        store.start()
+        # Missing keys are answered from memory
+        assert store.load("settings/7", {}) == {}
+        await store.migrateLegacy()
+        assert store.load("settings/5") == {"prefix": "?"}
+        store.put("settings/7", {"prefix": "!"})
+        await asyncio.sleep(0.05)
+        await asyncio.get_event_loop().run_in_executor(None, store.close)
+    asyncio.run(main())
+    assert persistence.Store("state").recover().get("settings/7") == {"prefix": "!"}
+
+def test_spilled_rich_message_events(guard, monkeypatch):
+    monkeypatch.setattr(static, "DiscordBotStatic", Events)
+    monkeypatch.setattr(util, "DiscordBotStatic", Events, raising=False)
+    Events.received.clear()
+    store = persistence.Store("state", flushInterval=0.01).recover()
+    guard()
+    async def main():
+        store.start()
+        h = messages.MessageHandler(makeBot(store))
+        h.richMessages.maxEntries = 2
+        for i in range(10):
+            m = util.RichMessage().setContent(f"message {i}")
+            m.channel = 9
+            m.setEventHandler("record")
+            h.richMessages[i] = m
+            h.persist(i, m)
+        await asyncio.sleep(0.05)
+        assert "messages/3" in store.cold
+        # Membership and get do not read from disk or put the message back into memory
+        assert 3 in h.richMessages and h.richMessages.get(3) is None
+        assert h.richMessages.stats["reloaded"] == 0 and 3 not in h.richMessages.entries
+        await h.onReactionActionEvent(types.SimpleNamespace(message_id=3))
+        await asyncio.get_event_loop().run_in_executor(None, store.close)
+        return store.stats["coldReads"]
+    assert asyncio.run(main()) == 1
+    assert [x[:2] for x in Events.received] == [(3, "message 3")]
+
+def test_blocking_detector():
+    async def main():
+        m = metrics.Metrics(blockingThreshold=0.05)
+        m.start()
+        await asyncio.sleep(0.05)
+        async def handler(name, seconds):
+            with m.track(name):
+                await asyncio.sleep(0)
+                time.sleep(seconds)
+                await asyncio.sleep(0.2)
+        # Stalls are attributed to the task that blocked, not to other tasks that are handling something
+        idle = asyncio.ensure_future(handler("event:idle", 0))
+        await handler("command:slow", 0.3)
+        await idle
+        m.stop()
+        return m
+    m = asyncio.run(main())
+    assert m.histogram("blocked:command:slow").count == 1
+    assert "blocked:event:idle" not in m.histograms
+    assert metrics.currentActivity.get() is None
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import runner
+
+RUNTIMES = [
+    {"language": "python", "version": "3.9.4", "aliases": ["py", "python3"]},
+    {"language": "python", "version": "3.10.0", "aliases": ["py", "python3"]},
+    {"language": "javascript", "version": "16.3.0", "aliases": ["node", "js"]},
+]
+
+class MockPiston:
+    """A Piston server that answers with the stdin of each job after a delay, and records how it was used"""
+    def __init__(self, delay: float=0.0):
+        self.delay = delay
+        self.runtimesCalls = 0
+        self.jobs = []
+        self.running = 0
+        self.maxRunning = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/v2/runtimes", self.runtimes)
+        app.router.add_post("/api/v2/execute", self.execute)
+        return app
+
+    async def runtimes(self, request: web.Request) -> web.Response:
+        self.runtimesCalls += 1
+        return web.json_response(RUNTIMES)
+
+    async def execute(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.jobs.append(body)
+        if body["stdin"] == "reject": return web.json_response({"message": "Rejected"}, status=400)
+        self.running += 1
+        self.maxRunning = max(self.maxRunning, self.running)
+        try: await asyncio.sleep(self.delay)
+        finally: self.running -= 1
+        return web.json_response({"language": body["language"], "version": body["version"], "run": {"stdout": body["stdin"], "stderr": "", "code": 0, "signal": None}})
+
+def withPiston(test, delay: float=0.0, **options):
+    """Runs test(runner, piston) against a mock Piston server and returns its result"""
+    async def main():
+        piston = MockPiston(delay)
+        server = TestServer(piston.app())
+        await server.start_server()
+        r = runner.PistonRunner(str(server.make_url("")), **options)
+        try: return await test(r, piston)
+        finally:
+            await r.close()
+            await server.close()
+    return asyncio.run(main())
+
+def test_aliases():
+    async def test(r, piston):
+        assert await r.resolve("py") == ("python", "3.10.0")
+        assert await r.resolve("Node") == ("javascript", "16.3.0")
+        assert await r.resolve("python3", "3.9.4") == ("python", "3.9.4")
+        with pytest.raises(runner.PistonError): await r.resolve("cobol")
+        result, _ = await r.execute("py", [{"content": "print(input())"}], "hello")
+        assert (result["language"], result["version"]) == ("python", "3.10.0")
+        assert piston.runtimesCalls == 1
+    withPiston(test)
+
+def test_runtimes_ttl():
+    async def test(r, piston):
+        await asyncio.gather(*[r.getRuntimes() for _ in range(5)])
+        await r.resolve("js")
+        assert piston.runtimesCalls == 1
+        await asyncio.sleep(0.15)
+        await r.resolve("js")
+        assert piston.runtimesCalls == 2
+    withPiston(test, runtimesTTL=0.1)
+
+def test_result_cache():
+    async def test(r, piston):
+        files = [{"content": "print(input())"}]
+        first, cached = await r.execute("py", files, "a")
+        assert not cached
+        again, cached = await r.execute("python", files, "a", version="3.10.0")
+        assert cached and again == first
+        _, cached = await r.execute("py", files, "b")
+        assert not cached
+        _, cached = await r.execute("py", files, "a", ["--flag"])
+        assert not cached
+        assert len(piston.jobs) == 3
+    withPiston(test)
+
+def test_result_cache_size():
+    async def test(r, piston):
+        for x in "abc": await r.execute("py", [{"content": ""}], x)
+        _, cached = await r.execute("py", [{"content": ""}], "a")
+        assert not cached and len(r.cache) == 2
+    withPiston(test, cacheSize=2)
+
+def test_inflight_coalescing():
+    async def test(r, piston):
+        results = await asyncio.gather(*[r.execute("py", [{"content": ""}], "same") for _ in range(5)])
+        assert len(piston.jobs) == 1
+        assert all(x == results[0][0] for x, _ in results)
+        assert r.stats["coalesced"] == 4 and not r.inflight
+    withPiston(test, delay=0.1)
+
+def test_concurrency_cap():
+    async def test(r, piston):
+        await asyncio.gather(*[r.execute("py", [{"content": ""}], str(i)) for i in range(6)])
+        assert len(piston.jobs) == 6
+        assert piston.maxRunning == 2
+    withPiston(test, delay=0.05, concurrency=2)
+
+def test_rejected_jobs():
+    async def test(r, piston):
+        for _ in range(2):
+            with pytest.raises(runner.PistonError, match="Rejected"): await r.execute("py", [{"content": ""}], "reject")
+        # Failures are not cached
+        assert len(piston.jobs) == 2 and r.stats["errors"] == 2
+    withPiston(test)
+
+def test_unreachable():
+    async def test():
+        r = runner.PistonRunner("http://127.0.0.1:9", timeout=2)
+        try:
+            with pytest.raises(runner.PistonError, match="could not be reached"): await r.getRuntimes()
+        finally: await r.close()
+    asyncio.run(test())
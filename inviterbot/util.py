@@ -1,18 +1,26 @@
+import asyncio
+import bisect
 import discord
 import os
+import time
 import json
+import re
 import datetime
 import traceback
 
-from typing import Any, Optional, Union
+from typing import Any, List, Optional, Union
 
 # from . import static
 # from .static import *
 
 from static import *
 
+def dataPath(file: str) -> str:
+    """Returns the path of a file in the bot's data directory"""
+    return "discordbot/" + file
+
 def loadJSON(file: str) -> dict:
-    file = "discordbot/" + file
+    file = dataPath(file)
     if os.path.isfile(file):
         try:
             with open(file) as f:
@@ -25,7 +33,78 @@ def loadJSON(file: str) -> dict:
     return {}
 
 def saveJSON(object: Any, file) -> None:
-    with open("discordbot/" + file,"w") as f: json.dump(object, f, indent=2)
+    with open(dataPath(file),"w") as f: json.dump(object, f, indent=2)
+
+class TokenBucket:
+    """A token bucket that refills at rate tokens per second up to capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "warned")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.warned = False # Whether the owner was told they are limited since the bucket last ran dry
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> bool:
+        """Returns whether a token can be taken, without taking it"""
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self) -> bool:
+        """Takes a token, returning whether one was available"""
+        self.refill()
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        self.warned = False
+        return True
+
+    def delay(self) -> float:
+        """Returns the number of seconds until a token is available"""
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+class RateLimitGate:
+    """Retries requests that were rate limited. Every worker that shares a gate pauses until the rate limit of any of them has passed."""
+    def __init__(self, retries: int=3):
+        self.retries = retries
+        self.resumeAt = 0.0 # Monotonic time before which no request may be sent
+        self.limited = 0 # Number of requests that were rate limited
+
+    async def call(self, function, *args, **kwargs) -> Any:
+        """Awaits function(*args, **kwargs), retrying up to the configured number of times on HTTP 429"""
+        for attempt in range(self.retries + 1):
+            delay = self.resumeAt - time.monotonic()
+            if delay > 0: await asyncio.sleep(delay)
+            try: return await function(*args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == self.retries: raise
+                self.limited += 1
+                retryAfter = float(getattr(e, "retry_after", None) or 2 ** attempt)
+                self.resumeAt = max(self.resumeAt, time.monotonic() + retryAfter)
+
+def parseTime(time: Union[str, datetime.datetime, None]) -> Optional[datetime.datetime]:
+    """Returns an ISO 8601 string or datetime as a naive datetime in UTC, the form the discord library uses"""
+    if time is None: return None
+    if isinstance(time, str): time = datetime.datetime.fromisoformat(time)
+    if time.tzinfo is not None: time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+# Permissions that could make a member a moderator of a server
+MODERATOR_PERMISSIONS = ("administrator", "manage_guild", "manage_roles", "manage_channels", "manage_messages", "kick_members", "ban_members")
+
+def moderatorPermissionsChanged(before: discord.Permissions, after: discord.Permissions) -> bool:
+    """Returns whether any permission that could make a member a moderator differs between the two permission sets"""
+    return any(getattr(before, x) != getattr(after, x) for x in MODERATOR_PERMISSIONS)
 
 def ensureSize(message: Union[str, discord.Embed]) -> Union[str, discord.Embed]:
     if message is None: return message
@@ -41,15 +120,112 @@ def ensureSize(message: Union[str, discord.Embed]) -> Union[str, discord.Embed]:
         return embed
     return message
 
+class NameIndex:
+    """Maps case-folded names to the ids of the objects that have them. Names are kept sorted so they can be queried by prefix."""
+    def __init__(self):
+        self.ids = {} # type: dict[str, set[int]]
+        self.names = {} # type: dict[int, frozenset[str]]
+        self.sorted = [] # type: list[str]
+
+    def put(self, id: int, *names: Optional[str]) -> None:
+        """Sets the names of the object with the given id, replacing its previous names. Empty names are ignored."""
+        folded = frozenset(x.casefold() for x in names if x)
+        if self.names.get(id) == folded: return
+        self.remove(id)
+        self.names[id] = folded
+        for x in folded:
+            if x not in self.ids:
+                self.ids[x] = set()
+                bisect.insort(self.sorted, x)
+            self.ids[x].add(id)
+
+    def build(self, items: List[tuple[int, tuple[Optional[str], ...]]]) -> None:
+        """Sets the names of many objects like put, but sorts the names once instead of inserting each. Used to index everything that is seen at ready."""
+        fresh = []
+        rebuild = False
+        for id, names in items:
+            folded = frozenset(x.casefold() for x in names if x)
+            previous = self.names.get(id)
+            if previous == folded: continue
+            for x in previous or ():
+                self.ids[x].discard(id)
+                if not self.ids[x]:
+                    del self.ids[x]
+                    rebuild = True
+            self.names[id] = folded
+            for x in folded:
+                if x not in self.ids:
+                    self.ids[x] = set()
+                    fresh.append(x)
+                self.ids[x].add(id)
+        if rebuild: self.sorted = sorted(self.ids)
+        elif fresh:
+            # Sorting two sorted runs merges them
+            self.sorted.extend(sorted(fresh))
+            self.sorted.sort()
+
+    def remove(self, id: int) -> None:
+        """Removes the object with the given id"""
+        for x in self.names.pop(id, ()):
+            self.ids[x].discard(id)
+            if not self.ids[x]:
+                del self.ids[x]
+                del self.sorted[bisect.bisect_left(self.sorted, x)]
+
+    def get(self, name: str) -> set[int]:
+        """Returns the ids of the objects with the given name"""
+        return self.ids.get(name.casefold(), set())
+
+    def prefix(self, prefix: str, limit: int=25) -> List[int]:
+        """Returns the ids of up to limit objects with a name starting with prefix, in order of their names"""
+        prefix = prefix.casefold()
+        r = []
+        for i in range(bisect.bisect_left(self.sorted, prefix), len(self.sorted)):
+            x = self.sorted[i]
+            if not x.startswith(prefix) or len(r) >= limit: break
+            r.extend(y for y in self.ids[x] if y not in r)
+        return r[:limit]
+
+class MessageRoute:
+    """Compiled rules that decide whether a message is a command, built from a server's settings. Without settings, only mentions of the bot are accepted."""
+    __slots__ = ("channels", "whitelist", "prefix")
+
+    def __init__(self, botID: int, settings: Optional[dict[str, Any]]=None):
+        self.channels = frozenset(int(x) for x in settings["channellist"]) if settings else frozenset()
+        self.whitelist = bool(settings["channellistiswhitelist"]) if settings else False
+        forms = [f"<@{botID}>", f"<@!{botID}>"]
+        if settings and settings["commandprefix"]: forms.append(settings["commandprefix"])
+        # Longest forms first so a prefix that starts with another is matched completely
+        self.prefix = re.compile("|".join(re.escape(x) for x in sorted(forms, key=len, reverse=True)))
+
+    def accepts(self, message: discord.Message) -> bool:
+        """Returns whether the message should be handled as a command"""
+        if message.channel.id in self.channels: return self.whitelist
+        return self.isAddressed(message.content)
+
+    def isAddressed(self, content: str) -> bool:
+        """Returns whether the content starts with the prefix or a mention of the bot"""
+        return self.prefix.match(content) is not None
+
+    def strip(self, content: str) -> str:
+        """Returns the content without the accepted prefix, if it has one"""
+        m = self.prefix.match(content)
+        return content[m.end():] if m else content
+
 class ServerContext:
     """Data class for a specific server"""
     def __init__(self, bot, guild: discord.Guild):
-        """Initializes a data class for a given guild, which must not be None. It will attempt to retrieve settings from settings/{id}.json"""
+        """Initializes a data class for a given guild, which must not be None. It will attempt to retrieve settings from the bot's store, or settings/{id}.json"""
         if guild is None: raise ValueError("Guild must not be None")
         self.bot = bot
         self.guildID = guild.id
         self.serverOwner = str(guild.owner_id)
         self.inviteCache = {} # type: dict[str, Any]
+        self.inviteInfo = {} # type: dict[str, tuple[Optional[int], int, Optional[float]]] # Inviter id, max uses and expiry timestamp of each invite
+        self.unclaimedInvites = [] # type: list[tuple[str, int, Optional[int], float]] # Invite uses that were not attributed to a member yet, with the time at which they are dropped
+        self.inviteLock = asyncio.Lock()
+        self.warmed = False # Whether the invite cache was fetched since login
+        self.seeded = False # Whether the invite cache was restored from a snapshot. It is saved again, but joins are only attributed once the guild is warmed.
         self.settings = {} # type: dict[str, Any]
         self.settings["commandprefix"] = "//"
         self.settings["channellist"] = []
@@ -58,20 +234,70 @@ class ServerContext:
         self.settings["modlog"] = None
         self.settings["invitelog"] = None
         self.settings["invitedlog"] = None
+        self.route = None # type: MessageRoute
 
-        x = loadJSON(f"settings/{guild.id}.json")
+        x = bot.store.load(f"settings/{guild.id}", {})
         for k in x:
             self.settings[k] = x[k]    
+        self.saveSettings()
+
+    def saveSettings(self) -> None:
+        """Marks the settings as changed so they are persisted and the message route is rebuilt. Must be called after changing settings."""
+        self.route = None
+        self.bot.store.put(f"settings/{self.guildID}", self.settings)
+
+    def getRoute(self) -> MessageRoute:
+        """Returns the message route of the server, compiling it if the settings changed"""
+        if self.route is None: self.route = MessageRoute(self.bot.user.id, self.settings)
+        return self.route
     
-    async def update(self, guild: discord.Guild) -> None:
-        """Updates the data object with the guild object provided, which must not be None"""
+    def seedInvites(self, snapshot: dict[str, int]) -> None:
+        """Fills the invite cache from a previously persisted snapshot, so invites can be attributed before the guild is warmed"""
+        self.inviteCache.clear()
+        self.inviteCache.update(snapshot)
+        self.seeded = True
+
+    async def update(self, guild: discord.Guild, locked: bool=False) -> dict[str, int]:
+        """Updates the data object with the guild object provided, which must not be None. Returns the increase in uses of each invite compared to the previous invite cache. Set locked if the caller already holds inviteLock."""
         if guild is None: raise ValueError("Guild must not be None")
+        if not locked:
+            async with self.inviteLock: return await self.update(guild, locked=True)
         self.serverOwner = str(guild.owner_id)
-        invites = await guild.invites()
+        deltas = {}
+        self.bot.metrics.count("rest:context.invites")
+        for code, count, inviter in self.applyInvites(await guild.invites()): deltas[code] = count
+        # update role heirarchy
+        return deltas
+
+    def cacheInvite(self, invite: discord.Invite) -> None:
+        """Stores the uses of the invite and the details needed to attribute it after it is deleted"""
+        self.inviteCache[invite.code] = invite.uses or 0
+        expiry = None
+        if invite.max_age and invite.created_at: expiry = invite.created_at.replace(tzinfo=datetime.timezone.utc).timestamp() + invite.max_age
+        self.inviteInfo[invite.code] = (invite.inviter.id if invite.inviter else None, invite.max_uses or 0, expiry)
+
+    def applyInvites(self, invites: List[discord.Invite], pending: int=0) -> List[tuple[str, int, Optional[int]]]:
+        """Replaces the invite cache with the given invites. Returns the invites whose uses increased as (code, uses, inviter id), sorted by code. A cached invite that is missing from the list may have reached its maximum uses or may have been deleted, so it is only credited for the joins of the pending ones that the increased uses do not explain."""
+        deltas = []
+        current = set()
+        for i in sorted(invites, key=lambda x: x.code):
+            current.add(i.code)
+            if i.code in self.inviteCache and (i.uses or 0) > self.inviteCache[i.code]: 
+                deltas.append((i.code, i.uses - self.inviteCache[i.code], i.inviter.id if i.inviter else None))
+        unexplained = pending - sum(x[1] for x in deltas)
+        now = time.time()
+        for code in sorted(set(self.inviteCache) - current):
+            if unexplained <= 0: break
+            inviter, maxUses, expiry = self.inviteInfo.get(code, (None, 0, None))
+            if maxUses and self.inviteCache[code] < maxUses and (expiry is None or expiry > now): 
+                n = min(maxUses - self.inviteCache[code], unexplained)
+                deltas.append((code, n, inviter))
+                unexplained -= n
         self.inviteCache.clear()
-        for i in invites:
-            self.inviteCache[i.code] = i.uses
-            # update role heirarchy
+        self.inviteInfo.clear()
+        for i in invites: self.cacheInvite(i)
+        self.warmed = True
+        return deltas
 
     def isModerator(self, user: Any) -> bool:
         """Checks if the given user has moderator privileges in the given server""" 
@@ -152,6 +378,8 @@ class RichMessage:
         self.data = {} # type: dict[Any, Any]
 
         self.channel = None # type: int
+        self.ttl = None # type: float # Lifetime in seconds, overriding the default of the registry
+        self.expires = None # type: float # Unix time at which the message stops handling events
 
     def getContent(self) -> str: 
         """Returns the string content of the message"""
@@ -237,6 +465,11 @@ class RichMessage:
         """Handles a message event that may occur with this particular message. Could be either a pin, unpin, reply, reaction (action, clear emoji, clear), or deletion"""
         getattr(DiscordBotStatic, self.eventHandler)(self, event, message)
 
+    def setTTL(self, ttl: Optional[float]) -> "RichMessage":
+        """Sets how many seconds the message keeps handling events after it is sent. None uses the default of the message handler"""
+        self.ttl = ttl
+        return self
+
     def setEventHandler(self, handler: str) -> None:
         """Sets the handler of a message pin event to a given method. The handler must be a method name in the DiscordBotStatic class and take 3 parameters (RichMessage, eventType, discord.Message). Setting handler to None defaults the handler back to this message. This persists across bot restarts"""
         self.eventHandler = handler
@@ -265,7 +498,7 @@ class CommandEvent:
             message.setEmbed(ensureSize(message.getEmbed()))
         
         if self.lastResponseFinished: await self.sendNewResponse(message)
-        else: await self.editOldResponse(message)
+        else: await self.editOldResponse(message, wait=finished)
         self.lastResponse = message
         self.lastResponseFinished = finished
         
@@ -273,9 +506,10 @@ class CommandEvent:
         """Sends a new response to the command. Can be overriden to define new behaviour with the command"""
         self.lastResponseMessage = await self.bot.messageHandler.sendMessage(message, self.message.channel)
 
-    async def editOldResponse(self, message: Union[str, discord.Embed, RichMessage]) -> None:
-        """Edits an old response to the command. Can be overriden to define new behaviour with the command"""
-        await self.bot.messageHandler.editMessage(message, self.lastResponseMessage)
+    async def editOldResponse(self, message: Union[str, discord.Embed, RichMessage], wait: bool=True) -> None:
+        """Edits an old response to the command. Edits that do not wait are coalesced with later ones. Can be overriden to define new behaviour with the command"""
+        task = self.bot.messageHandler.queueEdit(message, self.lastResponseMessage)
+        if wait: await task
 
 class CommandPrototype:
     pass
@@ -0,0 +1,92 @@
+import asyncio
+import time
+import discord
+from typing import List
+
+# from . import util, static
+# from .static import *
+# from .util import *
+
+from static import *
+from util import *
+
+class GuildWarmup:
+    """Initializes guild contexts in the background after login with bounded concurrency, so commands can be served before every guild has been fetched"""
+    def __init__(self, bot, snapshot: dict[str, dict[str, int]]=None, concurrency: int=8, retries: int=3):
+        """Creates a warm-up engine for the bot. The snapshot is the last persisted invite cache of each guild, keyed by guild id"""
+        self.bot = bot
+        self.snapshot = snapshot or {} # type: dict[str, dict[str, int]]
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.gate = RateLimitGate(retries)
+        self.tasks = {} # type: dict[int, asyncio.Task]
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.startTime = None # type: float
+        self.finished = asyncio.Event()
+
+    def seed(self, guild: discord.Guild) -> ServerContext:
+        """Creates the context of the guild and fills its invite cache from the snapshot, if there is one. Does not send any requests."""
+        c = self.bot.getContext(guild)
+        if str(guild.id) in self.snapshot and not c.warmed: c.seedInvites(self.snapshot[str(guild.id)])
+        return c
+
+    def start(self, guilds: List[discord.Guild]) -> None:
+        """Schedules the initialization of every given guild in the background. Returns immediately."""
+        self.startTime = time.monotonic()
+        self.finished.clear()
+        for g in guilds:
+            if g.id in self.tasks: continue
+            self.total += 1
+            self.tasks[g.id] = asyncio.ensure_future(self.warm(g))
+        if self.total == self.done + self.failed: self.finished.set()
+
+    async def warm(self, guild: discord.Guild, priority: bool=False) -> None:
+        """Initializes a single guild, waiting for a free worker unless priority is set. Only the queued initialization of each guild counts towards the progress."""
+        if priority: 
+            await self._warm(guild)
+            return
+        try:
+            async with self.semaphore: await self._warm(guild)
+            self.done += 1
+        except Exception as e:
+            self.failed += 1
+            print(f" - Failed to initialize {guild.name} ({guild.id}): {e}")
+        self.report()
+
+    async def _warm(self, guild: discord.Guild) -> None:
+        """Fetches the invites of a guild unless it is already warmed, backing off every worker when rate limited"""
+        c = self.bot.getContext(guild)
+        async def update():
+            async with c.inviteLock:
+                # A pending batch of joins refreshes the cache itself, and must see the deltas of its members
+                if c.warmed or self.bot.invites.isPending(guild.id): return {}
+                return await c.update(guild, locked=True)
+        deltas = await self.gate.call(update)
+        if deltas: print(f" - {guild.name} ({guild.id}): {sum(deltas.values())} invite use(s) occured while offline")
+
+    async def ensure(self, guild: discord.Guild) -> ServerContext:
+        """Returns the context of the guild once its invite cache can be used to attribute joins. Guilds that have not been warmed up yet are initialized immediately. A cache seeded from the snapshot is not enough, as the uses made while the bot was offline would be attributed to the joining members."""
+        c = self.bot.getContext(guild)
+        if c.warmed: return c
+        # Jump the queue rather than waiting for the guilds ahead of this one. The queued task finds the guild warmed and skips it.
+        await self.warm(guild, priority=True)
+        return c
+
+    def progress(self) -> str:
+        """Returns a human readable summary of the warm-up progress"""
+        elapsed = time.monotonic() - self.startTime if self.startTime else 0
+        return f"{self.done + self.failed}/{self.total} guilds initialized ({self.failed} failed) in {elapsed:.1f}s"
+
+    def report(self) -> None:
+        """Prints the progress at every tenth of the guilds and once everything is initialized"""
+        n = self.done + self.failed
+        step = max(1, self.total // 10)
+        if n == self.total:
+            print(f"Guild warm-up finished: {self.progress()}")
+            self.finished.set()
+        elif n % step == 0: print(f"Guild warm-up: {self.progress()}")
+
+    def save(self) -> dict[str, dict[str, int]]:
+        """Returns the invite snapshot of every known context, to be persisted on shutdown"""
+        return {str(k): dict(v.inviteCache) for k,v in self.bot.getContexts().items() if v.warmed or v.seeded}
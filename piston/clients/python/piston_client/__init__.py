@@ -0,0 +1,6 @@
+"""Async Python client for the Piston v2 API"""
+
+from .batch import execute_batch
+from .client import PistonClient, Stream
+from .errors import PistonConnectionError, PistonError
+from .models import ExecuteRequest, ExecuteResponse, File, Package, Runtime, StageResult, StreamEvent
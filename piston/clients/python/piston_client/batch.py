@@ -0,0 +1,65 @@
+import asyncio
+
+from .errors import PistonError
+
+_DONE = object()
+
+
+async def execute_batch(client, requests, concurrency=None, buffer=None):
+    """Runs many jobs and yields (index, ExecuteResponse or PistonError) as they finish.
+
+    requests may be any iterable or async iterable of ExecuteRequests, including a lazy
+    generator of thousands of jobs. It is consumed only as fast as jobs finish and results
+    are read: at most `concurrency` jobs are in flight (default: the client's limit) and at
+    most `buffer` finished results wait to be read (default: concurrency).
+    Closing the generator early cancels the jobs that are in flight.
+    """
+    concurrency = concurrency or client.concurrency
+    results = asyncio.Queue(maxsize=buffer or concurrency)
+    lock = asyncio.Lock()
+    if hasattr(requests, '__aiter__'):
+        source = requests.__aiter__()
+    else:
+        source = iter(requests)
+    counter = iter(range(1 << 62))
+
+    async def take():
+        async with lock:
+            try:
+                request = await source.__anext__() if hasattr(source, '__anext__') else next(source)
+            except (StopIteration, StopAsyncIteration):
+                return None
+            return next(counter), request
+
+    async def worker():
+        try:
+            while True:
+                item = await take()
+                if item is None:
+                    break
+                index, request = item
+                try:
+                    result = await client.execute(request)
+                except PistonError as e:
+                    result = e
+                await results.put((index, result))
+        except Exception:
+            await results.put(_DONE)
+            raise
+        await results.put(_DONE)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        running = len(workers)
+        while running:
+            item = await results.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            yield item
+        for x in workers:
+            # Surfaces errors of the request iterable
+            x.result()
+    finally:
+        for x in workers:
+            x.cancel()
@@ -0,0 +1,220 @@
+"""Load and latency benchmark for a Piston API.
+
+Replays the package tests (packages/*/*/test.*) against the API, either open-loop at a
+fixed or Poisson arrival rate, or closed-loop with a fixed number of concurrent clients.
+Jobs are streamed over the WebSocket so compile and run stages can be timed separately.
+Latency is measured from the scheduled arrival of a job, so queueing caused by a slow
+server is included rather than hidden. Results are printed and can be written as JSON
+to compare runs, e.g. across values of max_concurrent_jobs:
+
+    python -m piston_client.benchmark --rate 20 --duration 60 --output before.json
+    python -m piston_client.benchmark --rate 20 --duration 60 --compare before.json
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import math
+import random
+import sys
+import time
+
+from .client import PistonClient
+from .errors import PistonConnectionError
+from .package_tests import PACKAGES_DIR, TestResult, discover, run_test
+
+PERCENTILES = (50, 90, 99, 99.9)
+STAGES = ('total', 'queue', 'compile', 'run')
+
+
+class Sample(TestResult):
+    """Result of a job, and whether it ran during warmup"""
+    __slots__ = ('warmup',)
+
+    def __init__(self, test, warmup):
+        super().__init__(test)
+        self.warmup = warmup
+
+
+def interval(rate, arrival, rng):
+    return rng.expovariate(rate) if arrival == 'poisson' else 1.0 / rate
+
+
+async def open_loop(client, tests, args, rng, samples):
+    """Starts jobs at the arrival rate regardless of how many are still running"""
+    start = time.perf_counter()
+    end = start + args.warmup + args.duration
+    tasks = set()
+    scheduled = start
+    while scheduled < end:
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sample = Sample(rng.choice(tests), scheduled < start + args.warmup)
+        samples.append(sample)
+        task = asyncio.ensure_future(run_test(client, sample.test, args.timeout, rng.choice(args.payload_sizes), scheduled, sample))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        scheduled += interval(args.rate, args.arrival, rng)
+    if tasks:
+        await asyncio.wait(tasks)
+    return start
+
+
+async def closed_loop(client, tests, args, rng, samples):
+    """Runs a fixed number of clients that each start a new job when their last one finished"""
+    start = time.perf_counter()
+    end = start + args.warmup + args.duration
+
+    async def worker():
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                return
+            sample = Sample(rng.choice(tests), now < start + args.warmup)
+            samples.append(sample)
+            await run_test(client, sample.test, args.timeout, rng.choice(args.payload_sizes), now, sample)
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return start
+
+
+def percentiles(values):
+    """Returns the percentiles, mean and max of values in milliseconds, using the nearest rank"""
+    if not values:
+        return None
+    values = sorted(values)
+    result = {f'p{p:g}': round(values[max(0, math.ceil(len(values) * p / 100) - 1)] * 1000, 3) for p in PERCENTILES}
+    result['mean'] = round(sum(values) / len(values) * 1000, 3)
+    result['max'] = round(values[-1] * 1000, 3)
+    return result
+
+
+def summarize(samples, seconds):
+    """Returns the statistics of the samples measured over the given number of seconds"""
+    errors = [x for x in samples if x.error is not None]
+    failed = [x for x in samples if x.error is None and not x.passed]
+    completed = [x for x in samples if x.error is None]
+    return {
+        'requests': len(samples),
+        'completed': len(completed),
+        'errors': len(errors),
+        'failed': len(failed),
+        'error_rate': round(len(errors) / len(samples), 6) if samples else 0.0,
+        'throughput': round(len(completed) / seconds, 3) if seconds else 0.0,
+        'latency': {stage: percentiles([getattr(x, stage) for x in completed if getattr(x, stage) is not None]) for stage in STAGES},
+    }
+
+
+def report(samples, args, started, measured):
+    measure = [x for x in samples if not x.warmup]
+    by_test = collections.defaultdict(list)
+    for x in measure:
+        by_test[x.test.name].append(x)
+    errors = collections.Counter(x.error for x in measure if x.error is not None)
+    return {
+        'started': started,
+        'config': {
+            'url': args.url,
+            'mode': args.mode,
+            'rate': args.rate if args.mode == 'open' else None,
+            'arrival': args.arrival if args.mode == 'open' else None,
+            'concurrency': args.concurrency,
+            'warmup': args.warmup,
+            'duration': args.duration,
+            'payload_sizes': args.payload_sizes,
+            'languages': args.languages,
+            'seed': args.seed,
+            'label': args.label,
+        },
+        'measured_seconds': round(measured, 3),
+        'summary': summarize(measure, measured),
+        'tests': {k: summarize(v, measured) for k, v in sorted(by_test.items())},
+        'errors': dict(errors.most_common(20)),
+    }
+
+
+def format_latency(latency):
+    if latency is None:
+        return '-'
+    return ' '.join(f'{k} {v:.1f}' for k, v in latency.items() if k.startswith('p'))
+
+
+def print_report(result, baseline=None):
+    s = result['summary']
+    print(f"{s['requests']} requests, {s['completed']} completed, {s['errors']} errors ({s['error_rate']:.2%}), {s['failed']} did not print OK")
+    print(f"Throughput {s['throughput']:.2f} jobs/s over {result['measured_seconds']:.1f}s")
+    for stage in STAGES:
+        line = f'  {stage:<8} {format_latency(s["latency"][stage])} ms'
+        if baseline is not None:
+            old = baseline['summary']['latency'].get(stage)
+            new = s['latency'][stage]
+            if old and new:
+                line += '   (' + ' '.join(f'{k} {(new[k] - old[k]) / old[k]:+.1%}' for k in new if k.startswith('p') and old.get(k)) + ')'
+        print(line)
+    if baseline is not None:
+        b = baseline['summary']
+        print(f"Baseline: throughput {b['throughput']:.2f} jobs/s, error rate {b['error_rate']:.2%}")
+    for message, count in result['errors'].items():
+        print(f'  {count}x {message}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for a Piston API')
+    parser.add_argument('--url', default='http://127.0.0.1:2000', help='Base URL of the API')
+    parser.add_argument('--packages', default=PACKAGES_DIR, help='Packages directory to take test files from')
+    parser.add_argument('--languages', nargs='*', help='Only use tests of these packages or languages')
+    parser.add_argument('--mode', choices=('open', 'closed'), default='open', help='Open loop starts jobs at a rate, closed loop keeps a number of jobs running')
+    parser.add_argument('--rate', type=float, default=10.0, help='Jobs started per second in open loop mode')
+    parser.add_argument('--arrival', choices=('poisson', 'constant'), default='poisson', help='Distribution of arrivals in open loop mode')
+    parser.add_argument('--concurrency', type=int, default=64, help='Clients in closed loop mode, and the most jobs in flight in open loop mode')
+    parser.add_argument('--warmup', type=float, default=10.0, help='Seconds to run before measuring')
+    parser.add_argument('--duration', type=float, default=60.0, help='Seconds to measure')
+    parser.add_argument('--payload-sizes', type=lambda x: [int(y) for y in x.split(',')], default=[0], help='Comma separated sizes in bytes of an unused file added to each job, picked at random')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds a job may take')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the mix of tests and arrivals')
+    parser.add_argument('--label', default=None, help='Free text stored with the results, e.g. the server config')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Show the change against the results in this JSON file')
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    tests = discover(args.packages)
+    if args.languages:
+        tests = [x for x in tests if x.package in args.languages or x.language in args.languages]
+    if not tests:
+        print('No tests matched', file=sys.stderr)
+        return 1
+    rng = random.Random(args.seed)
+    samples = []
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    # Retries would hide errors and distort latency
+    async with PistonClient(args.url, concurrency=args.concurrency, retries=0, timeout=args.timeout) as client:
+        try:
+            await client.runtimes()
+        except PistonConnectionError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f'Running {len(tests)} tests {args.mode} loop for {args.warmup:g}s warmup and {args.duration:g}s measurement')
+        loop = open_loop if args.mode == 'open' else closed_loop
+        start = await loop(client, tests, args, rng, samples)
+    # Jobs still running at the end extend the measurement, so throughput is not overstated
+    measured = time.perf_counter() - start - args.warmup
+    result = report(samples, args, started, measured)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
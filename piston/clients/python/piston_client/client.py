@@ -0,0 +1,195 @@
+import asyncio
+import json
+import random
+
+import aiohttp
+
+from .errors import PistonConnectionError, PistonError
+from .models import ExecuteRequest, ExecuteResponse, File, Package, Runtime, StreamEvent
+
+# Statuses that mean the server is busy or failed, rather than rejecting the request
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Close code the server uses once a streamed job has finished
+JOB_COMPLETED = 4999
+
+
+class PistonClient:
+    """Async client for the Piston v2 API.
+
+    All requests share one keep-alive connection pool, and at most `concurrency` requests or
+    streams are in flight at once. Requests that fail with 429, a 5xx status or a connection
+    error are retried with exponential backoff; jobs run in a fresh sandbox, so retrying an
+    execute is safe. Use it as an async context manager, or call close() when done.
+
+    headers are sent with every request and stream. An api_key is sent as the Authorization
+    header, as public instances such as emkc.org expect.
+    """
+
+    def __init__(self, base_url='http://127.0.0.1:2000', concurrency=64, retries=3, backoff=0.5, timeout=60.0, session=None, headers=None, api_key=None):
+        self.base_url = base_url.rstrip('/') + '/api/v2/'
+        self.headers = dict(headers or {})
+        if api_key:
+            self.headers['Authorization'] = api_key
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._session = session
+        self._owns_session = session is None
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._owns_session = True
+        return self._session
+
+    @property
+    def slots(self):
+        # Created lazily so the client can be constructed outside of a running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    async def close(self):
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+        self._session = None
+
+    async def request(self, method, path, body=None):
+        """Sends a request with retries and returns the decoded JSON response"""
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.slots:
+                    async with self.session.request(method, self.base_url + path, json=body, headers=self.headers) as resp:
+                        data = await resp.json(content_type=None)
+                        if resp.status < 400:
+                            return data
+                        message = data.get('message', f'HTTP {resp.status}') if isinstance(data, dict) else f'HTTP {resp.status}'
+                        if resp.status not in RETRY_STATUSES or last:
+                            raise PistonError(message, resp.status)
+                        delay = retry_after(resp.headers.get('Retry-After'))
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, ValueError) as e:
+                if last:
+                    raise PistonConnectionError(f'{method} {path} failed after {attempt + 1} attempts: {type(e).__name__} {e}')
+                delay = None
+            if delay is None:
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+            await asyncio.sleep(delay)
+
+    async def runtimes(self):
+        return [Runtime.from_json(x) for x in await self.request('GET', 'runtimes')]
+
+    async def packages(self):
+        return [Package.from_json(x) for x in await self.request('GET', 'packages')]
+
+    async def install(self, language, version):
+        """Installs a package and returns the installed language and version"""
+        return await self.request('POST', 'packages', {'language': language, 'version': version})
+
+    async def uninstall(self, language, version):
+        """Uninstalls a package and returns the uninstalled language and version"""
+        return await self.request('DELETE', 'packages', {'language': language, 'version': version})
+
+    async def execute(self, request):
+        """Runs a job and returns its result once it finished"""
+        return ExecuteResponse.from_json(await self.request('POST', 'execute', request.to_json()))
+
+    async def run(self, language, code, version='*', stdin='', args=()):
+        """Runs a single source file with the latest matching version of a language"""
+        return await self.execute(ExecuteRequest(language, version, [File(code)], stdin, list(args)))
+
+    def stream(self, request):
+        """Returns a Stream that runs the job over the WebSocket and yields its output as it arrives:
+
+            async with client.stream(request) as stream:
+                async for event in stream:
+                    ...
+        """
+        return Stream(self, request)
+
+
+class Stream:
+    """A job running over /api/v2/connect. Iterating yields StreamEvents until the job finished. Holds one of the client's concurrency slots while open."""
+
+    def __init__(self, client, request):
+        self.client = client
+        self.request = request
+        self.ws = None
+        self.done = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        await self.client.slots.acquire()
+        try:
+            self.ws = await self.client.session.ws_connect(self.client.base_url + 'connect', headers=self.client.headers)
+            await self.ws.send_json({'type': 'init', **self.request.to_json()})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise PistonConnectionError(f'Could not start the stream: {type(e).__name__} {e}')
+        except BaseException:
+            await self.close()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        msg = await self.ws.receive()
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            data = json.loads(msg.data)
+            if data.get('type') == 'error':
+                self.done = True
+                raise PistonError(data.get('message', 'The job failed'))
+            return StreamEvent.from_json(data)
+        self.done = True
+        if msg.type == aiohttp.WSMsgType.ERROR:
+            raise PistonConnectionError(f'The stream failed: {self.ws.exception()}')
+        code = self.ws.close_code
+        if code != JOB_COMPLETED:
+            raise PistonError(f'The stream closed before the job finished: {msg.extra or code}', code)
+        raise StopAsyncIteration
+
+    async def write(self, data):
+        """Writes to the stdin of the running stage"""
+        await self.ws.send_json({'type': 'data', 'stream': 'stdin', 'data': data})
+
+    async def signal(self, signal):
+        """Sends a signal such as 'SIGKILL' to the running stage"""
+        await self.ws.send_json({'type': 'signal', 'signal': signal})
+
+    async def close(self):
+        if self.client is None:
+            return
+        try:
+            if self.ws is not None:
+                await self.ws.close()
+        finally:
+            self.client.slots.release()
+            self.client = None
+
+
+def retry_after(value):
+    """Returns the delay in seconds of a Retry-After header, or None if it is missing or a date"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
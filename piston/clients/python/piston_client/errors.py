@@ -0,0 +1,11 @@
+class PistonError(Exception):
+    """Raised when the API rejects a request. status is the HTTP status, or the WebSocket close code for streamed jobs."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class PistonConnectionError(PistonError):
+    """Raised when the API could not be reached after every retry"""
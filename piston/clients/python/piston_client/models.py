@@ -0,0 +1,146 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class File:
+    """A file uploaded into the job. The first utf8 file is the one that is run."""
+    content: str
+    name: Optional[str] = None
+    encoding: str = 'utf8'
+
+    def to_json(self):
+        data = {'content': self.content, 'encoding': self.encoding}
+        if self.name is not None:
+            data['name'] = self.name
+        return data
+
+
+@dataclass
+class ExecuteRequest:
+    """Body of POST /api/v2/execute, also used to start a job over the WebSocket. Limits left as None use the server's configured maximum."""
+    language: str
+    version: str
+    files: List[File]
+    stdin: str = ''
+    args: List[str] = field(default_factory=list)
+    compile_timeout: Optional[int] = None
+    run_timeout: Optional[int] = None
+    compile_memory_limit: Optional[int] = None
+    run_memory_limit: Optional[int] = None
+
+    def to_json(self):
+        data = {
+            'language': self.language,
+            'version': self.version,
+            'files': [x.to_json() for x in self.files],
+            'stdin': self.stdin,
+            'args': list(self.args),
+        }
+        for key in ('compile_timeout', 'run_timeout', 'compile_memory_limit', 'run_memory_limit'):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        return data
+
+
+@dataclass
+class StageResult:
+    """Result of the compile or run stage of a job. Either code or signal is None."""
+    stdout: str
+    stderr: str
+    output: str
+    code: Optional[int]
+    signal: Optional[str]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            stdout=data.get('stdout', ''),
+            stderr=data.get('stderr', ''),
+            output=data.get('output', ''),
+            code=data.get('code'),
+            signal=data.get('signal'),
+        )
+
+    @property
+    def ok(self):
+        return self.code == 0 and self.signal is None
+
+
+@dataclass
+class ExecuteResponse:
+    """Response of POST /api/v2/execute. compile is only set for compiled languages."""
+    language: str
+    version: str
+    run: StageResult
+    compile: Optional[StageResult] = None
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            language=data['language'],
+            version=data['version'],
+            run=StageResult.from_json(data['run']),
+            compile=StageResult.from_json(data['compile']) if data.get('compile') else None,
+        )
+
+
+@dataclass
+class Runtime:
+    """An installed runtime, as listed by GET /api/v2/runtimes"""
+    language: str
+    version: str
+    aliases: List[str] = field(default_factory=list)
+    runtime: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['language'], data['version'], list(data.get('aliases', [])), data.get('runtime'))
+
+
+@dataclass
+class Package:
+    """A package in the repository, as listed by GET /api/v2/packages"""
+    language: str
+    language_version: str
+    installed: bool
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['language'], data['language_version'], bool(data['installed']))
+
+
+@dataclass
+class StreamEvent:
+    """A message received while streaming a job over /api/v2/connect.
+
+    type is one of:
+        runtime: the job started, with language and version set
+        stage: a stage started, with stage set
+        data: output arrived, with stream ('stdout' or 'stderr') and data set
+        exit: a stage finished, with stage, code, signal and error set
+    """
+    type: str
+    stage: Optional[str] = None
+    stream: Optional[str] = None
+    data: Optional[str] = None
+    code: Optional[int] = None
+    signal: Optional[str] = None
+    error: Optional[str] = None
+    language: Optional[str] = None
+    version: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data):
+        error = data.get('error')
+        return cls(
+            type=data['type'],
+            stage=data.get('stage'),
+            stream=data.get('stream'),
+            data=data.get('data'),
+            code=data.get('code'),
+            signal=data.get('signal'),
+            error=str(error) if error is not None else None,
+            language=data.get('language'),
+            version=data.get('version'),
+        )
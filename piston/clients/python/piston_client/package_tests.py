@@ -0,0 +1,126 @@
+import asyncio
+import base64
+import functools
+import json
+import os
+import time
+from dataclasses import dataclass
+
+from .errors import PistonError
+from .models import ExecuteRequest, File
+
+# The packages directory of this repository
+PACKAGES_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'packages'))
+
+
+@dataclass
+class PackageTest:
+    """A test file of a package, e.g. packages/gcc/10.2.0/test.cpp. A passing test prints OK."""
+    package: str
+    version: str
+    language: str
+    path: str
+
+    @property
+    def name(self):
+        return f'{self.package}/{self.version}/{os.path.basename(self.path)}'
+
+    @functools.cached_property
+    def file(self):
+        """The test as a File. Binary tests, such as those of the file package, are base64 encoded."""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        try:
+            return File(data.decode('utf-8'), os.path.basename(self.path))
+        except UnicodeDecodeError:
+            return File(base64.b64encode(data).decode('ascii'), os.path.basename(self.path), 'base64')
+
+    def request(self, padding=0):
+        """Returns the job that runs the test. padding adds an unused file of about that many bytes to the payload."""
+        files = [self.file]
+        if padding >= 4:
+            # Only utf8 files are passed to the compile and run scripts, so a base64 file is never touched
+            files.append(File('A' * (padding // 4 * 4), 'padding.bin', 'base64'))
+        return ExecuteRequest(self.language, self.version, files)
+
+
+def test_language(metadata, extension):
+    """Returns the language a test file extension refers to, using the language and aliases of the package and the languages it provides"""
+    languages = [metadata] + metadata.get('provides', [])
+    for x in languages:
+        if extension == x.get('language') or extension in x.get('aliases', []):
+            return x['language']
+    # Leave it to the API to resolve
+    return extension
+
+
+def discover(packages_dir=PACKAGES_DIR):
+    """Returns the tests of every package, sorted by name"""
+    tests = []
+    for package in sorted(os.listdir(packages_dir)):
+        if not os.path.isdir(os.path.join(packages_dir, package)):
+            continue
+        for version in sorted(os.listdir(os.path.join(packages_dir, package))):
+            directory = os.path.join(packages_dir, package, version)
+            metadata_path = os.path.join(directory, 'metadata.json')
+            if not os.path.isfile(metadata_path):
+                continue
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            for file in sorted(os.listdir(directory)):
+                if not file.startswith('test.'):
+                    continue
+                # test.nasm64.asm is a test of nasm64
+                extension = file.split('.')[1]
+                tests.append(PackageTest(package, metadata.get('version', version), test_language(metadata, extension), os.path.join(directory, file)))
+    return tests
+
+
+class TestResult:
+    """Outcome and timings in seconds of running a test. Stages that did not run are None. queue is the time until the job started."""
+    __slots__ = ('test', 'total', 'queue', 'compile', 'run', 'error', 'passed', 'stdout', 'output', 'code', 'signal')
+
+    def __init__(self, test):
+        self.test = test
+        self.total = self.queue = self.compile = self.run = None
+        self.error = None
+        self.passed = False
+        self.stdout = self.output = ''
+        self.code = self.signal = None
+
+
+async def run_test(client, test, timeout=60.0, padding=0, scheduled=None, result=None):
+    """Streams a test job and returns its result, or fills in the given result. Timings are measured from scheduled, which defaults to now."""
+    result = result if result is not None else TestResult(test)
+    scheduled = scheduled if scheduled is not None else time.perf_counter()
+    stages = {}
+    stdout = []
+    output = []
+
+    async def consume():
+        async with client.stream(test.request(padding)) as stream:
+            async for event in stream:
+                now = time.perf_counter()
+                if event.type == 'runtime':
+                    result.queue = now - scheduled
+                elif event.type == 'stage':
+                    stages[event.stage] = now
+                elif event.type == 'exit' and event.stage in stages:
+                    setattr(result, event.stage, now - stages[event.stage])
+                    result.code, result.signal = event.code, event.signal
+                elif event.type == 'data':
+                    output.append(event.data)
+                    if event.stream == 'stdout':
+                        stdout.append(event.data)
+
+    try:
+        await asyncio.wait_for(consume(), timeout)
+    except PistonError as e:
+        result.error = str(e)
+    except asyncio.TimeoutError:
+        result.error = f'Timed out after {timeout:g}s'
+    result.total = time.perf_counter() - scheduled
+    result.stdout = ''.join(stdout)
+    result.output = ''.join(output)
+    result.passed = result.error is None and 'OK' in result.stdout
+    return result
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client is used by adding its directory to PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
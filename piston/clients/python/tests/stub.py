@@ -0,0 +1,76 @@
+import asyncio
+import contextlib
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from piston_client import PistonClient
+
+
+class StubPiston:
+    """A Piston API that runs no code. Jobs echo their stdin, and responses can be queued to fail requests."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.failures = []
+        self.requests = []
+        self.running = 0
+        self.max_running = 0
+        self.stream_handler = None
+
+    def fail(self, status, message='Failed', headers=None):
+        """Queues a response to the next request"""
+        self.failures.append((status, message, headers))
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/v2/runtimes', self.runtimes)
+        app.router.add_post('/api/v2/execute', self.execute)
+        app.router.add_get('/api/v2/connect', self.connect)
+        return app
+
+    def failure(self, request):
+        self.requests.append(request)
+        if not self.failures:
+            return None
+        status, message, headers = self.failures.pop(0)
+        return web.json_response({'message': message}, status=status, headers=headers)
+
+    async def runtimes(self, request):
+        return self.failure(request) or web.json_response([{'language': 'python', 'version': '3.10.0', 'aliases': ['py']}])
+
+    async def execute(self, request):
+        failure = self.failure(request)
+        if failure is not None:
+            return failure
+        body = await request.json()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        if body['stdin'] == 'reject':
+            return web.json_response({'message': 'Rejected'}, status=400)
+        run = {'stdout': body['stdin'], 'stderr': '', 'output': body['stdin'], 'code': 0, 'signal': None}
+        return web.json_response({'language': body['language'], 'version': body['version'], 'run': run})
+
+    async def connect(self, request):
+        self.requests.append(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        init = await ws.receive_json()
+        await self.stream_handler(ws, init)
+        return ws
+
+
+@contextlib.asynccontextmanager
+async def serve(piston, **options):
+    """Starts the stub and yields a client of it"""
+    server = TestServer(piston.app())
+    await server.start_server()
+    try:
+        async with PistonClient(str(server.make_url('')), **options) as client:
+            yield client
+    finally:
+        await server.close()
@@ -0,0 +1,54 @@
+import asyncio
+
+from piston_client import ExecuteRequest, File, PistonError, execute_batch
+
+from stub import StubPiston, serve
+
+
+def requests(n, taken, stdin=lambda i: str(i)):
+    for i in range(n):
+        taken.append(i)
+        yield ExecuteRequest('python', '3.x', [File('print(input())')], stdin(i))
+
+
+def test_results():
+    async def main():
+        piston = StubPiston()
+        async with serve(piston) as client:
+            stdin = lambda i: 'reject' if i == 3 else str(i)
+            results = dict([x async for x in execute_batch(client, requests(10, [], stdin), concurrency=4)])
+        assert sorted(results) == list(range(10))
+        assert isinstance(results[3], PistonError)
+        assert all(results[i].run.stdout == str(i) for i in results if i != 3)
+    asyncio.run(main())
+
+
+def test_async_iterable():
+    async def jobs():
+        for i in range(5):
+            await asyncio.sleep(0)
+            yield ExecuteRequest('python', '3.x', [File('')], str(i))
+
+    async def main():
+        async with serve(StubPiston()) as client:
+            return sorted([i async for i, _ in execute_batch(client, jobs(), concurrency=2)])
+    assert asyncio.run(main()) == list(range(5))
+
+
+def test_backpressure():
+    async def main():
+        piston = StubPiston(delay=0.01)
+        taken = []
+        async with serve(piston) as client:
+            batch = execute_batch(client, requests(1000, taken), concurrency=2, buffer=1)
+            await batch.__anext__()
+            # While results are not read, the workers stop once the buffer is full
+            await asyncio.sleep(0.3)
+            assert len(taken) <= 1 + 1 + 2
+            assert piston.max_running <= 2
+            await batch.aclose()
+            stopped = len(taken)
+            await asyncio.sleep(0.1)
+            assert len(taken) == stopped
+            assert piston.running == 0
+    asyncio.run(main())
@@ -0,0 +1,19 @@
+from piston_client.benchmark import percentiles
+
+
+def test_percentiles():
+    assert percentiles([]) is None
+    result = percentiles([i / 1000 for i in range(100, 0, -1)])
+    assert result['p50'] == 50
+    assert result['p90'] == 90
+    assert result['p99'] == 99
+    assert result['p99.9'] == 100
+    assert result['mean'] == 50.5
+    assert result['max'] == 100
+
+
+def test_percentiles_few_values():
+    result = percentiles([0.001, 0.002])
+    assert result['p50'] == 1
+    assert result['p90'] == 2
+    assert percentiles([0.005])['p50'] == 5
@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+import pytest
+
+from piston_client import ExecuteRequest, File, PistonClient, PistonConnectionError, PistonError
+from piston_client.client import JOB_COMPLETED, retry_after
+
+from stub import StubPiston, serve
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_retry_after():
+    assert retry_after('2') == 2.0
+    assert retry_after('-1') == 0.0
+    assert retry_after('Wed, 21 Oct 2015 07:28:00 GMT') is None
+    assert retry_after(None) is None
+
+
+def test_retries_busy_statuses():
+    async def main():
+        piston = StubPiston()
+        for status in (429, 503, 502):
+            piston.fail(status)
+        async with serve(piston, backoff=0.01) as client:
+            result = await client.run('python', 'print(input())', stdin='hello')
+        assert result.run.stdout == 'hello'
+        assert len(piston.requests) == 4
+    run(main())
+
+
+def test_honours_retry_after():
+    async def main():
+        piston = StubPiston()
+        piston.fail(429, headers={'Retry-After': '0.3'})
+        async with serve(piston, backoff=10) as client:
+            start = time.perf_counter()
+            await client.runtimes()
+            elapsed = time.perf_counter() - start
+        # The header replaces the backoff of at least 5s
+        assert 0.3 <= elapsed < 2
+    run(main())
+
+
+def test_gives_up_after_retries():
+    async def main():
+        piston = StubPiston()
+        for _ in range(3):
+            piston.fail(500, 'Internal error')
+        async with serve(piston, retries=2, backoff=0.01) as client:
+            with pytest.raises(PistonError) as e:
+                await client.runtimes()
+        assert (e.value.status, e.value.message) == (500, 'Internal error')
+        assert len(piston.requests) == 3
+    run(main())
+
+
+def test_does_not_retry_rejections():
+    async def main():
+        piston = StubPiston()
+        piston.fail(400, 'python-9 runtime is unknown')
+        async with serve(piston, backoff=0.01) as client:
+            with pytest.raises(PistonError) as e:
+                await client.run('python', '', version='9')
+            assert (e.value.status, e.value.message) == (400, 'python-9 runtime is unknown')
+            assert len(piston.requests) == 1
+            with pytest.raises(PistonError, match='Rejected'):
+                await client.run('python', '', stdin='reject')
+    run(main())
+
+
+def test_headers():
+    async def job(ws, init):
+        await ws.close(code=JOB_COMPLETED)
+
+    async def main():
+        piston = StubPiston()
+        piston.stream_handler = job
+        async with serve(piston, api_key='secret', headers={'User-Agent': 'tests'}) as client:
+            await client.runtimes()
+            async with client.stream(ExecuteRequest('python', '3.x', [File('')])) as stream:
+                assert [x async for x in stream] == []
+        assert [(x.headers.get('Authorization'), x.headers.get('User-Agent')) for x in piston.requests] == [('secret', 'tests')] * 2
+    run(main())
+
+
+def test_connection_errors():
+    async def main():
+        async with PistonClient('http://127.0.0.1:9', retries=1, backoff=0.01) as client:
+            with pytest.raises(PistonConnectionError, match='after 2 attempts'):
+                await client.runtimes()
+    run(main())
+
+
+def test_stream():
+    async def job(ws, init):
+        await ws.send_json({'type': 'runtime', 'language': init['language'], 'version': '3.10.0'})
+        await ws.send_json({'type': 'stage', 'stage': 'run'})
+        message = await ws.receive_json()
+        await ws.send_json({'type': 'data', 'stream': 'stdout', 'data': message['data']})
+        await ws.send_json({'type': 'exit', 'stage': 'run', 'code': 0, 'signal': None})
+        await ws.close(code=JOB_COMPLETED, message=b'Job Completed')
+
+    async def main():
+        piston = StubPiston()
+        piston.stream_handler = job
+        events = []
+        async with serve(piston, concurrency=1) as client:
+            async with client.stream(ExecuteRequest('python', '3.x', [File('print(input())')])) as stream:
+                async for event in stream:
+                    events.append(event)
+                    if event.type == 'stage':
+                        await stream.write('hello\n')
+            # The stream released its slot
+            assert not client.slots.locked()
+        assert [x.type for x in events] == ['runtime', 'stage', 'data', 'exit']
+        assert events[0].version == '3.10.0'
+        assert (events[2].stream, events[2].data) == ('stdout', 'hello\n')
+        assert events[3].code == 0
+    run(main())
+
+
+def test_stream_closed_early():
+    async def job(ws, init):
+        await ws.send_json({'type': 'runtime', 'language': init['language'], 'version': '3.10.0'})
+        await ws.close(code=4001, message=b'Timeout waiting for init')
+
+    async def main():
+        piston = StubPiston()
+        piston.stream_handler = job
+        async with serve(piston) as client:
+            async with client.stream(ExecuteRequest('python', '3.x', [File('')])) as stream:
+                assert (await stream.__anext__()).type == 'runtime'
+                with pytest.raises(PistonError) as e:
+                    await stream.__anext__()
+        assert e.value.status == 4001
+    run(main())
+
+
+def test_stream_error():
+    async def job(ws, init):
+        await ws.send_json({'type': 'error', 'message': 'Unknown runtime'})
+        await ws.close(code=4004)
+
+    async def main():
+        piston = StubPiston()
+        piston.stream_handler = job
+        async with serve(piston) as client:
+            async with client.stream(ExecuteRequest('cobol', '*', [File('')])) as stream:
+                with pytest.raises(PistonError, match='Unknown runtime'):
+                    async for _ in stream:
+                        pass
+                async for _ in stream:
+                    pytest.fail('The stream continued after an error')
+    run(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Builds package archives ([name]-[version].pkg.tar.gz), skipping packages that did not change.
+
+A package is fingerprinted from its build.sh, metadata.json, run, compile and environment
+files, the files of other packages its build.sh refers to, and the build platform. A package
+whose archive was built from the same fingerprint is skipped. Builds run concurrently: each
+is given a number of cores according to its weight, exposed to `nproc` through
+OMP_NUM_THREADS, and the longest builds start first. Logs are streamed with a package
+prefix and kept in .build/logs, and .build/report.json records how long each build took.
+
+    ./build.py python-3.10.0 gcc             # some packages, all versions of gcc
+    ./build.py --all --jobs 16
+    ./build.py --changed HEAD^ --platform docker-debian
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+PACKAGES_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = os.path.join(PACKAGES_DIR, '.build')
+
+# Files that determine the contents of a package. Anything else in a package directory is build output.
+SOURCE_FILES = ('build.sh', 'metadata.json', 'run', 'compile', 'environment')
+
+# Bumped when the build steps change, so every package is rebuilt
+FINGERPRINT_VERSION = 1
+
+# Cores given to toolchains that are compiled from source. Other packages mostly download and unpack, and get one.
+WEIGHTS = {
+    'gcc': 8,
+    'swift': 6,
+    'dotnet': 6,
+    'mono': 6,
+    'octave': 6,
+    'haskell': 4,
+    'julia': 4,
+    'erlang': 4,
+    'php': 4,
+    'python': 4,
+}
+
+# Other package directories referred to by a build script, e.g. `source ../../node/15.10.0/build.sh`
+REFERENCE = re.compile(r'\.\./\.\./([\w.+-]+)/([\w.+-]+)/')
+
+
+class Package:
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.directory = os.path.join(PACKAGES_DIR, name, version)
+        self.weight = WEIGHTS.get(name, 1)
+
+    @property
+    def id(self):
+        return f'{self.name}-{self.version}'
+
+    @property
+    def artifact(self):
+        return os.path.join(PACKAGES_DIR, f'{self.id}.pkg.tar.gz')
+
+    @property
+    def fingerprint_path(self):
+        return os.path.join(STATE_DIR, f'{self.id}.fingerprint')
+
+    @property
+    def log_path(self):
+        return os.path.join(STATE_DIR, 'logs', f'{self.id}.log')
+
+    def references(self):
+        """Returns the other packages whose files the build script uses"""
+        try:
+            with open(os.path.join(self.directory, 'build.sh')) as f:
+                script = f.read()
+        except FileNotFoundError:
+            return []
+        found = []
+        for name, version in REFERENCE.findall(script):
+            if (name, version) != (self.name, self.version) and os.path.isfile(os.path.join(PACKAGES_DIR, name, version, 'metadata.json')):
+                found.append(Package(name, version))
+        return found
+
+    def fingerprint(self, platform, seen=None):
+        """Returns a hash of everything the archive is built from"""
+        seen = seen if seen is not None else set()
+        seen.add(self.id)
+        h = hashlib.sha256(f'{FINGERPRINT_VERSION}\0{platform}\0{self.id}\0'.encode())
+        for file in SOURCE_FILES:
+            path = os.path.join(self.directory, file)
+            h.update(file.encode() + b'\0')
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    h.update(hashlib.sha256(f.read()).digest())
+            else:
+                h.update(b'missing')
+        for x in sorted(self.references(), key=lambda x: x.id):
+            if x.id not in seen:
+                h.update(x.fingerprint(platform, seen).encode())
+        return h.hexdigest()
+
+    def is_current(self, fingerprint):
+        if not os.path.isfile(self.artifact) or not os.path.isfile(self.fingerprint_path):
+            return False
+        with open(self.fingerprint_path) as f:
+            return f.read().strip() == fingerprint
+
+
+def all_packages():
+    packages = []
+    for name in sorted(os.listdir(PACKAGES_DIR)):
+        directory = os.path.join(PACKAGES_DIR, name)
+        if name.startswith('.') or not os.path.isdir(directory):
+            continue
+        for version in sorted(os.listdir(directory)):
+            if os.path.isfile(os.path.join(directory, version, 'metadata.json')):
+                packages.append(Package(name, version))
+    return packages
+
+
+def select(packages, names):
+    """Returns the packages matching any of name, name-version or name/version"""
+    selected = []
+    for x in packages:
+        if any(n in (x.name, x.id, f'{x.name}/{x.version}') for n in names):
+            selected.append(x)
+    return selected
+
+
+def changed(ref):
+    """Returns the name-version ids of packages with files changed since a git ref"""
+    out = subprocess.run(['git', 'diff', '--name-only', '--relative', ref, '--', '.'], cwd=PACKAGES_DIR, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return {'-'.join(x.split('/')[:2]) for x in out.split('\n') if x.count('/') >= 2}
+
+
+def build_platform(platform):
+    if platform:
+        return platform
+    with open('/etc/os-release') as f:
+        ids = [x[3:].strip().strip('"') for x in f if x.startswith('ID=')]
+    return 'baremetal-' + (ids[0] if ids else 'unknown')
+
+
+class Builder:
+    """Runs builds concurrently, keeping the cores given to running builds within the limit"""
+
+    def __init__(self, jobs, platform, history, quiet=False):
+        self.jobs = jobs
+        self.platform = platform
+        self.history = history
+        self.quiet = quiet
+        self.free = jobs
+        self.results = {}
+
+    def cores(self, package):
+        return min(package.weight, self.jobs)
+
+    def expected(self, package):
+        """Seconds the last build of a package took, or its weight if it was never built, used to start long builds first"""
+        x = self.history.get(package.id)
+        return x['duration'] if x and x.get('duration') else package.weight
+
+    async def run(self, packages):
+        pending = sorted(packages, key=self.expected, reverse=True)
+        running = set()
+        finished = asyncio.Event()
+
+        def done(task, package):
+            running.discard(task)
+            self.free += self.cores(package)
+            finished.set()
+
+        while pending or running:
+            # Start the longest pending builds that fit in the free cores
+            for x in list(pending):
+                if self.cores(x) <= self.free:
+                    pending.remove(x)
+                    self.free -= self.cores(x)
+                    task = asyncio.ensure_future(self.build(x))
+                    running.add(task)
+                    task.add_done_callback(lambda t, x=x: done(t, x))
+            finished.clear()
+            await finished.wait()
+        return self.results
+
+    async def build(self, package):
+        fingerprint = package.fingerprint(self.platform)
+        start = time.monotonic()
+        os.makedirs(os.path.dirname(package.log_path), exist_ok=True)
+        print(f'[{package.id}] Building with {self.cores(package)} cores', flush=True)
+        try:
+            with open(os.path.join(package.directory, 'metadata.json')) as f:
+                info = json.load(f)
+            info['build_platform'] = self.platform
+            with open(os.path.join(package.directory, 'pkg-info.json'), 'w') as f:
+                json.dump(info, f, indent=2)
+            env = dict(os.environ, OMP_NUM_THREADS=str(self.cores(package)), PLATFORM=self.platform)
+            with open(package.log_path, 'w') as log:
+                code = await self.stream(package, log, env, 'bash', '-c', 'chmod +x ./build.sh && ./build.sh', cwd=package.directory)
+                if code == 0:
+                    # Written next to the archive and moved in place, so an interrupted build never leaves a partial archive behind
+                    code = await self.stream(package, log, env, 'tar', 'czf', package.artifact + '.tmp', '-C', package.directory, '.', cwd=PACKAGES_DIR)
+            if code == 0:
+                os.replace(package.artifact + '.tmp', package.artifact)
+                with open(package.fingerprint_path, 'w') as f:
+                    f.write(fingerprint + '\n')
+                status = 'built'
+            else:
+                status = 'failed'
+        except Exception as e:
+            print(f'[{package.id}] {type(e).__name__}: {e}', flush=True)
+            status = 'failed'
+        finally:
+            if os.path.exists(package.artifact + '.tmp'):
+                os.remove(package.artifact + '.tmp')
+        duration = time.monotonic() - start
+        if status == 'failed' and self.quiet:
+            self.print_tail(package)
+        print(f'[{package.id}] {status.capitalize()} in {duration:.1f}s' + ('' if status == 'built' else f', see {os.path.relpath(package.log_path)}'), flush=True)
+        self.results[package.id] = {'status': status, 'duration': round(duration, 3), 'cores': self.cores(package), 'fingerprint': fingerprint}
+
+    def print_tail(self, package, lines=50):
+        """Prints the end of the log of a failed build, whose output was not streamed"""
+        if not os.path.isfile(package.log_path):
+            return
+        with open(package.log_path, encoding='utf-8', errors='replace') as f:
+            tail = f.readlines()[-lines:]
+        sys.stdout.write(''.join(f'[{package.id}] {x}' for x in tail))
+
+    async def stream(self, package, log, env, *command, cwd):
+        """Runs a command, writing its output to the log and, prefixed with the package, to stdout. Returns its exit code."""
+        process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, stdin=asyncio.subprocess.DEVNULL)
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            text = line.decode('utf-8', 'replace')
+            log.write(text)
+            if not self.quiet:
+                sys.stdout.write(f'[{package.id}] {text}')
+        return await process.wait()
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get('packages', {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def print_report(results, wall):
+    built = sorted(((k, v) for k, v in results.items() if v['status'] != 'skipped'), key=lambda x: x[1]['duration'], reverse=True)
+    total = sum(v['duration'] for _, v in built) or 1
+    for k, v in built:
+        print(f"  {v['duration']:8.1f}s {v['duration'] / total:6.1%}  {v['cores']:2} cores  {v['status']:<7} {k}")
+    counts = {s: sum(1 for v in results.values() if v['status'] == s) for s in ('built', 'skipped', 'failed')}
+    print(f"{counts['built']} built, {counts['skipped']} up to date, {counts['failed']} failed in {wall:.1f}s ({total:.1f}s of builds)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Builds package archives, skipping packages that did not change')
+    parser.add_argument('packages', nargs='*', help='Packages to build, as name, name-version or name/version')
+    parser.add_argument('--all', action='store_true', help='Build every package')
+    parser.add_argument('--changed', metavar='REF', help='Build packages changed since this git ref')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='Cores to share between builds')
+    parser.add_argument('--platform', default=os.environ.get('PLATFORM'), help='Build platform written to pkg-info.json (default: $PLATFORM or baremetal-[os])')
+    parser.add_argument('--force', action='store_true', help='Build packages even if their archive is up to date')
+    parser.add_argument('--dry-run', action='store_true', help='Only show what would be built')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Do not stream build output, only keep it in the logs and show the end of the logs of failed builds')
+    parser.add_argument('--report', default=os.path.join(STATE_DIR, 'report.json'), help='Where to write the build time report')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    packages = all_packages()
+    if not args.all:
+        wanted = list(args.packages)
+        if args.changed:
+            wanted += sorted(changed(args.changed))
+        packages = select(packages, wanted)
+    if not packages:
+        print('No packages to build')
+        return 0
+    platform = build_platform(args.platform)
+
+    results = {}
+    todo = []
+    for x in packages:
+        fingerprint = x.fingerprint(platform)
+        if not args.force and x.is_current(fingerprint):
+            results[x.id] = {'status': 'skipped', 'duration': 0.0, 'cores': 0, 'fingerprint': fingerprint}
+        else:
+            todo.append(x)
+    print(f"Building {len(todo)} of {len(packages)} packages for {platform} on {args.jobs} cores: {' '.join(x.id for x in todo) or 'nothing'}")
+    if args.dry_run or not todo:
+        return 0
+
+    history = load_history(args.report)
+    start = time.monotonic()
+    builder = Builder(args.jobs, platform, history, args.quiet)
+    results.update(asyncio.run(builder.run(todo)))
+    wall = time.monotonic() - start
+    print_report(results, wall)
+
+    # Durations of packages that were not built this time are kept, so the next run can still order builds by them
+    for k, v in results.items():
+        if v['status'] != 'skipped' or k not in history:
+            history[k] = v
+    os.makedirs(os.path.dirname(args.report), exist_ok=True)
+    with open(args.report, 'w') as f:
+        json.dump({'platform': platform, 'jobs': args.jobs, 'wall': round(wall, 3), 'finished': time.time(), 'packages': history}, f, indent=2, sort_keys=True)
+    return 1 if any(v['status'] == 'failed' for v in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
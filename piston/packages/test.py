@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Runs the package tests (*/*/test.*) concurrently against a Piston API.
+
+Every test must print OK. Tests of runtimes the API has not installed are skipped, unless
+--install is given. Compile and run timings are recorded per test, and can be stored as a
+baseline to flag runtimes that got slower:
+
+    ./test.py                                   # every package
+    ./test.py python gcc/10.2.0                 # some packages
+    ./test.py --changed origin/master           # packages changed since a git ref
+    ./test.py --baseline baseline.json --update-baseline
+    ./test.py --baseline baseline.json --junit report.xml --json report.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clients', 'python'))
+
+from piston_client import PistonClient, PistonError  # noqa: E402
+from piston_client.package_tests import PACKAGES_DIR, discover, run_test  # noqa: E402
+
+# Stages compared against the baseline. Total and queue time depend on how busy the API is.
+BASELINE_STAGES = ('compile', 'run')
+
+
+def changed_packages(ref):
+    """Returns the (package, version) directories with files changed since a git ref, including uncommitted and untracked files"""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=PACKAGES_DIR, check=True, capture_output=True, text=True).stdout.split('\n')
+    paths = git('diff', '--name-only', '--relative', ref, '--', '.') + git('ls-files', '--others', '--exclude-standard')
+    return {tuple(x.split('/')[:2]) for x in paths if x.count('/') >= 2}
+
+
+def select(tests, patterns):
+    """Returns the tests matching any of package, package/version or package/version/file"""
+    return [x for x in tests if any(x.name == p or x.name.startswith(p.rstrip('/') + '/') for p in patterns)]
+
+
+def installed(test, runtimes):
+    return any(test.version == x.version and (test.language == x.language or test.language in x.aliases) for x in runtimes)
+
+
+def regression(result, baseline, tolerance, min_delta):
+    """Returns the stages of a passing test that are slower than its baseline by more than the tolerance and min_delta seconds"""
+    base = baseline.get(result.test.name)
+    if not result.passed or base is None:
+        return {}
+    slower = {}
+    for stage in BASELINE_STAGES:
+        now, before = getattr(result, stage), base.get(stage)
+        if now is None or before is None:
+            continue
+        if now > before * (1 + tolerance) and now - before > min_delta:
+            slower[stage] = {'baseline': before, 'now': round(now, 4)}
+    return slower
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def write_junit(path, records, duration):
+    suite = ET.Element('testsuite', name='piston-packages', tests=str(len(records)), time=f'{duration:.3f}')
+    failures = skipped = 0
+    for r in records:
+        case = ET.SubElement(suite, 'testcase', classname=r['name'].rsplit('/', 1)[0], name=r['name'].rsplit('/', 1)[1], time=f"{(r['timings']['total'] or 0) / 1000:.3f}")
+        if r['status'] == 'skipped':
+            skipped += 1
+            ET.SubElement(case, 'skipped', message=r['error'] or 'Skipped')
+        elif r['status'] == 'failed':
+            failures += 1
+            ET.SubElement(case, 'failure', message=r['error'] or 'Did not print OK').text = r['output']
+        elif r['regression']:
+            failures += 1
+            message = ', '.join(f"{k} {v['baseline'] * 1000:.0f}ms -> {v['now'] * 1000:.0f}ms" for k, v in r['regression'].items())
+            ET.SubElement(case, 'failure', type='regression', message=f'Slower than the baseline: {message}')
+    suite.set('failures', str(failures))
+    suite.set('skipped', str(skipped))
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the package tests concurrently against a Piston API')
+    parser.add_argument('packages', nargs='*', help='Only test these packages, as package, package/version or package/version/test file')
+    parser.add_argument('--url', default=os.environ.get('PISTON_URL', 'http://127.0.0.1:2000'), help='Base URL of the API (default: $PISTON_URL or http://127.0.0.1:2000)')
+    parser.add_argument('--api-key', default=os.environ.get('API_KEY'), help='Sent as the Authorization header (default: $API_KEY)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Tests to run at once')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds a test may take')
+    parser.add_argument('--changed', metavar='REF', help='Only test packages changed since this git ref')
+    parser.add_argument('--install', action='store_true', help='Install the packages of tests whose runtime is missing instead of skipping them')
+    parser.add_argument('--junit', metavar='PATH', help='Write a JUnit XML report')
+    parser.add_argument('--json', metavar='PATH', help='Write a JSON report')
+    parser.add_argument('--baseline', metavar='PATH', help='Flag tests whose compile or run time regressed against this file')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the timings of passing tests to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Relative slowdown allowed before a stage counts as a regression')
+    parser.add_argument('--min-delta', type=float, default=0.1, help='Absolute slowdown in seconds allowed before a stage counts as a regression')
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    tests = discover()
+    if args.packages:
+        tests = select(tests, args.packages)
+    if args.changed:
+        changed = changed_packages(args.changed)
+        tests = [x for x in tests if (x.package, os.path.basename(os.path.dirname(x.path))) in changed]
+    if not tests:
+        print('No tests to run')
+        return 0
+    baseline = {}
+    if args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    start = time.perf_counter()
+    async with PistonClient(args.url, concurrency=args.concurrency, retries=1, timeout=args.timeout, api_key=args.api_key) as client:
+        try:
+            runtimes = await client.runtimes()
+        except PistonError as e:
+            print(f'Could not reach the API at {args.url}: {e}', file=sys.stderr)
+            return 2
+        missing = sorted({(x.package, x.version) for x in tests if not installed(x, runtimes)})
+        install_errors = {}
+        if missing and args.install:
+            print(f'Installing {", ".join(f"{p}-{v}" for p, v in missing)}')
+            results = await asyncio.gather(*(client.install(p, v) for p, v in missing), return_exceptions=True)
+            install_errors = {m: str(r) for m, r in zip(missing, results) if isinstance(r, Exception)}
+            runtimes = await client.runtimes()
+
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def run(test):
+            if not installed(test, runtimes):
+                return None
+            # The timeout starts once a slot is free, so tests waiting their turn do not time out
+            async with slots:
+                result = await run_test(client, test, args.timeout)
+            status = 'PASS' if result.passed else 'FAIL'
+            stages = ' '.join(f'{k} {getattr(result, k) * 1000:.0f}ms' for k in BASELINE_STAGES if getattr(result, k) is not None)
+            print(f'{status} {test.name} ({test.language}-{test.version}) {stages}', flush=True)
+            return result
+
+        results = await asyncio.gather(*(run(x) for x in tests))
+    duration = time.perf_counter() - start
+
+    records = []
+    for test, result in zip(tests, results):
+        key = (test.package, test.version)
+        record = {'name': test.name, 'language': test.language, 'version': test.version, 'regression': {}, 'output': '', 'error': None}
+        if result is None:
+            record['status'] = 'skipped'
+            record['error'] = f'Not installed: {install_errors[key]}' if key in install_errors else 'Runtime is not installed'
+            record['timings'] = dict.fromkeys(('total', 'queue', 'compile', 'run'))
+        else:
+            record['status'] = 'passed' if result.passed else 'failed'
+            record['error'] = result.error
+            record['timings'] = {k: ms(getattr(result, k)) for k in ('total', 'queue', 'compile', 'run')}
+            record['regression'] = regression(result, baseline, args.tolerance, args.min_delta)
+            if not result.passed:
+                record['output'] = result.output
+        records.append(record)
+
+    failed = [x for x in records if x['status'] == 'failed']
+    skipped = [x for x in records if x['status'] == 'skipped']
+    regressed = [x for x in records if x['regression']]
+    for x in failed:
+        print(f"\n=={x['name']}: {x['language']}-{x['version']}==\n{x['error'] or x['output']}")
+    for x in regressed:
+        print(f"Regressed: {x['name']} " + ', '.join(f"{k} {v['baseline'] * 1000:.0f}ms -> {v['now'] * 1000:.0f}ms" for k, v in x['regression'].items()))
+    print(f'\n{len(records) - len(failed) - len(skipped)} passed, {len(failed)} failed, {len(skipped)} skipped, {len(regressed)} regressed in {duration:.1f}s')
+
+    if args.junit:
+        write_junit(args.junit, records, duration)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'url': args.url, 'started': started, 'duration': round(duration, 3), 'tests': records}, f, indent=2)
+    if args.baseline and args.update_baseline:
+        for test, result in zip(tests, results):
+            if result is not None and result.passed:
+                baseline[test.name] = {k: round(getattr(result, k), 4) for k in BASELINE_STAGES if getattr(result, k) is not None}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    return 1 if failed or regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
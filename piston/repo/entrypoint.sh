@@ -6,6 +6,8 @@ CI=0
 
 echo "Running through arguments.."
 
+PACKAGES=()
+
 for pkg in "$@"
 do
     shift
@@ -22,32 +24,32 @@ do
         CI=1
     else
         if [[ $BUILD -eq 1 ]]; then
-            echo "Building package $pkg"
-            make -j16 $pkg.pkg.tar.gz PLATFORM=docker-debian
-            echo "Done with package $pkg"
+            echo "Queueing package $pkg"
+            PACKAGES+=("$pkg")
         elif [[ $CI -eq 1 ]]; then
             echo "Commit SHA: $pkg"
-            
-            cd ..
-            echo "Changed files:"
-            git diff --name-only $pkg^1 $pkg
-            PACKAGES=$(git diff --name-only $pkg^1 $pkg | awk -F/ '{ print $2 "-" $3 }' | sort -u)
-            cd packages
 
-            echo "Building packages: $PACKAGES"
-            for package in "$PACKAGES"; do
-                make -j16 $package.pkg.tar.gz PLATFORM=docker-debian
-            done
+            echo "Changed files:"
+            git -C .. diff --name-only $pkg^1 $pkg
 
+            echo "Building packages changed in $pkg"
+            python3 build.py --platform docker-debian --changed $pkg^1
         else
             echo "Building was disabled, skipping $pkg build=$BUILD ci=$CI"
         fi
     fi
 done
 
+if [[ ${#PACKAGES[@]} -gt 0 ]]; then
+    # Packages whose archive is already up to date are skipped
+    echo "Building packages ${PACKAGES[*]}"
+    python3 build.py --platform docker-debian "${PACKAGES[@]}"
+    echo "Done with packages"
+fi
+
 cd /piston/repo
 echo "Creating index"
-./mkindex.sh
+python3 mkindex.py
 echo "Index created"
 
 if [[ $SERVER -eq 1 ]]; then
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Creates the package index the API downloads packages from.
+
+Each line of the index is `name,version,sha256,url` for one package archive. Archives are
+hashed in parallel worker processes using memory-mapped reads, and the checksums are kept in
+a cache keyed by path, size and modification time, so archives that did not change are never
+read again. Archives are linked or copied next to the index to be served with it, and the
+index is replaced atomically.
+
+    ./mkindex.py
+    ./mkindex.py --base-url https://example.com/pkgs/ --packages /path/to/archives
+    ./mkindex.py --benchmark
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SUFFIX = '.pkg.tar.gz'
+
+# Bytes hashed per update. Slices of the mapping are handed to sha256 without copying.
+CHUNK = 8 * 1024 * 1024
+
+
+def sha256(path):
+    """Returns the hex sha256 of a file, read through a memory map"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                for i in range(0, size, CHUNK):
+                    h.update(view[i:i + CHUNK])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+
+def find_archives(packages_dir):
+    """Returns the paths of the package archives under a directory, sorted by file name"""
+    found = []
+    for directory, _, files in os.walk(packages_dir):
+        found.extend(os.path.join(directory, x) for x in files if x.endswith(SUFFIX))
+    return sorted(found, key=os.path.basename)
+
+
+def parse_name(file):
+    """Returns the name and version of an archive. The version starts at the first dash followed by a digit, so both names and prerelease versions may contain dashes."""
+    base = file[:-len(SUFFIX)]
+    match = re.match(r'^(.+?)-(\d.*)$', base)
+    if match is None:
+        name, _, version = base.rpartition('-')
+        return name, version
+    return match.group(1), match.group(2)
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_atomic(path, text):
+    """Writes a file so readers see either the old or the new contents"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def publish(path, directory):
+    """Makes an archive available in the served directory, hard linking it when possible instead of copying"""
+    target = os.path.join(directory, os.path.basename(path))
+    if os.path.abspath(path) == os.path.abspath(target):
+        return
+    source = os.stat(path)
+    try:
+        existing = os.stat(target)
+        if existing.st_size == source.st_size and existing.st_mtime_ns == source.st_mtime_ns:
+            return
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copy2(path, target)
+
+
+def checksums(archives, cache, workers):
+    """Returns the checksum of every archive, hashing only those whose path, size or modification time is not in the cache. Updates the cache and returns the number of archives hashed."""
+    result = {}
+    stale = []
+    for path in archives:
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        entry = cache.get(key)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            result[path] = entry['sha256']
+        else:
+            stale.append((path, key, st))
+    if stale:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(stale))) as pool:
+            # Largest first, so a big toolchain does not start last and hold up the index
+            stale.sort(key=lambda x: x[2].st_size, reverse=True)
+            futures = {pool.submit(sha256, path): (path, key, st) for path, key, st in stale}
+            for future in concurrent.futures.as_completed(futures):
+                path, key, st = futures[future]
+                result[path] = future.result()
+                cache[key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': result[path]}
+    # Archives that no longer exist are dropped from the cache
+    keep = {os.path.abspath(x) for x in archives}
+    for key in [x for x in cache if x not in keep]:
+        del cache[key]
+    return result, len(stale)
+
+
+def make_index(packages_dir, output, base_url, cache_path, workers, copy=True, quiet=False):
+    """Writes the index and returns the number of archives it lists and how many of them were hashed"""
+    archives = find_archives(packages_dir)
+    cache = load_cache(cache_path) if cache_path else {}
+    sums, hashed = checksums(archives, cache, workers)
+    lines = []
+    for path in archives:
+        file = os.path.basename(path)
+        name, version = parse_name(file)
+        if copy:
+            publish(path, os.path.dirname(os.path.abspath(output)))
+        lines.append(f'{name},{version},{sums[path]},{base_url}{file}\n')
+        if not quiet:
+            print(f'Adding package {name}-{version}')
+    write_atomic(output, ''.join(lines))
+    if cache_path:
+        write_atomic(cache_path, json.dumps(cache, indent=1, sort_keys=True))
+    return len(archives), hashed
+
+
+def benchmark(args):
+    """Times a serial run without a cache, the parallel run without a cache, and the run with a warm cache"""
+    archives = find_archives(args.packages)
+    size = sum(os.path.getsize(x) for x in archives)
+    print(f'{len(archives)} archives, {size / 2 ** 20:.1f} MiB')
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'index')
+        cache = os.path.join(tmp, 'cache.json')
+        start = time.perf_counter()
+        for path in archives:
+            with open(path, 'rb') as f:
+                hashlib.sha256(f.read()).hexdigest()
+        serial = time.perf_counter() - start
+        start = time.perf_counter()
+        make_index(args.packages, output, args.base_url, cache, args.workers, copy=False, quiet=True)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        _, hashed = make_index(args.packages, output, args.base_url, cache, args.workers, copy=False, quiet=True)
+        warm = time.perf_counter() - start
+    print(f'Serial, no cache:               {serial:8.3f}s')
+    print(f'Cold ({args.workers} workers, empty cache): {cold:8.3f}s')
+    print(f'Warm (cached, {hashed} hashed):      {warm:8.3f}s')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Creates the package index')
+    parser.add_argument('--packages', default=os.path.join(REPO_DIR, '..', 'packages'), help='Directory to find package archives in')
+    parser.add_argument('--output', default=os.path.join(REPO_DIR, 'index'), help='Index file to write. Archives are linked or copied next to it.')
+    parser.add_argument('--base-url', default=os.environ.get('BASEURL', 'http://repo:8000/'), help='URL the archives are served from (default: $BASEURL or http://repo:8000/)')
+    parser.add_argument('--cache', default=os.path.join(REPO_DIR, '.index-cache.json'), help='Checksum cache file')
+    parser.add_argument('--no-cache', action='store_true', help='Hash every archive')
+    parser.add_argument('--no-copy', action='store_true', help='Do not link or copy archives next to the index')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes to hash archives with')
+    parser.add_argument('--benchmark', action='store_true', help='Compare index times with a cold and a warm cache, without writing the index')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.benchmark:
+        benchmark(args)
+        return 0
+    start = time.perf_counter()
+    count, hashed = make_index(args.packages, args.output, args.base_url, None if args.no_cache else args.cache, args.workers, copy=not args.no_copy)
+    print(f'Indexed {count} packages ({hashed} hashed) in {time.perf_counter() - start:.2f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())